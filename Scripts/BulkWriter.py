@@ -0,0 +1,90 @@
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+#####################################################################################
+# BulkWriter.py
+# Author: Adi Bhan
+# This script batches MongoDB upserts so that a refresh sends a few bulk_write calls instead of one round trip per document
+###############################################################################################################
+
+
+class BulkUpsertWriter:
+    """ BulkUpsertWriter collects documents and upserts them with bulk_write, matching on a unique key field.
+        Documents are flushed automatically every batch_size documents and when flush is called.
+        Documents that could not be written are counted in report["errors"] and their keys kept in failed_keys """
+
+    def __init__(self, collection, key: str, batch_size: int = 500, ordered: bool = False):
+        self.collection = collection
+        self.key = key
+        self.batch_size = max(1, batch_size)
+        self.ordered = ordered
+        self.operations = []
+        self.keys = []
+        # Key values of the documents that did not exist before, in the order they were inserted
+        self.inserted_keys = []
+        # Key values of the documents that were not written (write errors, or the whole batch if bulk_write failed)
+        self.failed_keys = []
+        self.report = {"inserted": 0, "modified": 0,
+                       "unchanged": 0, "errors": 0}
+
+    def ensure_index(self) -> None:
+        """ ensure_index creates the unique index on the key field that the upserts match on (no-op if it exists) """
+        self.collection.create_index(self.key, unique=True)
+
+    def add(self, document: dict) -> None:
+        """ add queues an upsert of document, replacing the fields of any existing document with the same key """
+        self.operations.append(UpdateOne(
+            {self.key: document[self.key]}, {"$set": document}, upsert=True))
+        self.keys.append(document[self.key])
+        if len(self.operations) >= self.batch_size:
+            try:
+                self.flush()
+            except Exception as e:
+                # Already counted in the report and failed_keys, the caller checks them after its final flush
+                print(f"Error with bulk writing to MongoDB {self.collection.name}: {e}")
+
+    def flush(self) -> dict:
+        """ flush sends the queued upserts to MongoDB and returns the running report of
+            inserted, modified, unchanged and failed documents. Documents rejected by MongoDB (BulkWriteError) are counted
+            as errors; if bulk_write fails altogether (network error, timeout, ...) the whole batch is counted and the error is raised """
+        if not self.operations:
+            return self.report
+
+        operations, self.operations = self.operations, []
+        keys, self.keys = self.keys, []
+        try:
+            result = self.collection.bulk_write(
+                operations, ordered=self.ordered)
+            inserted, matched, modified = result.upserted_count, result.matched_count, result.modified_count
+            upserted = sorted(result.upserted_ids)
+        except BulkWriteError as e:
+            # In unordered mode every operation is attempted, so count what went through
+            details = e.details
+            inserted, matched, modified = details.get("nUpserted", 0), details.get(
+                "nMatched", 0), details.get("nModified", 0)
+            upserted = sorted(item["index"]
+                              for item in details.get("upserted", []))
+            failed = sorted(error["index"] for error in details.get("writeErrors", []))
+            if self.ordered and failed:
+                # An ordered bulk_write stops at the first error, the operations after it were never sent
+                failed += list(range(failed[-1] + 1, len(operations)))
+            self.report["errors"] += len(failed)
+            self.failed_keys.extend(keys[index] for index in failed)
+            print(
+                f"Error with bulk writing to MongoDB {self.collection.name}: {len(failed)} failed")
+        except Exception:
+            # Nothing is known to have been written, so the whole batch counts as failed
+            self.report["errors"] += len(operations)
+            self.failed_keys.extend(keys)
+            raise
+
+        self.inserted_keys.extend(keys[index] for index in upserted)
+        self.report["inserted"] += inserted
+        self.report["modified"] += modified
+        self.report["unchanged"] += matched - modified
+        return self.report
+
+    def print_report(self) -> None:
+        """ print_report prints a one line summary of everything written so far """
+        print(f"MongoDB {self.collection.name}: {self.report['inserted']} inserted, {self.report['modified']} modified, "
+              f"{self.report['unchanged']} unchanged, {self.report['errors']} errors")
@@ -0,0 +1,102 @@
+import heapq
+import re
+from collections import Counter
+from operator import itemgetter
+
+#####################################################################################
+# ChallengeCounter.py
+# Author: Adi Bhan
+# This script counts how often each vulnerability (challenge) occurs across municipalities, one record at a time
+###############################################################################################################
+
+CVE_PATTERN = re.compile(r"CVE-\d{4}-\d{4,}", re.IGNORECASE)
+
+# Longest label kept per challenge, so memory does not grow with the length of CVE descriptions
+MAX_LABEL_LENGTH = 200
+
+
+class ChallengeCounter:
+    """ ChallengeCounter counts vulnerability records keyed on their CVE id (or on the normalized description when there is no id).
+        Records can come from a Mongo cursor, the fetch generators or the old challenge tables.
+        Counters for separate municipalities can be built in parallel and merged with merge() or + """
+
+    def __init__(self):
+        self.counts = Counter()
+        self.labels = {}
+
+    @staticmethod
+    def normalize(record) -> tuple:
+        """ normalize returns (key, label) for a record. A record is a description string, a stored
+            vulnerability ({"CVE", "Vulnerability"}) or a raw UpGuard vulnerability ({"cve": {"id", "description"}}) """
+        if isinstance(record, dict):
+            cve = record.get("cve") if isinstance(
+                record.get("cve"), dict) else {}
+            identifier = record.get("CVE") or cve.get("id")
+            description = record.get("Vulnerability") or cve.get(
+                "description") or ""
+        else:
+            identifier, description = None, str(record)
+
+        if not identifier:
+            match = CVE_PATTERN.search(description)
+            identifier = match.group(0) if match else None
+        if identifier:
+            identifier = identifier.upper()
+            if description and identifier not in description.upper():
+                return identifier, f"{identifier}: {description}"
+            return identifier, description or identifier
+        text = " ".join(description.split())
+        return text.lower(), text
+
+    def add(self, record, count: int = 1) -> None:
+        """ add counts one vulnerability record """
+        key, label = self.normalize(record)
+        self.counts[key] += count
+        if key not in self.labels:
+            self.labels[key] = label[:MAX_LABEL_LENGTH]
+
+    def update(self, records) -> "ChallengeCounter":
+        """ update counts every record of an iterable (list, generator, cursor) without materializing it """
+        for record in records:
+            self.add(record)
+        return self
+
+    def update_from_documents(self, documents) -> "ChallengeCounter":
+        """ update_from_documents counts the vulnerabilities of Municipality_Vulnerabilities documents ({"name", "vulnerabilities": [...]}) """
+        for document in documents:
+            self.update(document.get("vulnerabilities") or [])
+        return self
+
+    @classmethod
+    def from_collection(cls, collection, municipalities: list = None) -> "ChallengeCounter":
+        """ from_collection streams the vulnerabilities collection (optionally only some municipalities) into a new counter """
+        query = {"name": {"$in": list(municipalities)}
+                 } if municipalities is not None else {}
+        return cls().update_from_documents(collection.find(query, {"vulnerabilities": 1, "_id": 0}))
+
+    @classmethod
+    def from_challenge_table(cls, challenge_table: list) -> "ChallengeCounter":
+        """ from_challenge_table counts the old format used by create_challenge_frequency_graph: a list of {city: [challenge, ...]} """
+        counter = cls()
+        for dict_ in challenge_table:
+            for vulnerabilities in dict_.values():
+                counter.update(vulnerabilities)
+        return counter
+
+    def merge(self, other: "ChallengeCounter") -> "ChallengeCounter":
+        """ merge adds the counts of another counter into this one """
+        self.counts.update(other.counts)
+        for key, label in other.labels.items():
+            self.labels.setdefault(key, label)
+        return self
+
+    def __add__(self, other: "ChallengeCounter") -> "ChallengeCounter":
+        return ChallengeCounter().merge(self).merge(other)
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def top(self, k: int) -> list:
+        """ top returns the k most frequent challenges as (label, count) pairs, using a bounded heap (O(n log k)) """
+        largest = heapq.nlargest(k, self.counts.items(), key=itemgetter(1))
+        return [(self.labels[key], count) for key, count in largest]
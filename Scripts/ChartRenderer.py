@@ -0,0 +1,144 @@
+import math
+import os
+import textwrap
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import pandas as pd
+import seaborn as sns
+from Metrics import timed_call
+
+#####################################################################################
+# ChartRenderer.py
+# Author: Adi Bhan
+# This script draws charts from chart specs with the object oriented Figure API (no pyplot global state),
+# so charts can be rendered one at a time or as a batch in a process pool
+###############################################################################################################
+
+# A chart spec is a dictionary with these keys:
+#   type          "bar", "stacked_bar", "histogram", "challenge_frequency", "timeseries" or "scatter_map"
+#   data          bar/histogram: {name: value}, stacked_bar: {column label: {name: value}},
+#                 challenge_frequency: list of (challenge, count) pairs,
+#                 timeseries: {series label: {"YYYY-MM-DD" period: count}},
+#                 scatter_map: {name: [longitude, latitude, value]}
+#   xaxis_label, yaxis_label, graph_title, file_name
+#   graph_dir, figsize, dpi (filled in by GraphGenerator.chart_spec)
+#   font_scale    optional seaborn font scale
+#   labels        scatter_map only, write the town names next to the points (default True)
+
+
+def _draw_bar(ax, spec) -> None:
+    series = pd.Series(spec["data"])
+    sns.barplot(x=series.index, y=series.values, hue=series.index, legend=False,
+                edgecolor='black', errorbar=None, saturation=30, ax=ax)
+    ax.set_xlabel("")
+    ax.set_title(spec["graph_title"], fontsize=23, fontweight='bold')
+    ax.set_ylim(0, 950)
+    ax.set_xticks([], [])
+    ax.set_ylabel(spec["yaxis_label"], fontsize=21)
+
+
+def _draw_stacked_bar(ax, spec) -> None:
+    data = pd.DataFrame(spec["data"])
+    if data.empty:
+        ax.text(0.5, 0.5, "No data", ha="center", va="center", transform=ax.transAxes)
+    else:
+        data.plot(kind='bar', stacked=True, ax=ax)
+        ax.legend()
+    ax.set_xlabel(spec["xaxis_label"])
+    ax.tick_params(axis='x', labelrotation=90)
+    ax.set_title(spec["graph_title"])
+
+
+def _draw_histogram(ax, spec) -> None:
+    series = pd.Series(list(spec["data"].values()))
+    sns.histplot(series, bins=30, edgecolor='black',
+                 color='blue', kde=True, line_kws={'color': 'lightblue'}, ax=ax)
+    ax.set_title(spec["graph_title"])
+    ax.set_xlabel(spec["xaxis_label"])
+
+
+def _draw_challenge_frequency(ax, spec) -> None:
+    vulnerabilities = [textwrap.fill(str(item[0]), 40)
+                       for item in spec["data"]]
+    frequencies = [item[1] for item in spec["data"]]
+    sns.barplot(x=frequencies, y=vulnerabilities, hue=vulnerabilities,
+                edgecolor='black', palette='Blues_d', legend=False, ax=ax)
+    ax.set_xlabel(spec["xaxis_label"])
+    ax.set_title(spec["graph_title"])
+
+
+def _draw_timeseries(ax, spec) -> None:
+    data = pd.DataFrame(spec["data"]).fillna(0)
+    data.index = pd.to_datetime(data.index)
+    if data.empty:
+        ax.text(0.5, 0.5, "No data", ha="center", va="center", transform=ax.transAxes)
+    else:
+        data.sort_index().plot(kind='line', marker='o', ax=ax)
+    ax.set_xlabel(spec["xaxis_label"])
+    ax.set_ylabel(spec["yaxis_label"])
+    ax.set_title(spec["graph_title"])
+    if not data.empty:
+        ax.legend()
+
+
+def _draw_scatter_map(ax, spec) -> None:
+    points = pd.DataFrame.from_dict(spec["data"], orient="index", columns=["longitude", "latitude", "value"])
+    # Every town in one scatter call, colored by its score on the UpGuard scale
+    scatter = ax.scatter(points["longitude"], points["latitude"], c=points["value"], cmap="RdYlGn",
+                         vmin=0, vmax=950, s=120, edgecolors="black", linewidths=0.5)
+    if spec.get("labels", True):
+        for name, (longitude, latitude) in points[["longitude", "latitude"]].iterrows():
+            ax.annotate(name, (longitude, latitude), xytext=(4, 4), textcoords="offset points", fontsize=8)
+    # Degrees of longitude are shorter than degrees of latitude away from the equator
+    if len(points):
+        ax.set_aspect(1 / math.cos(math.radians(points["latitude"].mean())), adjustable="datalim")
+    ax.figure.colorbar(scatter, ax=ax, label=spec["yaxis_label"])
+    ax.set_xlabel(spec["xaxis_label"])
+    ax.set_ylabel("Latitude")
+    ax.set_title(spec["graph_title"])
+
+
+CHART_TYPES = {
+    "bar": _draw_bar,
+    "stacked_bar": _draw_stacked_bar,
+    "histogram": _draw_histogram,
+    "challenge_frequency": _draw_challenge_frequency,
+    "timeseries": _draw_timeseries,
+    "scatter_map": _draw_scatter_map,
+}
+
+
+def render_chart(spec: dict) -> str:
+    """ render_chart draws one chart spec to a PNG file and returns its path.
+        The figure is cleared and released before returning so memory stays flat across many charts """
+    path = os.path.join(spec["graph_dir"], spec["file_name"])
+    with sns.plotting_context(font_scale=spec.get("font_scale", 1)):
+        fig = Figure(figsize=spec["figsize"], dpi=spec["dpi"])
+        FigureCanvasAgg(fig)
+        try:
+            ax = fig.add_subplot()
+            CHART_TYPES[spec["type"]](ax, spec)
+            fig.tight_layout()
+            fig.savefig(path, dpi=spec["dpi"])
+        finally:
+            fig.clear()
+    return path
+
+
+def render_batch(specs: list, max_workers: int = None) -> list:
+    """ render_batch renders chart specs in a process pool (one process per core by default).
+        Returns (file_name, error, seconds) tuples in spec order, error is None when the chart was saved
+        and seconds is the render time measured in the worker (None if it failed) """
+    results = []
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(timed_call, render_chart, spec) for spec in specs]
+        for spec, future in zip(specs, futures):
+            try:
+                _, seconds = future.result()
+                results.append((spec["file_name"], None, seconds))
+            except Exception as e:
+                results.append((spec["file_name"], e, None))
+    return results
@@ -1,10 +1,20 @@
 
+import argparse
+import datetime
+import hashlib
 import os
-import requests
+import threading
 from dotenv import load_dotenv
-import pymongo as pm
-import openpyxl
-from geopy.geocoders import Nominatim
+from FetchEngine import FetchEngine
+from GeocodeCache import GeocodeCache
+from BulkWriter import BulkUpsertWriter
+from ResponseStream import iter_records
+from Replay import FixtureRecorder
+from ResponseCache import ResponseCache, parse_ttls
+from MongoConnection import MongoConnection
+from Metrics import Metrics
+from RiskRollups import RiskRollups, parse_detected
+from MunicipalityRegistry import load_registry, hostnames, states, DEFAULT_STATE
 
 #####################################################################################
 # FetchData.py
@@ -13,11 +23,16 @@ from geopy.geocoders import Nominatim
 
 ###############################################################################################################
 
+# Dictionary of all municipalities and their respective domains used for querying UpGuard API,
+# read from the municipality registry (data/municipalities.csv, see MunicipalityRegistry.py)
+MUNICIPALITIES = hostnames(load_registry())
+
 
 class FetchData:
-    def __init__(self):
+    def __init__(self, connection: MongoConnection = None):
         """ Constructor for FetchData class
-            Loads environment variables from .env file to be used for UpGuard API"""
+            Loads environment variables from .env file to be used for UpGuard API
+            connection is an optional MongoConnection to share, by default the process-wide one is used"""
 
         load_dotenv()  # take environment variables from .env.
 
@@ -26,151 +41,184 @@ class FetchData:
         self.BASE_URL = os.getenv("UPGUARD_BASE_URL")
         self.EMAIL = os.getenv("UPGUARD_EMAIL")
         self.PASSWORD = os.getenv("UPGUARD_PASSWORD")
-        self.VENDOR_URL = "https://cyber-risk.upguard.com/api/public/vendor"
-        self.VULNERABILITY_URL = "https://cyber-risk.upguard.com/api/public/vulnerabilities/vendor"
-        self.RISKS_URL = "https://cyber-risk.upguard.com/api/public/risks"
-        self.geolocator = Nominatim(user_agent="MAPC_DATA")
+        # UPGUARD_API_ROOT can point at a local stand-in server (see Replay.py)
+        self.API_ROOT = os.getenv(
+            "UPGUARD_API_ROOT", "https://cyber-risk.upguard.com/api/public").rstrip("/")
+        self.VENDOR_URL = self.API_ROOT + "/vendor"
+        self.VULNERABILITY_URL = self.API_ROOT + "/vulnerabilities/vendor"
+        self.RISKS_URL = self.API_ROOT + "/risks"
+        self.VENDOR_RISKS_URL = self.API_ROOT + "/risks/vendors"
+        # The geocoder, geocode cache and score store are created on first use (see their properties),
+        # so commands that never touch them do not import geopy or numpy
+        self.lazy_lock = threading.Lock()
+        self.__geolocator = None
+        self.__geocode_cache = None
+        self.__score_store = None
 
         # Directory settings
 
         self.graph_dir = os.path.join(os.getcwd(), "data")
+        self.score_store_path = os.path.join(self.graph_dir, "Muncipalities.npy")
+        self.legacy_score_csv = os.path.join(self.graph_dir, "Muncipalities.csv")
+        # Workers on other hosts turn this off and the score store is rebuilt from MongoDB instead (see sync_score_store)
+        self.store_scores_locally = True
+        # Workers turn this off so only one process ever rebuilds the risk rollups (see __update_risk_rollups)
+        self.rebuild_empty_rollups = True
 
-        # MongoDB settings
-        self.MongoDB_URI = os.getenv("MONGO_URI")
-
-        # Initalize connection to MongoDB for storing data
-
-        self.client = pm.MongoClient(self.MongoDB_URI)
+        # MongoDB settings, the connection is only opened the first time a collection is used
+        self.connection = connection if connection is not None else MongoConnection.shared()
+        self.MongoDB_URI = self.connection.uri
 
-        if self.client.server_info():
-            print("Connected to MongoDB successfully")
-        else:
-            print("Failed to connect to MongoDB")
-
-        self.DB = self.client["Cluster0"]
-        self.collection_scores = self.DB["Municipality_Scores"]
-        self.collection_vulnerabilities = self.DB["Municipality_Vulnerabilities"]
-        self.collection_risks = self.DB["Muncipality_Risks"]
+        # Batched upserts, one writer per collection (see bulk_writer)
+        self.mongo_batch_size = int(os.getenv("MONGO_BATCH_SIZE", 500))
+        self.writers = {}
 
         self.headers = {
             "Authorization": self.API_KEY
         }
-        # Dictionary of all municipalities and their respective domains used for querying UpGuard API
-        self.muncipalities = {
-
-            "Maynard": "townofmaynard-ma.gov",
-            "Medford": "medfordma.org",
-            "Melrose": "cityofmelrose.org",
-            "Merrimac": "merrimac01860.info",
-            "Methuen": "cityofmethuen.net",
-            "Middleton": "middletonma.gov",
-            "Nahant": "nahant.org",
-            "Newbury": "townofnewbury.org",
-            "Newburyport": "cityofnewburyport.com",
-            "Newton": "newtonma.gov",
-            "North Andover": "northandoverma.gov",
-            "North Reading": "northreadingma.gov",
-            "Peabody": "peabody-ma.gov",
-            "Pepperell": "town.pepperell.ma.us",
-            "Reading": "readingma.gov",
-            "Rockport": "rockportma.gov",
-            "Rowley": "townofrowley.org",
-            "Salem": "salemma.gov",
-            "Salisbury": "salisburyma.gov",
-            "Saugus": "saugus-ma.gov",
-            "Sherborn": "sherbornma.org",
-            "Shirley": "shirley-ma.gov",
-            "Stoneham": "stoneham-ma.gov",
-            "Stow": "stow-ma.gov",
-            "Sudbury": "sudbury.ma.us",
-            "Swampscott": "swampscottma.gov",
-            "Tewksbury": "tewksbury-ma.gov",
-            "Topsfield": "topsfield-ma.gov",
-            "Townsend": "townsend.ma.us",
-            "Tyngsborough": "tyngsboroughma.gov",
-            "Wakefield": "wakefield.ma.us",
-            "WaterTown": "watertown-ma.gov",
-            "Wayland": "wayland.ma.us",
-            "Westford": "westfordma.gov",
-            "Weston": "weston.org",
-            "Wilmington": "wilmingtonma.gov",
-            "Winchester": "winchester.us",
-            "Woburn": "cityofwoburn.com",
-            "Georgetown": "georgetownma.gov",
-            "Gloucester": "gloucester-ma.gov",
-            "Groveland": "grovelandma.com",
-            "Hamilton": "hamiltonma.gov",
-            "Haverhill": "cityofhaverhill.com",
-            "Groton": "townofgroton.org",
-            "Ipswich": "ipswichma.gov",
-            "Lawrence": "cityoflawrence.com",
-            "Lexington": "lexingtonma.gov",
-            "Littleton": "littletonma.org",
-            "Lynn": "lynnma.gov",
-            "Lynnfield": "town.lynnfield.ma.us",
-            "Malden": "cityofmalden.org",
-            "Manchester": "manchester.ma.us",
-            "Marblehead": "marblehead.org",
-            "Marlborough": "marlborough-ma.gov",
-            "Acton": "acton-ma.gov",
-            "Amesbury": "amesburyma.gov",
-            "Andover": "andoverma.gov",
-            "Arlington": "arlingtonma.gov",
-            "Ayer": "ayer.ma.us",
-            "Bedford": "bedfordma.gov",
-            "Belmont": "belmont-ma.gov",
-            "Billercia": "town.billerica.ma.us",
-            "Beverly": "beverlyma.gov",
-            "Boxborough": "boxborough-ma.gov",
-            "Burlington": "burlington.org",
-            "Chelmsford": "chelmsfordma.gov",
-            "Concord": "concordma.gov",
-            "Danvers": "danversma.gov",
-            "Dracut": "dracutma.gov",
-            "Dunstable": "dunstable-ma.gov",
-            "Essex": "essexma.org",
-            "Frameingham": "framinghamma.gov",
-            "Holliston": "townofholliston.us",
-            "Hopkinton": "hopkintonma.gov",
-            "Lowell": "lowellma.gov",
-        }
+
+        # Concurrent fetch settings, shared session used by every collector
+        self.fetch_engine = FetchEngine(
+            headers=self.headers,
+            max_workers=int(os.getenv("UPGUARD_CONCURRENCY", 8)),
+            requests_per_second=float(os.getenv("UPGUARD_RATE_LIMIT", 10)),
+            max_retries=int(os.getenv("UPGUARD_MAX_RETRIES", 5)),
+            backoff_base=float(os.getenv("UPGUARD_BACKOFF_BASE", 0.5)),
+            backoff_max=float(os.getenv("UPGUARD_BACKOFF_MAX", 30)),
+            breaker_threshold=int(os.getenv("UPGUARD_BREAKER_THRESHOLD", 5)),
+            breaker_reset_seconds=float(os.getenv("UPGUARD_BREAKER_RESET", 30)),
+            timeout=float(os.getenv("UPGUARD_TIMEOUT", 30)))
+        if os.getenv("UPGUARD_RECORD_DIR"):
+            self.fetch_engine.recorder = FixtureRecorder(
+                os.getenv("UPGUARD_RECORD_DIR"))
+        # Response cache, UPGUARD_CACHE=off disables it. By default every response is revalidated (TTL 0)
+        if os.getenv("UPGUARD_CACHE", "").lower() != "off":
+            self.fetch_engine.cache = ResponseCache(
+                os.getenv("UPGUARD_CACHE") or os.path.join(
+                    os.getcwd(), "data", "response_cache.sqlite"),
+                default_ttl=float(os.getenv("UPGUARD_CACHE_TTL", 0)),
+                ttls=parse_ttls(os.getenv("UPGUARD_CACHE_TTLS")))
+        # Municipalities whose data changed since the previous run, per collector (see __fetch_each)
+        self.changed = {}
+        # Dictionary of all municipalities and their respective domains used for querying UpGuard API,
+        # read again here so a MUNICIPALITY_REGISTRY set in .env is used
+        registry = load_registry()
+        self.muncipalities = hostnames(registry)
+        # State of each municipality, used in geocoder queries
+        self.states = states(registry)
         # self.VULNERABILITY_TABLE = self.__parse_vulnerabilities()
 
-    def test_vendors(self) -> None:
+    @property
+    def geolocator(self):
+        """ The Nominatim geocoder, geopy is imported on first access """
+        with self.lazy_lock:
+            if self.__geolocator is None:
+                from geopy.geocoders import Nominatim
+                self.__geolocator = Nominatim(user_agent="MAPC_DATA")
+            return self.__geolocator
+
+    @property
+    def geocode_cache(self) -> GeocodeCache:
+        """ The geocode cache used by vendor_scores, opened on first access """
+        geolocator = self.geolocator
+        with self.lazy_lock:
+            if self.__geocode_cache is None:
+                self.__geocode_cache = GeocodeCache(
+                    os.getenv("GEOCODE_CACHE", os.path.join(
+                        os.getcwd(), "data", "geocode_cache.sqlite")),
+                    geocoder=geolocator,
+                    ttl_days=float(os.getenv("GEOCODE_TTL_DAYS", 365)),
+                    gazetteer=os.getenv("GEOCODE_GAZETTEER"))
+            return self.__geocode_cache
+
+    @property
+    def score_store(self):
+        """ The local score store (Muncipalities.npy), numpy and pandas are imported on first access """
+        with self.lazy_lock:
+            if self.__score_store is None:
+                from ScoreStore import ScoreStore
+                self.__score_store = ScoreStore(
+                    self.score_store_path, legacy_csv=self.legacy_score_csv)
+            return self.__score_store
+
+    @property
+    def client(self):
+        """ MongoDB client, connects on first access """
+        return self.connection.client
+
+    @property
+    def DB(self):
+        return self.connection.db
+
+    @property
+    def collection_scores(self):
+        return self.DB["Municipality_Scores"]
+
+    @property
+    def collection_vulnerabilities(self):
+        return self.DB["Municipality_Vulnerabilities"]
+
+    @property
+    def collection_risks(self):
+        return self.DB["Muncipality_Risks"]
+
+    @property
+    def collection_ingest_state(self):
+        return self.DB["Ingest_State"]
+
+    @property
+    def collection_dead_letters(self):
+        return self.DB["Dead_Letters"]
+
+    @property
+    def collection_risk_rollups(self):
+        return self.DB["Muncipality_Risk_Rollups"]
+
+    @property
+    def metrics(self) -> Metrics:
+        """ The metrics the fetch engine records to (the process-wide Metrics unless replaced), see Metrics.py """
+        return self.fetch_engine.metrics
+
+    @property
+    def geo_query(self):
+        """ Nearest, radius and polygon lookups over Municipality_Scores (see GeoQuery.py) """
+        from GeoQuery import GeoQuery
+        return GeoQuery(self.collection_scores, native=self.connection.backend != "memory")
+
+    @property
+    def risk_rollups(self) -> RiskRollups:
+        return RiskRollups(self.collection_risk_rollups)
+
+    def test_vendors(self, municipalities: list = None) -> None:
         """ test_vendors used for testing purposes to make sure Vendor endpoint can be reached from UpGuard API** 
-            ** If assert error is thrown, check the municipality name and URL in the muncipalities dictionary **"""
-        for municipality in self.muncipalities:
-
-            params = {
-                "hostname": self.muncipalities[municipality],
-            }
-            response = requests.get(
-                self.VENDOR_URL, headers=self.headers, params=params)
-
-            if (response.status_code == 200):
-                print(municipality)
-                print(response.json(), "\n")
-                print()
-            else:
-                assert response.status_code == 200, f"\n | Error: {response.status_code} City: {municipality} URL: {self.muncipalities[municipality]}| \n"
-        print(
-            f"Success! All muncipalities endpoints work properly. Total number of municipalities: {len(self.muncipalities)}")
-
-    def vendor_scores(self) -> None:
-        """ get_vendor_scores method pulls all vendor scores from UpGuard API and stores them locally in a csv file and MongoDB under collection: Municipality_Scores"""
+            ** If a municipality fails, check its name and URL in the muncipalities dictionary **"""
+        names = municipalities or list(self.muncipalities)
+        responses = self.__fetch_each(self.VENDOR_URL, lambda hostname: {
+            "hostname": hostname,
+        }, None, names)
+        for municipality, response in responses:
+            print(municipality)
+            print(response.json(), "\n")
+            print()
+        if len(responses) == len(names):
+            print(
+                f"Success! All muncipalities endpoints work properly. Total number of municipalities: {len(names)}")
+
+    def vendor_scores(self, municipalities: list = None) -> None:
+        """ get_vendor_scores method pulls all vendor scores from UpGuard API and stores them locally in the score store (Muncipalities.npy) and MongoDB under collection: Municipality_Scores
+            municipalities optionally limits the refresh to some municipality names """
         locations = []
-        for municipality in self.muncipalities:
-            params = {
-                "hostname": self.muncipalities[municipality]
-            }
-            response = requests.get(
-                self.VENDOR_URL, headers=self.headers, params=params)
+        scores = []
+        responses = self.__fetch_each(self.VENDOR_URL, lambda hostname: {
+            "hostname": hostname
+        }, "scores", municipalities)
+        for municipality, response in responses:
 
             municipality_data = response.json()
 
             # get coordinates for each municipality, and adding to municipality_data dictionary
-            location = self.geolocator.geocode(
-                municipality + ", Massachusetts, USA")
+            location = self.geocode_cache.geocode(
+                f"{municipality}, {self.states.get(municipality, DEFAULT_STATE)}, USA")
             print(municipality, location)
 
             locations.append(location)
@@ -183,100 +231,213 @@ class FetchData:
             else:
                 print(f'Failed to get coordinates for {municipality}')
 
-            if (response.status_code == 200):
-
-                # store data locally in Muncipalities.csv file
-
-                print(os.path.join(self.graph_dir, "Muncipalities.csv"))
-                with open(os.path.join(self.graph_dir, "Muncipalities.csv"), "a") as file:
-                    file.write(str(municipality_data))
-                    file.write("\n")
-            else:
-                assert response.status_code == 200, f"\n | Error: {response.status_code} City: {municipality} URL: {self.muncipalities[municipality]}| \n"
+            # collected here and stored locally in one upsert once every municipality is fetched
+            scores.append(municipality_data)
 
             # finally, send municipality data to MongoDB for storage
             self.__send_to_mongodb(
                 municipality_data, municipality, self.collection_scores)
 
-        print("Success! All muncipalities are stored in Data.csv file")
+        self.flush_writer(self.collection_scores)
+        try:
+            self.geo_query.ensure_index()
+        except Exception as e:
+            print(f"Error with creating the location index: {e}")
+        if not self.store_scores_locally:
+            return
+        self.score_store.upsert(scores)
+        print(
+            f"Success! All muncipalities are stored in {self.score_store.path}")
+
+    def sync_score_store(self) -> None:
+        """ sync_score_store upserts every vendor score stored in MongoDB (Municipality_Scores) into the local score store,
+            so graphs drawn on this host include the municipalities fetched by workers on other hosts """
+        try:
+            scores = [document["data"] for document in self.collection_scores.find({}, {"_id": 0, "data": 1})
+                      if document.get("data")]
+        except Exception as e:
+            print(f"Error with querying MongoDB: {e}")
+            return
+        self.score_store.upsert(scores)
+        print(
+            f"Synced {len(scores)} muncipalities from MongoDB {self.collection_scores.name} into {self.score_store.path}")
 
     def test_endpoints(self) -> None:
         params = {
             "hostname": "danversma.gov",
             "primary_hostname": "danversma.gov",
         }
-        URL = "https://cyber-risk.upguard.com/api/public/risks/vendors"
-
-        response = requests.get(URL, headers=self.headers, params=params)
+        response = self.fetch_engine.get(self.VENDOR_RISKS_URL, params=params)
 
         print(response.json())
 
-    def __send_to_mongodb(self, data, muncipality, cluster) -> None:
-        """ send_to_mongodb method sends data to MongoDB server. 
-             ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
-        # cluster_name = cluster.name.split(' | ')[1]
+    def __hostname_params(self, hostname) -> dict:
+        """ Returns the query parameters used by the risks and vulnerabilities endpoints for a hostname
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        return {
+            "hostname": hostname,
+            "vendor_primary_hostname": hostname,
+            "ip": hostname,
+            "primary_hostname": hostname
+        }
 
+    def __fetch_each(self, url, build_params, collector: str = None, names: list = None) -> list:
+        """ Fetches url once for every municipality (or only the given names) through the concurrent fetch engine.
+            Returns (municipality, response) pairs in the order of self.muncipalities so results are stored exactly as the sequential loop did.
+            Municipalities that failed after all retries are left out and put on the dead letter list of the collector (if one is given)
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        names = [name for name in self.muncipalities if names is None or name in names]
+        responses = self.fetch_engine.fetch_all(
+            [(url, build_params(self.muncipalities[name])) for name in names])
+
+        fetched = []
+        for name, response in zip(names, responses):
+            if response is not None:
+                self.metrics.observe("municipality_fetch_seconds", response.fetch_seconds,
+                                     collector=collector or "test", municipality=name)
+            if response is not None and response.status_code == 200:
+                fetched.append((name, response))
+                continue
+            reason = "no response" if response is None else f"HTTP {response.status_code}: {response.text[:200]}"
+            if collector is None:
+                print(f"\n | Error: {reason} City: {name} URL: {self.muncipalities[name]}| \n")
+            else:
+                self.dead_letter(collector, name, reason)
+        if collector is None:
+            return fetched
+
+        self.changed[collector] = [name for name, response in fetched
+                                   if getattr(response, "changed", True)]
+        print(f"{collector}: {len(self.changed[collector])} of {len(fetched)} municipalities changed since the previous run")
+        self.clear_dead_letters(collector, [name for name, _ in fetched])
+        if len(fetched) < len(names):
+            print(f"\n | Error: {len(names) - len(fetched)} municipalities failed for {collector}, "
+                  f"retry them with FetchData.py --retry-failed | \n")
+        return fetched
+
+    def dead_letter(self, collector: str, name: str, reason: str) -> None:
+        """ dead_letter records that a municipality (or host) could not be fetched by a collector, see retry_dead_letters """
+        print(f"\n | Error: {collector} failed for {name}: {reason} | \n")
+        try:
+            self.collection_dead_letters.update_one({"_id": f"{collector}|{name}"}, {
+                "$set": {"collector": collector, "name": name, "reason": reason,
+                         "failed_at": datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)},
+                "$inc": {"attempts": 1}}, upsert=True)
+        except Exception as e:
+            print(f"Error with inserting into MongoDB: {e}")
+
+    def clear_dead_letters(self, collector: str, names: list) -> None:
+        """ clear_dead_letters removes municipalities that have now been fetched from a collector's dead letter list """
+        if not names:
+            return
         try:
-            # Check if the municipality already exists in the MongoDB cluster
+            self.collection_dead_letters.delete_many(
+                {"collector": collector, "name": {"$in": list(names)}})
+        except Exception as e:
+            print(f"Error with clearing MongoDB: {e}")
 
-            does_document_exist = cluster.find_one({"name": muncipality})
+    def dead_letters(self) -> dict:
+        """ dead_letters returns {collector: [municipality, ...]} of everything that failed and has not been fetched since """
+        failed = {}
+        for document in self.collection_dead_letters.find({}, {"collector": 1, "name": 1}):
+            failed.setdefault(document["collector"], []).append(document["name"])
+        return failed
+
+    def collectors(self) -> dict:
+        """ collectors returns the method that fetches each collector's data for a list of municipalities, used by retry_dead_letters """
+        return {
+            "scores": self.vendor_scores,
+            "vulnerabilities": self.fetch_vulnerabilities,
+            "risks": lambda municipalities: self.risk_timeseries(municipalities=municipalities),
+        }
 
-            if (not does_document_exist):
-                # Structure data in the way MongoDB expects, with 'municipality' as the key
+    def retry_dead_letters(self) -> None:
+        """ retry_dead_letters runs every collector again for only the municipalities on its dead letter list """
+        collectors = self.collectors()
+        for collector, names in self.dead_letters().items():
+            if collector not in collectors:
+                print(f"Skipping dead letters of {collector}, retry them with its own script (e.g. Remediation.py --retry-failed)")
+                continue
+            print(f"Retrying {collector} for {len(names)} municipalities")
+            collectors[collector](names)
+
+    def bulk_writer(self, collection, key: str = "name") -> BulkUpsertWriter:
+        """ bulk_writer returns the batched upsert writer for a collection, creating it (and its unique index on key) on first use """
+        if collection.name not in self.writers:
+            writer = BulkUpsertWriter(
+                collection, key, batch_size=self.mongo_batch_size, ordered=False)
+            try:
+                writer.ensure_index()
+            except Exception as e:
+                print(f"Error with creating index on {collection.name}: {e}")
+            self.writers[collection.name] = writer
+        return self.writers[collection.name]
+
+    def flush_writer(self, collection) -> bool:
+        """ flush_writer sends any queued upserts for a collection to MongoDB and prints how many documents changed.
+            Returns False if any document queued since the writer was created could not be written (see writer.failed_keys) """
+        writer = self.writers.get(collection.name)
+        if writer is None:
+            return True
+        try:
+            writer.flush()
+        except Exception as e:
+            print(f"Error with inserting into MongoDB: {e}")
+        writer.print_report()
+        return not writer.failed_keys
 
-                if (cluster == self.collection_scores):
-                    data_to_insert = data_to_insert = {
-                        "name": muncipality, "data": data}
-                if (cluster == self.collection_vulnerabilities):
-                    data_to_insert = {"name": muncipality,
-                                      "vulnerabilities": data[muncipality]}
+    def __send_to_mongodb(self, data, muncipality, cluster) -> None:
+        """ send_to_mongodb method queues data for a batched upsert into MongoDB, keyed on the municipality name.
+             Call flush_writer once all municipalities are queued.
+             ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+
+        try:
+            # Structure data in the way MongoDB expects, with 'municipality' as the key
 
-                cluster.insert_one(data_to_insert)
-                print(f"Successfully inserted {muncipality} into MongoDB ")
-            # else:
+            if (cluster == self.collection_scores):
+                data_to_insert = {"name": muncipality, "data": data}
+            if (cluster == self.collection_vulnerabilities):
+                data_to_insert = {"name": muncipality,
+                                  "vulnerabilities": data[muncipality]}
 
-                # print(f"Document already exists for {muncipality} ")
+            self.bulk_writer(cluster).add(data_to_insert)
 
         except Exception as e:
             print(f"Error with inserting into MongoDB: {e}")
 
-    def __parse_vulnerabilities(self) -> list:
+    def __parse_vulnerabilities(self, municipalities: list = None) -> list:
         """ parse_and_store_vulnerabilities method parses all vulnerabilities from UpGuard API and stores them in a csv file
             ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
 
         vulnerability_table = []
 
-        for municipality in self.muncipalities:
-            params = {
-                "hostname": self.muncipalities[municipality],
-                "vendor_primary_hostname": self.muncipalities[municipality],
-                "ip": self.muncipalities[municipality],
-                "primary_hostname": self.muncipalities[municipality]
-            }
-            response = requests.get(
-                self.VULNERABILITY_URL, headers=self.headers, params=params)
+        responses = self.__fetch_each(
+            self.VULNERABILITY_URL, self.__hostname_params, "vulnerabilities", municipalities)
+        for municipality, response in responses:
 
             municipality_vulnerabilities = {municipality: []}
 
-            if (response.status_code == 200):
-                for i in range(0, len(response.json()["vulnerabilities"])-1):
-                    severity = response.json(
-                    )["vulnerabilities"][i]['cve']['severity']
-                    vulnerability = response.json(
-                    )["vulnerabilities"][i]['cve']['description']
+            for record in iter_records(response, "vulnerabilities"):
+                severity = record['cve']['severity']
+                vulnerability = record['cve']['description']
 
-                    municipality_vulnerabilities[municipality].append({
+                municipality_vulnerabilities[municipality].append({
 
-                        "Vulnerability": vulnerability,
-                        "Severity": severity},)
-            else:
-                assert response.status_code == 200, f"\n | Error: {response.status_code} City: {municipality} URL: {self.muncipalities[municipality]}| \n"
+                    "CVE": record['cve'].get('id'),
+                    "Vulnerability": vulnerability,
+                    "Severity": severity},)
 
             self.__send_to_mongodb(
                 municipality_vulnerabilities, municipality, self.collection_vulnerabilities)
 
+        self.flush_writer(self.collection_vulnerabilities)
         return vulnerability_table
 
+    def fetch_vulnerabilities(self, municipalities: list = None) -> None:
+        """ fetch_vulnerabilities pulls every municipality's (or only the given municipalities') vulnerabilities from UpGuard API
+            and stores them in MongoDB under collection: Municipality_Vulnerabilities """
+        self.__parse_vulnerabilities(municipalities)
+
     def query_db(self, collection, municipality) -> dict:
         """ query_db method queries MongoDB for a specific municipality
             Returns a dictionary of the municipality's data"""
@@ -295,61 +456,179 @@ class FetchData:
         except Exception as e:
             print(f"Error with clearing MongoDB: {e}")
 
-    def risk_timeseries(self) -> None:
+    @staticmethod
+    def risk_key(city: str, risk: str, first_detected: str) -> str:
+        """ risk_key returns the deterministic identity of a risk document (city + risk + firstDetected),
+            used as the unique upsert key so re-running an ingest never duplicates a risk """
+        return hashlib.sha1(f"{city}|{risk}|{first_detected}".encode("utf-8")).hexdigest()
+
+    def risk_timeseries(self, since: str = None, until: str = None, municipalities: list = None) -> None:
         """Method to get Risk, Date, Severity, and Category/Type Data from UpGuard API and store it in MongoDB under collection: Municipality_Risk to be used for time series graphing (Risk over 2023)
+            Ingestion is incremental: only risks detected after each municipality's high-water mark (collection: Ingest_State) are written.
+            If since/until ("YYYY-MM-DD", inclusive) are given the high-water marks are ignored and that date range is backfilled instead.
+            municipalities optionally limits the ingest to some municipality names.
             URL: https://cyber-risk.upguard.com/api/public/risk"""
-        total_risk = []
-        for city in self.muncipalities:
-            self.params = {
-                "hostname": self.muncipalities[city],
-                "vendor_primary_hostname": self.muncipalities[city],
-                "ip": self.muncipalities[city],
-                "primary_hostname": self.muncipalities[city]
-
-            }
-            response = requests.get(
-                self.RISKS_URL, headers=self.headers, params=self.params)
+        backfill = since is not None or until is not None
+        high_water = {} if backfill else {
+            document["name"]: document.get("risks_high_water", "") for document in self.collection_ingest_state.find({})}
+
+        risk_writer = self.bulk_writer(self.collection_risks, key="Key")
+        state_writer = self.bulk_writer(self.collection_ingest_state)
+        # Documents queued in this run by key, so the ones that turn out to be new can be rolled up
+        pending = {}
+        already_inserted, already_failed = len(risk_writer.inserted_keys), len(risk_writer.failed_keys)
+        # New high-water mark per city, only stored once every risk of the city is written
+        high_water_updates = {}
+
+        responses = self.__fetch_each(
+            self.RISKS_URL, self.__hostname_params, "risks", municipalities)
+        for city, response in responses:
+            city_high_water = high_water.get(city, "")
+            latest = city_high_water
 
             # Parsing out the Risk, Date, Severity, and Category/Type Data from the API for each city and storing it in a list of dictionaries
 
-            for i in range(0, len(response.json()['risks'])-1):
-
-                data = response.json()['risks'][i]
+            for data in iter_records(response, "risks"):
 
                 # If any of the data is missing, skip it
                 if (not data.get("riskSubtype", None) or not data.get("severity", None) or not data.get("category", None) or not data.get("description", None)):
                     continue
                 else:
                     # If the data is from 2021, skip it (we only want data from 2023
-                    if (data["firstDetected"].split("-")[0] == "2021"):
+                    first_detected = data["firstDetected"]
+                    year, month, day = first_detected.split("-")[0:3]
+                    if (year == "2021"):
+                        continue
+
+                    # Skip risks already ingested, or outside of the backfill range
+                    if (first_detected <= city_high_water):
+                        continue
+                    if (since and first_detected[0:10] < since) or (until and first_detected[0:10] > until):
                         continue
+                    latest = max(latest, first_detected)
+
                     # Data is in format: "YEAR_MONTH_DAY" -> "MONTH_DAY_YEAR"
-                    date = data["firstDetected"].split(
-                        "-")[1] + "-" + data["firstDetected"].split(
-                        "-")[2][0:2] + "-" + data["firstDetected"].split("-")[0]
+                    date = month + "-" + day[0:2] + "-" + year
 
                     severity = data["severity"]
                     category = data["category"]
 
                     risk = data["risk"]
-                    total_risk.append({"Risk": risk, "Date": date,
-                                      "Severity": severity, "Category": category,
-                                       "Name": city})
+                    document = {"Key": self.risk_key(city, risk, first_detected),
+                                "Risk": risk, "Date": date, "FirstDetected": first_detected,
+                                "Detected": parse_detected(first_detected),
+                                "Severity": severity, "Category": category,
+                                "Name": city}
+                    pending[document["Key"]] = document
+                    risk_writer.add(document)
+
+            if (not backfill and latest != city_high_water):
+                high_water_updates[city] = latest
+
+        # Send data to MongoDB, risks first so a high-water mark never gets ahead of the data:
+        # a city with any risk that could not be written keeps its old mark and is put on the dead letter list
+        self.flush_writer(self.collection_risks)
+        failed_keys = set(risk_writer.failed_keys[already_failed:])
+        failed_cities = {pending[key]["Name"] for key in failed_keys if key in pending}
+        for city in sorted(failed_cities):
+            self.dead_letter("risks", city, "risks could not be written to MongoDB")
+        for city, latest in high_water_updates.items():
+            if city not in failed_cities:
+                state_writer.add({"name": city, "risks_high_water": latest})
+        if state_writer.operations:
+            self.flush_writer(self.collection_ingest_state)
+
+        if not backfill and municipalities is None:
+            self.__drop_unkeyed_risks()
+        self.__update_risk_rollups(
+            [pending[key] for key in risk_writer.inserted_keys[already_inserted:] if key in pending])
+
+        print(f"\nInserted {len(risk_writer.inserted_keys) - already_inserted} new risks into MongoDB {self.collection_risks.name}"
+              f" ({len(failed_keys)} failed)\n")
+
+    def backfill_risks(self, start: str, end: str) -> None:
+        """ backfill_risks re-ingests every risk first detected between start and end ("YYYY-MM-DD", inclusive).
+            Existing risks are matched on their key, so a backfill never creates duplicates """
+        self.risk_timeseries(since=start, until=end)
+
+    def __drop_unkeyed_risks(self) -> None:
+        """ Risks stored before incremental ingestion have no Key. A full run has just stored them again with a key,
+            so the old copies are removed and the unique index (which they block) is created
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        try:
+            result = self.collection_risks.delete_many(
+                {"Key": {"$exists": False}})
+            if result.deleted_count:
+                print(
+                    f"Removed {result.deleted_count} risks stored before incremental ingestion")
+                self.bulk_writer(self.collection_risks,
+                                 key="Key").ensure_index()
+        except Exception as e:
+            print(f"Error with clearing MongoDB: {e}")
 
-        # Send data to MongoDB
-        self.collection_risks.insert_many(total_risk)
-        print(
-            f"\nSuccessfully inserted data into MongoDB  {self.collection_risks}\n")
+    def __update_risk_rollups(self, inserted: list) -> None:
+        """ Adds newly inserted risks to the daily/weekly/monthly rollups (collection: Muncipality_Risk_Rollups).
+            If there are no rollups yet they are rebuilt from every stored risk instead, unless rebuild_empty_rollups is off
+            (workers: a rebuild deletes every rollup, including the increments of workers running at the same time)
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        rollups = self.risk_rollups
+        try:
+            self.collection_risks.create_index([("Name", 1), ("Detected", 1)])
+            self.collection_risks.create_index("Detected")
+            rollups.ensure_indexes()
+            if self.rebuild_empty_rollups and self.collection_risk_rollups.estimated_document_count() == 0:
+                touched = rollups.rebuild(self.collection_risks)
+            else:
+                touched = rollups.add(inserted)
+            print(
+                f"Updated {touched} rollups in MongoDB {self.collection_risk_rollups.name}")
+        except Exception as e:
+            print(f"Error with updating risk rollups: {e}")
+
+    def prepare_risk_rollups(self) -> None:
+        """ prepare_risk_rollups rebuilds the risk rollups from Muncipality_Risks if there are none yet.
+            Called once before risk jobs are handed to workers, which only add to the rollups """
+        try:
+            if self.collection_risk_rollups.estimated_document_count() == 0:
+                self.rebuild_risk_rollups()
+        except Exception as e:
+            print(f"Error with querying MongoDB: {e}")
+
+    def rebuild_risk_rollups(self) -> None:
+        """ rebuild_risk_rollups recomputes the risk rollups from Muncipality_Risks, e.g. after risks were removed by hand """
+        try:
+            touched = self.risk_rollups.rebuild(self.collection_risks)
+            print(
+                f"Rebuilt {touched} rollups in MongoDB {self.collection_risk_rollups.name}")
+        except Exception as e:
+            print(f"Error with rebuilding risk rollups: {e}")
 
     def save_to_exel(self) -> None:
 
-        # Function to save data to excel file using openpyxl
+        # Function to save data to excel file using openpyxl (import it here when this is written, not at module level)
 
         pass
 
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(
+        description="Incrementally ingest municipality risks from UpGuard")
+    parser.add_argument("--backfill", nargs=2, metavar=("START", "END"),
+                        help="Re-ingest risks first detected between START and END (YYYY-MM-DD)")
+    parser.add_argument("--rebuild-rollups", action="store_true",
+                        help="Recompute the daily/weekly/monthly risk rollups from the stored risks")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Fetch again every municipality that failed in an earlier run (see Dead_Letters)")
+    args = parser.parse_args()
+
     utilities = FetchData()
-    utilities.clear_db(utilities.collection_risks)
-    utilities.risk_timeseries()
+    if args.rebuild_rollups:
+        utilities.rebuild_risk_rollups()
+    elif args.retry_failed:
+        utilities.retry_dead_letters()
+    elif args.backfill:
+        utilities.backfill_risks(*args.backfill)
+    else:
+        utilities.risk_timeseries()
+    utilities.metrics.save()
@@ -0,0 +1,289 @@
+import email.utils
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from Metrics import Metrics
+from Replay import endpoint_name
+
+#####################################################################################
+# FetchEngine.py
+# Author: Adi Bhan
+# This script runs UpGuard API requests concurrently over one pooled HTTP session, with a per-host rate limit,
+# retries with jittered exponential backoff and a circuit breaker per endpoint
+###############################################################################################################
+
+
+# Responses worth retrying: rate limited or a temporary server error
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class FetchError(Exception):
+    """ FetchError is raised when a request could not get any response, after all retries """
+
+    def __init__(self, url: str, message: str):
+        super().__init__(f"{url}: {message}")
+        self.url = url
+
+
+class CircuitOpenError(FetchError):
+    """ CircuitOpenError is raised without sending the request while the circuit breaker of an endpoint is open """
+
+
+def retry_after_seconds(response) -> float:
+    """ retry_after_seconds returns how long a response asks to wait (Retry-After in seconds or as an HTTP date), or None """
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class CircuitBreaker:
+    """ CircuitBreaker stops requests to an endpoint after failure_threshold failures in a row.
+        After reset_seconds one trial request is let through: if it succeeds the circuit closes, otherwise it opens again """
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """ "closed", "open" or "half-open" """
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.reset_seconds else "open"
+
+    def allow(self) -> bool:
+        """ allow returns True if a request may be sent now """
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def success(self) -> None:
+        """ success closes the circuit """
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self) -> None:
+        """ failure counts a failed request and opens the circuit once the threshold is reached (or the trial request failed) """
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial = False
+
+
+class HostRateLimiter:
+    """ HostRateLimiter spaces out requests to a single host so that no more than
+        requests_per_second requests are started per second """
+
+    def __init__(self, requests_per_second: float):
+        self.interval = 1.0 / requests_per_second if requests_per_second > 0 else 0.0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        """ wait blocks the calling thread until it is allowed to send its request """
+        if self.interval == 0.0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def pause(self, seconds: float) -> None:
+        """ pause holds back every request to the host for the given number of seconds (e.g. after a 429) """
+        with self.lock:
+            self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+
+class FetchEngine:
+    """ FetchEngine sends GET requests in a bounded thread pool over a shared requests.Session.
+        Results are always returned in the same order as the requests were given.
+        Request errors (requests.RequestException) and RETRY_STATUSES responses are retried up to max_retries times with full jitter
+        exponential backoff (backoff_base * 2^attempt, at most backoff_max seconds), or as long as Retry-After asks.
+        Each endpoint (URL path) has a CircuitBreaker so a failing endpoint is not hammered """
+
+    def __init__(self, headers: dict = None, max_workers: int = 8, requests_per_second: float = 10.0,
+                 max_retries: int = 5, backoff_base: float = 0.5, backoff_max: float = 30.0,
+                 breaker_threshold: int = 5, breaker_reset_seconds: float = 30.0, timeout: float = 30.0,
+                 metrics: Metrics = None):
+        self.max_workers = max(1, max_workers)
+        self.requests_per_second = requests_per_second
+        self.max_retries = max(0, max_retries)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset_seconds = breaker_reset_seconds
+        self.timeout = timeout
+        self.random = random.Random()
+        # Request latency, bytes downloaded, retries and cache hits per endpoint, see Metrics.py
+        self.metrics = metrics if metrics is not None else Metrics.shared()
+
+        # One pooled session shared by every worker thread
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.max_workers,
+                              pool_maxsize=self.max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        if headers:
+            self.session.headers.update(headers)
+
+        self.limiters = {}
+        self.limiters_lock = threading.Lock()
+        self.breakers = {}
+        self.retries = 0
+
+        # Optional object with a record(url, params, response) method, see Replay.FixtureRecorder
+        self.recorder = None
+        # Optional ResponseCache, used for conditional requests and to tell callers whether data changed
+        self.cache = None
+
+    def __limiter(self, url: str) -> HostRateLimiter:
+        """ Returns the rate limiter for the host of url, creating it on first use
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        host = urlparse(url).netloc
+        with self.limiters_lock:
+            if host not in self.limiters:
+                self.limiters[host] = HostRateLimiter(self.requests_per_second)
+            return self.limiters[host]
+
+    def breaker(self, url: str) -> CircuitBreaker:
+        """ breaker returns the circuit breaker of the endpoint (URL path) of url, creating it on first use """
+        endpoint = urlparse(url).path
+        with self.limiters_lock:
+            if endpoint not in self.breakers:
+                self.breakers[endpoint] = CircuitBreaker(
+                    self.breaker_threshold, self.breaker_reset_seconds)
+            return self.breakers[endpoint]
+
+    def backoff(self, attempt: int) -> float:
+        """ backoff returns a random delay between 0 and backoff_base * 2^attempt seconds (capped at backoff_max) """
+        return self.random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def get(self, url: str, params: dict = None) -> requests.Response:
+        """ get sends a rate limited GET request using the shared session, retrying request errors and RETRY_STATUSES.
+            Returns the last response (check its status code), raises FetchError if no response was received
+            and CircuitOpenError if the endpoint's circuit is open.
+            With a cache the request may be answered locally or revalidated, see ResponseCache; response.changed tells
+            whether the body differs from the previous run. response.fetch_seconds is the time spent, retries included """
+        start = time.perf_counter()
+        if self.cache is None:
+            response = self.__send(url, params)
+        else:
+            entry = self.cache.lookup(url, params)
+            if entry is not None and entry["fresh"]:
+                self.metrics.inc("http_cache_hits_total", endpoint=endpoint_name(url))
+                response = self.cache.fresh(url, entry)
+                response.fetch_seconds = time.perf_counter() - start
+                return response
+            response = self.cache.resolve(url, params, self.__send(
+                url, params, self.cache.conditional_headers(entry)), entry)
+
+        if self.recorder is not None:
+            self.recorder.record(url, params, response)
+        response.fetch_seconds = time.perf_counter() - start
+        return response
+
+    def __send(self, url: str, params: dict = None, headers: dict = None) -> requests.Response:
+        """ Sends the request, with retries, backoff and the circuit breaker
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        limiter, breaker = self.__limiter(url), self.breaker(url)
+        endpoint = endpoint_name(url)
+        for attempt in range(self.max_retries + 1):
+            if not breaker.allow():
+                raise CircuitOpenError(url, "circuit open after repeated failures")
+
+            limiter.wait()
+            response, error = None, None
+            start = time.perf_counter()
+            try:
+                response = self.session.get(
+                    url, params=params, headers=headers, timeout=self.timeout)
+            except requests.RequestException as e:
+                # Connection errors, timeouts, truncated bodies (ChunkedEncodingError) ... are retried
+                error = e
+            except Exception:
+                # Counted as a failure so a half-open circuit's trial is never left pending
+                breaker.failure()
+                raise
+            self.metrics.observe("http_request_seconds", time.perf_counter() - start, endpoint=endpoint,
+                                 status=response.status_code if response is not None else "error")
+            if response is not None:
+                self.metrics.inc("http_bytes_total", len(response.content), endpoint=endpoint)
+
+            if response is not None and response.status_code not in RETRY_STATUSES:
+                breaker.success()
+                return response
+
+            # Rate limiting is not a fault of the endpoint, only errors count towards opening the circuit
+            if response is None or response.status_code != 429:
+                breaker.failure()
+            else:
+                breaker.success()
+            if attempt == self.max_retries:
+                break
+
+            delay = self.backoff(attempt)
+            retry_after = retry_after_seconds(response)
+            if retry_after is not None:
+                # Every thread sending to this host waits, not only this one
+                delay = max(delay, retry_after)
+                limiter.pause(retry_after)
+            with self.limiters_lock:
+                self.retries += 1
+            self.metrics.inc("http_retries_total", endpoint=endpoint)
+            time.sleep(delay)
+
+        if response is None:
+            raise FetchError(url, f"no response after {self.max_retries + 1} attempts ({error!r})")
+        return response
+
+    def fetch_all(self, jobs: list) -> list:
+        """ fetch_all takes a list of (url, params) tuples and returns the list of responses in the same order.
+            At most max_workers requests are in flight at any time. A request that raised any exception (FetchError
+            or otherwise) is returned as None, so one failing municipality does not abort the others """
+        if not jobs:
+            return []
+
+        def get(job):
+            try:
+                return self.get(*job)
+            except FetchError as e:
+                print(f"Error with fetching {e}")
+                return None
+            except Exception as e:
+                print(f"Error with fetching {job[0]}: {e!r}")
+                return None
+
+        workers = min(self.max_workers, len(jobs))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(get, jobs))
+
+    def close(self) -> None:
+        """ close releases the pooled connections """
+        self.session.close()
@@ -0,0 +1,200 @@
+import argparse
+import math
+from ScoreAnalytics import field_path
+
+#####################################################################################
+# GeoQuery.py
+# Author: Adi Bhan
+# This script answers location questions about the municipalities (nearest towns, towns within a radius or a polygon)
+# with the 2dsphere index on Municipality_Scores data.location, e.g. every town within 20 km of Danvers scoring below 500
+###############################################################################################################
+
+# Radius MongoDB uses to turn $centerSphere radians into kilometers
+EARTH_RADIUS_KM = 6378.1
+
+LOCATION_FIELD = "data.location"
+
+
+def haversine_km(longitude1: float, latitude1: float, longitude2: float, latitude2: float) -> float:
+    """ haversine_km returns the great circle distance between two points in kilometers """
+    phi1, phi2 = math.radians(latitude1), math.radians(latitude2)
+    dphi, dlambda = phi2 - phi1, math.radians(longitude2 - longitude1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def close_ring(polygon: list) -> list:
+    """ close_ring returns a polygon's [longitude, latitude] points with the first point repeated at the end, as GeoJSON needs """
+    ring = [list(point) for point in polygon]
+    if ring and ring[0] != ring[-1]:
+        ring.append(ring[0])
+    return ring
+
+
+def point_in_polygon(longitude: float, latitude: float, polygon: list) -> bool:
+    """ point_in_polygon tells whether a point is inside a polygon (ray casting on longitude/latitude, fine at town scale) """
+    ring = close_ring(polygon)
+    inside = False
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:]):
+        if (y1 > latitude) != (y2 > latitude):
+            if longitude < x1 + (latitude - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+    return inside
+
+
+class GeoQuery:
+    """ GeoQuery runs nearest, radius and polygon lookups on Municipality_Scores, optionally limited to a score range
+        (below is exclusive, above inclusive) of any score column. A center is a municipality name or a (longitude, latitude) pair.
+        Every lookup returns [{"name", "longitude", "latitude", "distance_km", column}] ("distance_km" only for nearest and radius).
+        With native=False (the in-memory backend, which has no geo operators) the same results are computed in Python """
+
+    def __init__(self, collection, native: bool = True):
+        self.collection = collection
+        self.native = native
+
+    def ensure_index(self) -> None:
+        """ ensure_index creates the 2dsphere index on data.location ([longitude, latitude]) the lookups use """
+        self.collection.create_index([(LOCATION_FIELD, "2dsphere")])
+
+    def location_of(self, name: str) -> tuple:
+        """ location_of returns the (longitude, latitude) stored for a municipality, raises ValueError if it has none """
+        document = self.collection.find_one({"name": name}, {"_id": 0, LOCATION_FIELD: 1})
+        location = (document or {}).get("data", {}).get("location")
+        if not location:
+            raise ValueError(f"No location stored for {name}, run vendor_scores first")
+        return tuple(location)
+
+    def __center(self, center) -> tuple:
+        """ Returns (longitude, latitude, name) of a municipality name or a (longitude, latitude) pair
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        if isinstance(center, str):
+            return self.location_of(center) + (center,)
+        return float(center[0]), float(center[1]), None
+
+    @staticmethod
+    def __score_filter(column: str, below: float, above: float) -> dict:
+        """ Returns the query on a score column for the below/above limits
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        limits = {}
+        if below is not None:
+            limits["$lt"] = below
+        if above is not None:
+            limits["$gte"] = above
+        return {field_path(column): limits} if limits else {}
+
+    @staticmethod
+    def __row(document: dict, column: str, center: tuple = None) -> dict:
+        """ Turns a projected Municipality_Scores document into a result row
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        data = document.get("data", {})
+        longitude, latitude = data["location"]
+        value = data
+        for part in field_path(column).split(".")[1:]:
+            value = value.get(part) if isinstance(value, dict) else None
+        row = {"name": document["name"], "longitude": longitude, "latitude": latitude, column: value}
+        if center is not None:
+            row["distance_km"] = round(haversine_km(center[0], center[1], longitude, latitude), 3)
+        return row
+
+    def __candidates(self, column: str, below: float, above: float, exclude: str = None) -> list:
+        """ Returns the rows of every located municipality in the score range, for the Python fallback
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        query = dict(self.__score_filter(column, below, above), **{LOCATION_FIELD: {"$exists": True}})
+        if exclude is not None:
+            query["name"] = {"$ne": exclude}
+        return [self.__row(document, column) for document in self.collection.find(
+            query, {"_id": 0, "name": 1, LOCATION_FIELD: 1, field_path(column): 1})]
+
+    def nearest(self, center, n: int = 5, column: str = "score", below: float = None, above: float = None,
+                max_km: float = None) -> list:
+        """ nearest returns the n municipalities closest to center (not counting the center town), nearest first """
+        longitude, latitude, name = self.__center(center)
+        query = self.__score_filter(column, below, above)
+        if name is not None:
+            query["name"] = {"$ne": name}
+        if self.native:
+            geo_near = {"near": {"type": "Point", "coordinates": [longitude, latitude]}, "key": LOCATION_FIELD,
+                        "distanceField": "distance", "spherical": True, "query": query}
+            if max_km is not None:
+                geo_near["maxDistance"] = max_km * 1000
+            documents = self.collection.aggregate([
+                {"$geoNear": geo_near}, {"$limit": n},
+                {"$project": {"_id": 0, "name": 1, LOCATION_FIELD: 1, field_path(column): 1}}])
+            return [self.__row(document, column, (longitude, latitude)) for document in documents]
+
+        rows = []
+        for row in self.__candidates(column, below, above, name):
+            row["distance_km"] = round(haversine_km(longitude, latitude, row["longitude"], row["latitude"]), 3)
+            if max_km is None or row["distance_km"] <= max_km:
+                rows.append(row)
+        return sorted(rows, key=lambda row: (row["distance_km"], row["name"]))[:n]
+
+    def within_radius(self, center, km: float, column: str = "score", below: float = None, above: float = None) -> list:
+        """ within_radius returns every municipality within km kilometers of center (the center town included), nearest first """
+        longitude, latitude, _ = self.__center(center)
+        if self.native:
+            query = dict(self.__score_filter(column, below, above), **{LOCATION_FIELD: {
+                "$geoWithin": {"$centerSphere": [[longitude, latitude], km / EARTH_RADIUS_KM]}}})
+            rows = [self.__row(document, column, (longitude, latitude)) for document in self.collection.find(
+                query, {"_id": 0, "name": 1, LOCATION_FIELD: 1, field_path(column): 1})]
+        else:
+            rows = []
+            for row in self.__candidates(column, below, above):
+                row["distance_km"] = round(haversine_km(longitude, latitude, row["longitude"], row["latitude"]), 3)
+                if row["distance_km"] <= km:
+                    rows.append(row)
+        return sorted(rows, key=lambda row: (row["distance_km"], row["name"]))
+
+    def within_polygon(self, polygon: list, column: str = "score", below: float = None, above: float = None) -> list:
+        """ within_polygon returns every municipality inside a polygon of [longitude, latitude] points, by name """
+        if self.native:
+            query = dict(self.__score_filter(column, below, above), **{LOCATION_FIELD: {
+                "$geoWithin": {"$geometry": {"type": "Polygon", "coordinates": [close_ring(polygon)]}}}})
+            rows = [self.__row(document, column) for document in self.collection.find(
+                query, {"_id": 0, "name": 1, LOCATION_FIELD: 1, field_path(column): 1})]
+        else:
+            rows = [row for row in self.__candidates(column, below, above)
+                    if point_in_polygon(row["longitude"], row["latitude"], polygon)]
+        return sorted(rows, key=lambda row: row["name"])
+
+
+if __name__ == "__main__":
+    from FetchData import FetchData
+
+    def center(value):
+        """ A municipality name or "longitude,latitude" """
+        try:
+            longitude, latitude = value.split(",")
+            return float(longitude), float(latitude)
+        except ValueError:
+            return value
+
+    parser = argparse.ArgumentParser(
+        description="Find municipalities by location, e.g. GeoQuery.py radius Danvers 20 --below 500")
+    parser.add_argument("--column", default="score",
+                        help="Score column to filter and print (score, websiteSecurity, emailSecurity, ...)")
+    parser.add_argument("--below", type=float, help="Only municipalities scoring below this")
+    parser.add_argument("--above", type=float, help="Only municipalities scoring at least this")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    nearest_parser = subparsers.add_parser("nearest", help="The municipalities closest to a town or point")
+    nearest_parser.add_argument("center", type=center)
+    nearest_parser.add_argument("-n", type=int, default=5)
+    nearest_parser.add_argument("--max-km", type=float)
+    radius_parser = subparsers.add_parser("radius", help="Every municipality within a distance of a town or point")
+    radius_parser.add_argument("center", type=center)
+    radius_parser.add_argument("km", type=float)
+    polygon_parser = subparsers.add_parser("polygon", help="Every municipality inside a polygon")
+    polygon_parser.add_argument("points", nargs="+", type=center, metavar="LONGITUDE,LATITUDE")
+    args = parser.parse_args()
+
+    geo = FetchData().geo_query
+    if args.command == "nearest":
+        rows = geo.nearest(args.center, args.n, args.column, args.below, args.above, args.max_km)
+    elif args.command == "radius":
+        rows = geo.within_radius(args.center, args.km, args.column, args.below, args.above)
+    else:
+        rows = geo.within_polygon(args.points, args.column, args.below, args.above)
+    for row in rows:
+        distance = f"{row['distance_km']:8.2f} km" if "distance_km" in row else ""
+        print(f"{row['name']:24} {row[args.column]!s:>6} {distance}")
+    print(f"{len(rows)} municipalities")
@@ -0,0 +1,155 @@
+import argparse
+import csv
+import os
+import sqlite3
+import time
+from collections import namedtuple
+
+#####################################################################################
+# GeocodeCache.py
+# Author: Adi Bhan
+# This script keeps an on-disk cache of municipality coordinates so vendor_scores does not hit Nominatim on every run
+###############################################################################################################
+
+# Same attribute names as geopy's Location, so callers can use either one
+GeoPoint = namedtuple("GeoPoint", ["latitude", "longitude"])
+
+
+class GeocodeCache:
+    """ GeocodeCache resolves place names to coordinates in this order:
+        local gazetteer file -> SQLite cache (if not expired) -> geocoder (result is then cached) """
+
+    def __init__(self, path: str, geocoder=None, ttl_days: float = 365, gazetteer: str = None, min_delay_seconds: float = 1.0):
+        self.path = path
+        self.ttl_seconds = ttl_days * 24 * 60 * 60
+        self.geocoder = geocoder
+        self.min_delay_seconds = min_delay_seconds
+        self.last_lookup = 0.0
+        self.gazetteer = {}
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS geocodes (query TEXT PRIMARY KEY, latitude REAL, longitude REAL, fetched_at REAL NOT NULL)")
+        self.connection.commit()
+
+        if gazetteer:
+            self.load_gazetteer(gazetteer)
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        """ normalize returns the cache key for a query: lowercase, single spaced, no spaces around commas """
+        parts = [" ".join(part.split()) for part in query.lower().split(",")]
+        return ",".join(part for part in parts if part)
+
+    def load_gazetteer(self, path: str) -> int:
+        """ load_gazetteer reads a CSV file with name, latitude and longitude columns.
+            Gazetteer entries always win over cached or geocoded coordinates. Returns the number of entries loaded """
+        with open(path, "r", newline="") as file:
+            for row in csv.DictReader(file):
+                self.gazetteer[self.normalize(row["name"])] = GeoPoint(
+                    float(row["latitude"]), float(row["longitude"]))
+        return len(self.gazetteer)
+
+    def __from_gazetteer(self, key: str):
+        """ Looks a key up in the gazetteer, first as a full query and then by its first part (the town name)
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        if key in self.gazetteer:
+            return self.gazetteer[key]
+        return self.gazetteer.get(key.split(",")[0])
+
+    def __from_geocoder(self, query: str):
+        """ Asks the geocoder for a query, waiting at least min_delay_seconds between calls (Nominatim usage policy)
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        wait = self.last_lookup + self.min_delay_seconds - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            location = self.geocoder.geocode(query)
+        finally:
+            self.last_lookup = time.monotonic()
+        return GeoPoint(location.latitude, location.longitude) if location is not None else None
+
+    def store(self, query: str, point) -> None:
+        """ store saves a result in the cache. A point of None is cached too, so failed lookups are not repeated until they expire """
+        latitude, longitude = (point.latitude, point.longitude) if point is not None else (None, None)
+        self.connection.execute("INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?)",
+                                (self.normalize(query), latitude, longitude, time.time()))
+        self.connection.commit()
+
+    def geocode(self, query: str, refresh: bool = False):
+        """ geocode returns a GeoPoint for query, or None when the place could not be found """
+        key = self.normalize(query)
+
+        point = self.__from_gazetteer(key)
+        if point is not None:
+            return point
+
+        if not refresh:
+            row = self.connection.execute(
+                "SELECT latitude, longitude, fetched_at FROM geocodes WHERE query = ?", (key,)).fetchone()
+            if row is not None and time.time() - row[2] < self.ttl_seconds:
+                return GeoPoint(row[0], row[1]) if row[0] is not None else None
+
+        if self.geocoder is None:
+            return None
+
+        point = self.__from_geocoder(query)
+        self.store(query, point)
+        return point
+
+    def prewarm(self, queries: list, refresh: bool = False) -> dict:
+        """ prewarm geocodes every query that is missing or expired (or all of them if refresh is set).
+            Returns a dictionary of query -> GeoPoint/None """
+        return {query: self.geocode(query, refresh=refresh) for query in queries}
+
+    def export_gazetteer(self, path: str) -> int:
+        """ export_gazetteer writes every cached coordinate to a CSV file that can be reviewed, corrected and loaded back as a gazetteer """
+        rows = self.connection.execute(
+            "SELECT query, latitude, longitude FROM geocodes WHERE latitude IS NOT NULL ORDER BY query").fetchall()
+        with open(path, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["name", "latitude", "longitude"])
+            writer.writerows(rows)
+        return len(rows)
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from geopy.geocoders import Nominatim
+    from MunicipalityRegistry import load_registry
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(
+        description="Manage the municipality geocode cache")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    prewarm_parser = subparsers.add_parser(
+        "prewarm", help="Geocode every municipality that is not cached yet")
+    prewarm_parser.add_argument("--refresh", action="store_true",
+                                help="Geocode every municipality again, even if it is cached")
+    export_parser = subparsers.add_parser(
+        "export", help="Write the cached coordinates to a gazetteer CSV file")
+    export_parser.add_argument("path")
+    args = parser.parse_args()
+
+    cache = GeocodeCache(os.getenv("GEOCODE_CACHE", os.path.join(os.getcwd(), "data", "geocode_cache.sqlite")),
+                         geocoder=Nominatim(user_agent="MAPC_DATA"),
+                         ttl_days=float(os.getenv("GEOCODE_TTL_DAYS", 365)),
+                         gazetteer=os.getenv("GEOCODE_GAZETTEER"))
+
+    if args.command == "prewarm":
+        results = cache.prewarm(
+            [f"{municipality.name}, {municipality.state}, USA" for municipality in load_registry()], refresh=args.refresh)
+        for query, point in results.items():
+            print(query, point)
+        print(
+            f"Success! {sum(point is not None for point in results.values())} / {len(results)} municipalities cached")
+    else:
+        print(f"Success! {cache.export_gazetteer(args.path)} entries written to {args.path}")
+    cache.close()
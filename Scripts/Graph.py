@@ -1,22 +1,18 @@
-import ast
 import json
 import os
-import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-import csv
 from dotenv import load_dotenv
-import textwrap
 from FetchData import FetchData
-import pymongo as pm
+from RenderCache import RenderCache
+from ScoreFrame import ScoreFrame, COLUMN_LABELS
+from ChallengeCounter import ChallengeCounter
+from ScoreAnalytics import ScoreAnalytics
 import datetime
 import platform
 
 #####################################################################################
 # FetchData.py
 # Author: Adi Bhan
-# This script will analyze the data from the Data.csv file and other sources to create graphs of the data
+# This script will analyze the data from the score store and other sources to create graphs of the data
 ###############################################################################################################
 
 
@@ -24,17 +20,14 @@ class GraphGenerator(FetchData):
 
     """ GraphGenerator class creates graphs of the data"""
 
-    def __init__(self):
-        self.name_to_score_map = {}
-        self.name_to_emailsecurity_map = {}
-        self.name_to_websecurity_map = {}
-        self.name_to_networksecurity_map = {}
+    def __init__(self, connection=None):
+        self.scores = None
         self.date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
         load_dotenv()  # take environment variables from .env.
 
         # Load Parent Class Constructor
-        super().__init__()
+        super().__init__(connection)
 
         # Directory settings
         self.graph_dir = os.getcwd() + "/graphs/"
@@ -54,73 +47,108 @@ class GraphGenerator(FetchData):
         height = 1200  # pixels
         self.figsize = (width / self.dpi, height / self.dpi)
 
+        # Charts whose data and parameters have not changed since the last run are not drawn again
+        self.render_cache = RenderCache(self.graph_dir)
+        self.force_render = os.getenv("RENDER_FORCE", "") == "1"
+
         # Used to initialize the data
         self.read_file()
 
     def read_file(self) -> None:
-        """ read_file method reads the Data.csv file and stores the data in dictionaries.
+        """ read_file method reads the score store (Muncipalities.npy) into a ScoreFrame (self.scores) indexed by municipality.
             Serves as a helper function to create_graphs method"""
 
-        with open(os.path.join(self.data_dir, "Muncipalities.csv"), "r") as file:
-            for line in file:
-                data = ast.literal_eval(line)
-                name = data["name"]
-                score = data["score"]
-                self.name_to_score_map[name] = score
-
-                category_scores = data.get('categoryScores', {})
-                self.emailsecurity = category_scores.get("emailSecurity", 0)
-                self.name_to_emailsecurity_map[name] = self.emailsecurity
-
-                self.websecurity = category_scores.get("websiteSecurity", 0)
-                self.name_to_websecurity_map[name] = self.websecurity
-
-                self.networksecurity = category_scores.get(
-                    "networkSecurity", 0)
-                self.name_to_networksecurity_map[name] = self.networksecurity
-
-    def create_graphs(self, score_map: dict, xaxis_label: str, yaxis_label: str, file_name: str, graph_title: str) -> None:
-        """ create_graphs method creates a graph of the data in the Data.csv file"""
-
-        ScoreSeries = pd.Series(self.sort_dictionaries(score_map))
-
-        plt.figure(figsize=self.figsize, dpi=self.dpi)
-
-        sns.barplot(x=ScoreSeries.index, y=ScoreSeries.values,
-                    edgecolor='black', ci=None, saturation=30)
-        plt.title(graph_title, fontsize=23, fontweight='bold')
-        plt.ylim(0, 950, fontsize=20)
-        plt.xticks(rotation=90)
-        plt.xticks([], [])
-        plt.ylabel(yaxis_label, fontsize=21)
-        plt.tight_layout()
-
-        plt.savefig(self.graph_dir + file_name)
+        self.scores = ScoreFrame.from_store(self.score_store)
+
+    @property
+    def analytics(self) -> ScoreAnalytics:
+        """ Aggregation queries over Municipality_Scores (pure Python on the in-memory backend) """
+        return ScoreAnalytics(self.collection_scores, pipelines=self.connection.backend != "memory")
+
+    def chart_spec(self, chart_type: str, data, xaxis_label: str, yaxis_label: str, file_name: str, graph_title: str, **options) -> dict:
+        """ chart_spec builds a chart spec (see ChartRenderer.py) using this generator's graph folder and figure settings """
+        spec = {"type": chart_type, "data": data, "xaxis_label": xaxis_label, "yaxis_label": yaxis_label,
+                "file_name": file_name, "graph_title": graph_title,
+                "graph_dir": self.graph_dir, "figsize": self.figsize, "dpi": self.dpi}
+        spec.update(options)
+        return spec
+
+    def render(self, spec: dict) -> bool:
+        """ render draws a single chart spec unless the render cache says the existing file is up to date.
+            Returns True if the chart was drawn """
+        if not self.force_render and self.render_cache.is_fresh(spec):
+            print(f"{spec['file_name']} is unchanged, skipping")
+            return False
+        # matplotlib and seaborn are only imported once a chart is drawn
+        from ChartRenderer import render_chart
+        with self.metrics.timed("chart_render_seconds", chart=spec["file_name"]):
+            render_chart(spec)
+        self.render_cache.record(spec)
+        self.render_cache.save()
+        return True
+
+    def render_batch(self, specs: list, max_workers: int = None) -> list:
+        """ render_batch renders a list of chart specs in parallel, one process per core by default.
+            Charts that are unchanged since the last run are skipped, a chart that fails is reported and does not stop the others.
+            Returns the file names of the charts that failed """
+        from ChartRenderer import render_batch
+        stale = [spec for spec in specs if self.force_render or not self.render_cache.is_fresh(spec)]
+        if len(stale) < len(specs):
+            print(f"{len(specs) - len(stale)} charts are unchanged, skipping")
+
+        failures = []
+        for spec, (file_name, error, seconds) in zip(stale, render_batch(stale, max_workers=max_workers) if stale else []):
+            if error is None:
+                self.metrics.observe("chart_render_seconds", seconds, chart=file_name)
+                self.render_cache.record(spec)
+                print(f"Saved {file_name} to the graphs folder")
+            else:
+                print(f"Error with rendering {file_name}: {error}")
+                failures.append(file_name)
+        self.render_cache.save()
+        self.print_message(f"Batch of {len(specs)}")
+        return failures
+
+    def bar_spec(self, column: str, xaxis_label: str, yaxis_label: str, file_name: str, graph_title: str) -> dict:
+        """ bar_spec builds the chart spec of a bar graph of one score column, sorted from lowest to highest """
+        return self.chart_spec("bar", self.scores.sorted(column).to_dict(),
+                               xaxis_label, yaxis_label, file_name, graph_title)
+
+    def map_spec(self, column: str, file_name: str, graph_title: str) -> dict:
+        """ map_spec builds the chart spec of a scatter map of one score column, one point per municipality with coordinates """
+        points = self.scores.frame[["longitude", "latitude", column]].dropna()
+        data = dict(zip(points.index, points.values.tolist()))
+        return self.chart_spec("scatter_map", data, "Longitude", COLUMN_LABELS.get(column, column),
+                               file_name, graph_title, labels=len(data) <= 100)
+
+    def create_score_map(self, column: str, file_name: str, graph_title: str) -> None:
+        """ create_score_map method draws every municipality at its location, colored by one score column
+            (the OverallSecurity scatter map for "score"). Municipalities without coordinates are left out """
+
+        self.render(self.map_spec(column, file_name, graph_title))
+
+        self.print_message("Score Map")
+
+    def create_graphs(self, column: str, xaxis_label: str, yaxis_label: str, file_name: str, graph_title: str) -> None:
+        """ create_graphs method creates a bar graph of one score column (e.g. "score", "emailSecurity") from the score store"""
+
+        self.render(self.bar_spec(column, xaxis_label,
+                    yaxis_label, file_name, graph_title))
 
         self.print_message("Bar Graph")
 
-    def create_stacked_bar_graph(self, score_map: dict, email_security_map: dict, web_security_map: dict, network_security_map: dict, xaxis_label: str, yaxis_label: str, file_name: str, graph_title: str) -> None:
-        """ create_stacked_bar_graph method creates a stacked bar graph of the data from all categories of vulnerabilities """
+    def create_stacked_bar_graph(self, xaxis_label: str, yaxis_label: str, file_name: str, graph_title: str,
+                                 columns: list = ["emailSecurity", "websiteSecurity", "networkSecurity"]) -> None:
+        """ create_stacked_bar_graph method creates a stacked bar graph of the data from all categories of vulnerabilities,
+            municipalities are ordered by their overall score """
 
-        score_map = self.sort_dictionaries(score_map)
-        email_security_map = self.sort_dictionaries(email_security_map)
-        web_security_map = self.sort_dictionaries(web_security_map)
-        network_security_map = self.sort_dictionaries(network_security_map)
+        order = self.scores.sorted("score").index
+        frame = self.scores.frame.loc[order, columns]
+        data = {COLUMN_LABELS[column]: frame[column].to_dict()
+                for column in columns}
 
-        data = pd.DataFrame({'Email Security': list(email_security_map.values()),
-                            'Web Security': list(web_security_map.values()), 'Network Security': list(network_security_map.values())},
-                            index=list(score_map.keys()))
-
-        fig, ax = plt.subplots(figsize=self.figsize, dpi=self.dpi)
-        data.plot(kind='bar', stacked=True, ax=ax)
-
-        plt.xlabel(xaxis_label)
-        plt.xticks(rotation=90)
-        plt.title(graph_title)
-        plt.legend()
-        plt.tight_layout()
-
-        plt.savefig(self.graph_dir + file_name, dpi=self.dpi)
+        self.render(self.chart_spec("stacked_bar", data, xaxis_label,
+                                    yaxis_label, file_name, graph_title))
 
         self.print_message("Stacked Bar Graph")
 
@@ -128,69 +156,46 @@ class GraphGenerator(FetchData):
         """ **Helper Function to create_graphs function**
             sort_dictionaries method sorts a dictionary by its values and returns a sorted dictionary"""
 
-        sorted_dict = {}
-        sorted_dict_values = sorted(dict_name.values())
-        for num, names in zip(sorted_dict_values, dict_name.keys()):
-            sorted_dict[names] = num
-        return sorted_dict
-
-    def create_histogram(self, score_map: dict, xaxis_label: str, yaxis_label: str, file_name: str, graph_title: str) -> None:
-        """Create a histogram of the data in score_map."""
-
-        ScoreSeries = pd.Series(score_map.values())
+        return dict(sorted(dict_name.items(), key=lambda item: item[1]))
 
-        plt.figure(figsize=self.figsize, dpi=self.dpi)
-        sns.histplot(ScoreSeries, bins=30, edgecolor='black',
-                     color='blue', kde=True, line_kws={'color': 'lightblue'})
-        plt.title(graph_title)
-        plt.xlabel(xaxis_label)
-        plt.tight_layout()
+    def create_histogram(self, column: str, xaxis_label: str, yaxis_label: str, file_name: str, graph_title: str) -> None:
+        """Create a histogram of one score column."""
 
-        plt.savefig(self.graph_dir + file_name)
+        self.render(self.chart_spec("histogram", self.scores.column(column).to_dict(), xaxis_label,
+                                    yaxis_label, file_name, graph_title))
 
-        city_to_score_map = {}
-        cursor = self.collection_scores.find({})
-        for document in cursor:
-            city_to_score_map[document['name']] = document['data']['score']
+        # Statistics are computed by MongoDB, only the top 15 and three numbers come back.
+        # The histogram itself comes from the score store, so it is kept when MongoDB cannot be reached
+        try:
+            summary = self.analytics.summary("score")
+            summary["top"] = self.analytics.top_scores(15, "score")
+        except Exception as e:
+            print(f"Error with querying MongoDB: {e}")
+            summary = None
 
-        self.print_message("Histogram", city_to_score_map)
+        self.print_message("Histogram", summary)
 
-    def create_challenge_frequency_graph(self, challenge_table: list, xaxis_label: str, yaxis_label: str, file_name: str, graph_title: str) -> None:
-        """create_challenge_frequency_graph method creates a graph which measures the frequency of each challenge."""
+    def create_challenge_frequency_graph(self, challenges, xaxis_label: str, yaxis_label: str, file_name: str, graph_title: str) -> None:
+        """create_challenge_frequency_graph method creates a graph which measures the frequency of each challenge.
+           challenges is a ChallengeCounter (e.g. ChallengeCounter.from_collection(self.collection_vulnerabilities))
+           or the old challenge table format, a list of {city: [challenge, ...]}"""
 
-        challenge_frequency = {}
-        for dict_ in challenge_table:
-            for city_, vulnerabilities in dict_.items():
-                for challenge in vulnerabilities:
-                    challenge_frequency[challenge] = challenge_frequency.get(
-                        challenge, 0) + 1
+        if not isinstance(challenges, ChallengeCounter):
+            challenges = ChallengeCounter.from_challenge_table(challenges)
 
-        sorted_vulnerabilities = self.sort_dictionaries(challenge_frequency)
+        # No vulnerabilities stored (e.g. an offline run), keep the existing graph and top_issues.txt
+        if len(challenges) == 0:
+            print(f"No vulnerabilities in {self.collection_vulnerabilities.name} yet, skipping {file_name}")
+            return
 
-        top_vulnerabilities_15 = list(reversed(list(sorted_vulnerabilities.items())))[
-            :15]    # Getting the top 15 vulnerabilities to save to a csv file
+        top_vulnerabilities_15 = challenges.top(
+            15)    # Getting the top 15 vulnerabilities to save to a csv file
 
-        top_vulnerabilities = list(reversed(list(sorted_vulnerabilities.items())))[
+        top_vulnerabilities = top_vulnerabilities_15[
             :5]    # Getting top 5 vulnerabilities for csv file
 
-        vulnerabilities = [item[0] for item in top_vulnerabilities]
-        frequencies = [item[1] for item in top_vulnerabilities]
-
-        plt.figure(figsize=(25, 20))
-        sns.set(font_scale=.6)
-        vulnerabilities = [textwrap.fill(item[0], 40)
-                           for item in top_vulnerabilities]
-
-        # Plotting the bar chart
-        sns.barplot(x=frequencies, y=vulnerabilities,
-                    edgecolor='black', palette='Blues_d')
-
-        plt.xlabel(xaxis_label)
-        plt.title(graph_title)
-        plt.legend()
-        plt.tight_layout()
-
-        plt.savefig(self.graph_dir + file_name, dpi=300)
+        self.render(self.chart_spec("challenge_frequency", top_vulnerabilities, xaxis_label, yaxis_label,
+                                    file_name, graph_title, figsize=(25, 20), dpi=300, font_scale=.6))
 
         # Saving the top 15 vulnerabilities to a csv file
         with open(self.graph_dir + "top_issues.txt", "w") as file:
@@ -199,34 +204,91 @@ class GraphGenerator(FetchData):
 
         self.print_message("Challenge Frequency Graph")
 
-    def print_message(self, graph, city_to_score_map=None) -> None:
+    def create_risk_timeseries_graph(self, xaxis_label: str, yaxis_label: str, file_name: str, graph_title: str,
+                                     granularity: str = "month", by: str = "severity", start=None, end=None, names: list = None) -> None:
+        """create_risk_timeseries_graph method plots how many risks were first detected per day, week or month,
+           one line per severity, category or municipality (by). Counts are read from the risk rollups, not the raw risks"""
+
+        series = {}
+        for row in self.risk_rollups.timeline(granularity, start, end, by=by, names=names):
+            label = str(row.get(by, "All risks"))
+            series.setdefault(label, {})[row["period"].date().isoformat()] = row["count"]
+
+        # A new database, or one the risks stage has not run against yet, has no rollups (pandas cannot plot nothing)
+        if not series:
+            print(f"No risks in {self.collection_risk_rollups.name} yet, skipping {file_name}")
+            return
+
+        self.render(self.chart_spec("timeseries", series, xaxis_label, yaxis_label,
+                                    file_name, graph_title))
+
+        self.print_message("Risk Time Series")
+
+    def __isolated(self, file_name: str, draw) -> list:
+        """ Calls draw(), reporting an exception instead of raising it so the remaining graphs are still drawn.
+            Returns the failed file names (draw's own list, or [file_name] if it raised)
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        try:
+            return draw() or []
+        except Exception as e:
+            print(f"Error with drawing {file_name}: {e!r}")
+            return [file_name]
+
+    def create_all_graphs(self) -> list:
+        """ create_all_graphs draws every graph: the score bar graphs and the score map (in parallel), the stacked bar graph,
+            the histogram, the challenge frequency graph and the risk time series.
+            A graph that fails (e.g. the MongoDB backed ones without a cluster) is reported and does not stop the others.
+            Returns the file names of the graphs that failed """
+        failures = self.__isolated("score graphs", lambda: self.render_batch([
+            self.bar_spec("score", "Municipalities", "General Scores",
+                          "general_map.png", "Scores across all municipalities"),
+            self.bar_spec("emailSecurity", "Municipalities", "Email Security Scores",
+                          "email_security_map.png", "Email Security Scores across all municipalities"),
+            self.bar_spec("websiteSecurity", "Municipalities", "Web Security Scores",
+                          "web_security_map.png", "Web Security Scores across all municipalities"),
+            self.bar_spec("networkSecurity", "Municipalities", "Network Security Scores",
+                          "network_security_map.png", "Network Security Scores across all municipalities"),
+            self.map_spec("score", "overall_security_map.png",
+                          "Overall security score by location"),
+        ]))
+        failures += self.__isolated("stacked_bar_graph.png", lambda: self.create_stacked_bar_graph(
+            "Municipalities", "Scores", "stacked_bar_graph.png", "Category scores across all municipalities"))
+        failures += self.__isolated("histogram.png", lambda: self.create_histogram(
+            "score", "Score", "Municipalities", "histogram.png", "Distribution of scores across all municipalities"))
+        failures += self.__isolated("challenge_frequency_graph.png", lambda: self.create_challenge_frequency_graph(
+            ChallengeCounter.from_collection(self.collection_vulnerabilities),
+            "Frequency", "Vulnerability", "challenge_frequency_graph.png",
+            "Most common vulnerabilities across all municipalities"))
+        failures += self.__isolated("risks_timeseries.png", lambda: self.create_risk_timeseries_graph(
+            "Month", "Risks", "risks_timeseries.png", "Risks detected per month by severity"))
+        if failures:
+            print(f"{len(failures)} graphs failed: {', '.join(failures)}")
+        return failures
+
+    def print_message(self, graph, summary=None) -> None:
         """ print_message method prints a message to the console after a graph is created
-                Serves as a helper function to create_graphs methods """
+                Serves as a helper function to create_graphs methods
+                summary is a ScoreAnalytics.summary dictionary with an extra "top" list of (name, score) pairs """
 
         print("--------------------------------------------------------------------")
         print(
             f"{graph} graph has been succesfully created and saved to the graphs folder")
         print(" As of date of: ", self.date)
         print("--------------------------------------------------------------------")
-        if (graph == "Histogram"):
+        # An empty Municipality_Scores collection gives a summary of None values
+        if (graph == "Histogram" and summary is not None and summary.get("mean") is not None):
             print("--------------------------------------------------------------------")
             print("Top 15 Municipalities with the highest scores:")
             print("Name, Score")
-            for name, score in self.sort_dictionaries(city_to_score_map).items():
+            for name, score in summary["top"]:
                 print(f"{name}, {score}")
 
-            print("Mean: ", np.mean(list(city_to_score_map.values())), "Median: ", np.median(list(
-                city_to_score_map.values())), "Standard Deviation: ", np.std(list(city_to_score_map.values())))
+            print("Mean: ", summary["mean"], "Median: ", summary["median"],
+                  "Standard Deviation: ", summary["std"])
             print("--------------------------------------------------------------------")
 
 
 if __name__ == "__main__":
     Work = GraphGenerator()
-    Work.create_graphs(Work.name_to_score_map, "Municipalities", "General Scores",
-                       "general_map.png", "Scores across all municipalities")
-    Work.create_graphs(Work.name_to_emailsecurity_map, "Municipalities", "Email Security Scores",
-                       "email_security_map.png", "Email Security Scores across all municipalities")
-    Work.create_graphs(Work.name_to_websecurity_map, "Municipalities", "Web Security Scores",
-                       "web_security_map.png", "Web Security Scores across all municipalities")
-    Work.create_graphs(Work.name_to_networksecurity_map, "Municipalities", "Network Security Scores",
-                       "network_security_map.png", "Network Security Scores across all municipalities")
+    Work.create_all_graphs()
+    Work.metrics.save()
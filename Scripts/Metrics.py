@@ -0,0 +1,246 @@
+import argparse
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import threading
+import time
+
+#####################################################################################
+# Metrics.py
+# Author: Adi Bhan
+# This script records timings and counters (stage and municipality wall time, HTTP latency and bytes, MongoDB commands,
+# chart and PDF render times) and writes them as JSON log lines, a JSON summary and a Prometheus textfile
+###############################################################################################################
+
+# Upper bounds (seconds) of the histogram buckets, from a fast MongoDB command up to a whole stage
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# Every metric the project records: name -> (Prometheus type, help text). Names are prefixed with "mapc_" in the textfile
+DESCRIPTIONS = {
+    "stage_seconds": ("histogram", "Wall time of a pipeline stage"),
+    "municipality_fetch_seconds": ("histogram", "Wall time of the requests of one municipality, retries included"),
+    "http_request_seconds": ("histogram", "Latency of one HTTP request to the UpGuard API"),
+    "http_bytes_total": ("counter", "Response bytes downloaded from the UpGuard API"),
+    "http_retries_total": ("counter", "UpGuard API requests that were retried"),
+    "http_cache_hits_total": ("counter", "UpGuard API requests answered by the response cache without a download"),
+    "mongo_command_seconds": ("histogram", "Latency of one MongoDB command"),
+    "mongo_command_failures_total": ("counter", "MongoDB commands that failed"),
+    "chart_render_seconds": ("histogram", "Time to render one chart"),
+    "report_render_seconds": ("histogram", "Time to render one remediation PDF"),
+    "work_queue_batch_seconds": ("histogram", "Time a worker took to run one batch of queued jobs"),
+    "work_queue_jobs_total": ("counter", "Queued jobs a worker finished, by collector and status"),
+}
+
+
+def timed_call(function, *args):
+    """ timed_call runs function(*args) and returns (result, seconds). It is a module level function so it can be
+        submitted to a process pool: the render time is measured in the worker and sent back with the result """
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+class Metrics:
+    """ Metrics keeps counters and histograms keyed by metric name and labels, safe to use from many threads.
+        Every observation is also appended to a JSON lines log (log_path) as it happens, so single slow municipalities,
+        endpoints or charts can be found afterwards. save writes the totals as JSON and as a Prometheus textfile.
+        profile_stages is a set of stage names (or "all") to run under cProfile, see profile """
+
+    shared_metrics = None
+    shared_lock = threading.Lock()
+
+    def __init__(self, directory: str = None, enabled: bool = True, log_path: str = None, profile_stages=None):
+        self.directory = directory or os.path.join(os.getcwd(), "data")
+        self.enabled = enabled
+        self.log_path = log_path
+        self.profile_stages = profile_stages or set()
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.__log = None
+
+    @classmethod
+    def shared(cls):
+        """ shared returns the process-wide metrics, configured from the environment:
+            METRICS=off disables recording, METRICS_DIR (default data/) is where metrics.json, metrics.prom,
+            metrics.jsonl and profiles/ are written, METRICS_PROFILE is a comma separated list of stages to profile (or "all") """
+        with cls.shared_lock:
+            if cls.shared_metrics is None:
+                directory = os.getenv("METRICS_DIR") or os.path.join(os.getcwd(), "data")
+                profile = {stage.strip() for stage in os.getenv(
+                    "METRICS_PROFILE", "").split(",") if stage.strip()}
+                cls.shared_metrics = cls(directory, enabled=os.getenv("METRICS", "").lower() != "off",
+                                         log_path=os.path.join(directory, "metrics.jsonl"), profile_stages=profile)
+            return cls.shared_metrics
+
+    @staticmethod
+    def __key(labels: dict) -> tuple:
+        """ Returns a hashable, ordered form of a label set
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+    def __write_log(self, metric: str, value: float, labels: dict) -> None:
+        """ Appends one observation to the JSON lines log. Called with the lock held
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        if self.log_path is None:
+            return
+        if self.__log is None:
+            os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+            self.__log = open(self.log_path, "a")
+        self.__log.write(json.dumps({"time": datetime.datetime.now().isoformat(timespec="milliseconds"),
+                                     "metric": metric, "value": round(value, 6), "labels": labels}) + "\n")
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """ inc adds value to a counter, e.g. metrics.inc("http_bytes_total", 512, endpoint="vendor") """
+        if not self.enabled:
+            return
+        key = self.__key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        """ observe records one duration in a histogram and in the JSON log """
+        if not self.enabled:
+            return
+        key = self.__key(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = {"buckets": [0] * len(BUCKETS), "count": 0,
+                                           "sum": 0.0, "min": seconds, "max": seconds}
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][index] += 1
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            histogram["min"] = min(histogram["min"], seconds)
+            histogram["max"] = max(histogram["max"], seconds)
+            self.__write_log(name, seconds, labels)
+
+    @contextlib.contextmanager
+    def timed(self, name: str, **labels):
+        """ timed records how long the with block took, e.g. with metrics.timed("stage_seconds", stage="graphs"): ...
+            The time is recorded even if the block raises """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextlib.contextmanager
+    def profile(self, stage: str):
+        """ profile runs the with block under cProfile when the stage is in profile_stages (or it is "all"),
+            writing <directory>/profiles/<stage>.prof (open it with python -m pstats). Only the calling thread is profiled,
+            so for the fetch stages the time spent waiting on the worker threads shows up as one call """
+        if not self.enabled or not ({stage, "all"} & set(self.profile_stages)):
+            yield
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Only one profiler can be active at a time on newer Pythons, e.g. when two profiled stages overlap
+            print(f"Not profiling {stage}: {e}")
+            yield
+            return
+        try:
+            yield
+        finally:
+            profiler.disable()
+            directory = os.path.join(self.directory, "profiles")
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"{stage}.prof")
+            profiler.dump_stats(path)
+            print(f"Profile of {stage} saved to {path}")
+
+    def snapshot(self) -> dict:
+        """ snapshot returns every counter and histogram as {"counters": {name: [...]}, "histograms": {name: [...]}},
+            each series a dictionary of its labels and values """
+        with self.lock:
+            counters = {name: [{"labels": dict(key), "value": value} for key, value in series.items()]
+                        for name, series in self.counters.items()}
+            histograms = {name: [dict(histogram, labels=dict(key), buckets=dict(zip(BUCKETS, histogram["buckets"])))
+                                 for key, histogram in series.items()]
+                          for name, series in self.histograms.items()}
+        return {"counters": counters, "histograms": histograms}
+
+    def prometheus(self) -> str:
+        """ prometheus returns every metric in the Prometheus text exposition format """
+        def labels_text(labels, extra=None):
+            pairs = list(labels.items()) + (extra or [])
+            if not pairs:
+                return ""
+            escaped = [(name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+                       for name, value in pairs]
+            return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+        snapshot = self.snapshot()
+        lines = []
+        for kind, metrics in (("counter", snapshot["counters"]), ("histogram", snapshot["histograms"])):
+            for name in sorted(metrics):
+                metric = "mapc_" + name
+                lines.append(f"# HELP {metric} {DESCRIPTIONS.get(name, (kind, name))[1]}")
+                lines.append(f"# TYPE {metric} {kind}")
+                for series in metrics[name]:
+                    labels = series["labels"]
+                    if kind == "counter":
+                        lines.append(f"{metric}{labels_text(labels)} {series['value']}")
+                        continue
+                    for bound, count in series["buckets"].items():
+                        lines.append(f"{metric}_bucket{labels_text(labels, [('le', bound)])} {count}")
+                    lines.append(f"{metric}_bucket{labels_text(labels, [('le', '+Inf')])} {series['count']}")
+                    lines.append(f"{metric}_sum{labels_text(labels)} {series['sum']}")
+                    lines.append(f"{metric}_count{labels_text(labels)} {series['count']}")
+        return "\n".join(lines) + "\n"
+
+    def save(self) -> None:
+        """ save writes metrics.json and metrics.prom to the metrics directory (the textfile is replaced atomically,
+            so a node_exporter textfile collector never reads half a file) and flushes the JSON log """
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        for file_name, text in (("metrics.json", json.dumps(self.snapshot(), indent=2, default=str)),
+                                ("metrics.prom", self.prometheus())):
+            path = os.path.join(self.directory, file_name)
+            with open(path + ".tmp", "w") as file:
+                file.write(text)
+            os.replace(path + ".tmp", path)
+        with self.lock:
+            if self.__log is not None:
+                self.__log.flush()
+        print(f"Metrics saved to {os.path.join(self.directory, 'metrics.prom')}")
+
+    def print_summary(self, limit: int = 10) -> None:
+        """ print_summary prints the slowest series of every histogram by total time """
+        for name, series in sorted(self.snapshot()["histograms"].items()):
+            print("--------------------------------------------------------------------")
+            print(f"{name}: {DESCRIPTIONS.get(name, ('', ''))[1]}")
+            for histogram in sorted(series, key=lambda item: item["sum"], reverse=True)[:limit]:
+                labels = ", ".join(f"{key}={value}" for key, value in histogram["labels"].items())
+                print(f"  {labels or 'all':50} total {histogram['sum']:9.3f}s  count {histogram['count']:6}  "
+                      f"mean {histogram['sum'] / histogram['count']:8.4f}s  max {histogram['max']:8.4f}s")
+        print("--------------------------------------------------------------------")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Print the slowest stages, municipalities, endpoints and charts of the last run")
+    parser.add_argument("--log", default=os.path.join(
+        os.getenv("METRICS_DIR") or os.path.join(os.getcwd(), "data"), "metrics.jsonl"),
+        help="JSON lines log written by the pipeline")
+    parser.add_argument("--limit", type=int, default=10,
+                        help="Series to print per metric")
+    args = parser.parse_args()
+
+    # Replaying the log rebuilds the histograms of every run that appended to it
+    summary = Metrics(enabled=True)
+    with open(args.log, "r") as file:
+        for line in file:
+            record = json.loads(line)
+            summary.observe(record["metric"], record["value"], **record["labels"])
+    summary.print_summary(args.limit)
@@ -0,0 +1,82 @@
+import os
+import threading
+
+#####################################################################################
+# MongoConnection.py
+# Author: Adi Bhan
+# This script creates the MongoDB client lazily, so classes that never touch the database never pay for a connection
+###############################################################################################################
+
+
+class MongoConnection:
+    """ MongoConnection holds the settings for a MongoDB client and creates it on first use.
+        One instance can be shared by FetchData, GraphGenerator and Remediation in the same process.
+        backend "mongodb" connects to MONGO_URI, backend "memory" uses an in-memory mongomock client for offline runs """
+
+    shared_connection = None
+    shared_lock = threading.Lock()
+
+    def __init__(self, uri: str = None, database: str = "Cluster0", backend: str = None,
+                 max_pool_size: int = None, timeout_ms: int = None):
+        self.uri = uri if uri is not None else os.getenv("MONGO_URI")
+        self.database = database
+        self.backend = (backend or os.getenv("MONGO_BACKEND", "mongodb")).lower()
+        self.max_pool_size = max_pool_size if max_pool_size is not None else int(
+            os.getenv("MONGO_MAX_POOL_SIZE", 100))
+        self.timeout_ms = timeout_ms if timeout_ms is not None else int(
+            os.getenv("MONGO_TIMEOUT_MS", 10000))
+        self.__client = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """ shared returns the process-wide connection, created with the settings from the environment """
+        with cls.shared_lock:
+            if cls.shared_connection is None:
+                cls.shared_connection = cls()
+            return cls.shared_connection
+
+    @property
+    def client(self):
+        """ client returns the MongoDB client, connecting on first access """
+        with self.lock:
+            if self.__client is None:
+                if self.backend == "memory":
+                    import mongomock
+                    self.__client = mongomock.MongoClient()
+                else:
+                    import pymongo as pm
+                    from Metrics import Metrics
+                    from MongoMetrics import MongoCommandMetrics
+                    # Every command's latency is recorded by command and collection, see Metrics.py
+                    self.__client = pm.MongoClient(self.uri, maxPoolSize=self.max_pool_size,
+                                                   serverSelectionTimeoutMS=self.timeout_ms,
+                                                   connectTimeoutMS=self.timeout_ms,
+                                                   event_listeners=[MongoCommandMetrics(Metrics.shared())])
+            return self.__client
+
+    @property
+    def db(self):
+        """ db returns the project database """
+        return self.client[self.database]
+
+    def collection(self, name: str):
+        """ collection returns a collection of the project database """
+        return self.db[name]
+
+    def check(self) -> bool:
+        """ check pings the server and prints whether the connection works """
+        try:
+            self.client.server_info()
+            print("Connected to MongoDB successfully")
+            return True
+        except Exception as e:
+            print(f"Failed to connect to MongoDB: {e}")
+            return False
+
+    def close(self) -> None:
+        """ close closes the client, a later access connects again """
+        with self.lock:
+            if self.__client is not None:
+                self.__client.close()
+                self.__client = None
@@ -0,0 +1,43 @@
+import threading
+from pymongo import monitoring
+from Metrics import Metrics
+
+#####################################################################################
+# MongoMetrics.py
+# Author: Adi Bhan
+# This script records the latency of every MongoDB command in Metrics. It is kept out of Metrics.py
+# so render workers and the cache commands that use Metrics do not import pymongo
+###############################################################################################################
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """ MongoCommandMetrics is a pymongo command listener that records the latency
+        of every MongoDB command by command and collection. The in-memory backend sends no events, so it is not measured """
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+        self.collections = {}
+        self.lock = threading.Lock()
+
+    def started(self, event) -> None:
+        collection = event.command.get(event.command_name)
+        with self.lock:
+            self.collections[(event.connection_id, event.request_id)] = collection if isinstance(
+                collection, str) else ""
+
+    def __collection(self, event) -> str:
+        """ Returns the collection the command of an event was sent to
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        with self.lock:
+            return self.collections.pop((event.connection_id, event.request_id), "")
+
+    def succeeded(self, event) -> None:
+        self.metrics.observe("mongo_command_seconds", event.duration_micros / 1e6,
+                             command=event.command_name, collection=self.__collection(event))
+
+    def failed(self, event) -> None:
+        collection = self.__collection(event)
+        self.metrics.observe("mongo_command_seconds", event.duration_micros / 1e6,
+                             command=event.command_name, collection=collection)
+        self.metrics.inc("mongo_command_failures_total",
+                         command=event.command_name, collection=collection)
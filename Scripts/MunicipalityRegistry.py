@@ -0,0 +1,62 @@
+import argparse
+import csv
+import os
+from collections import namedtuple
+
+#####################################################################################
+# MunicipalityRegistry.py
+# Author: Adi Bhan
+# This script reads the list of municipalities to collect (name, UpGuard hostname and state) from data/municipalities.csv,
+# so towns and other states are added by editing the data file instead of the code
+###############################################################################################################
+
+Municipality = namedtuple("Municipality", ["name", "hostname", "state"])
+
+# The registry lives next to the code, not in the working directory, so every entry point reads the same file
+DEFAULT_REGISTRY = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "data", "municipalities.csv")
+
+DEFAULT_STATE = "Massachusetts"
+
+
+def load_registry(path: str = None) -> list:
+    """ load_registry reads a CSV file with name, hostname and (optional) state columns and returns a list of Municipality.
+        path defaults to MUNICIPALITY_REGISTRY or data/municipalities.csv. Raises ValueError on a duplicate name """
+    path = path or os.getenv("MUNICIPALITY_REGISTRY") or DEFAULT_REGISTRY
+    municipalities, seen = [], set()
+    with open(path, "r", newline="") as file:
+        for row in csv.DictReader(file):
+            name = row["name"].strip()
+            if not name:
+                continue
+            if name in seen:
+                raise ValueError(f"{name} is listed twice in {path}")
+            seen.add(name)
+            municipalities.append(Municipality(name, row["hostname"].strip(),
+                                               (row.get("state") or DEFAULT_STATE).strip()))
+    return municipalities
+
+
+def hostnames(municipalities: list) -> dict:
+    """ hostnames returns {name: hostname}, the format FetchData.muncipalities uses """
+    return {municipality.name: municipality.hostname for municipality in municipalities}
+
+
+def states(municipalities: list) -> dict:
+    """ states returns {name: state}, used to build geocoder queries """
+    return {municipality.name: municipality.state for municipality in municipalities}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="List the municipalities in the registry")
+    parser.add_argument("--path", help="Registry file (default MUNICIPALITY_REGISTRY or data/municipalities.csv)")
+    parser.add_argument("--state", help="Only list the municipalities of one state")
+    args = parser.parse_args()
+
+    registry = [municipality for municipality in load_registry(args.path)
+                if args.state is None or municipality.state == args.state]
+    for municipality in registry:
+        print(f"{municipality.name:24} {municipality.hostname:36} {municipality.state}")
+    print(f"{len(registry)} municipalities")
@@ -0,0 +1,260 @@
+import argparse
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from MongoConnection import MongoConnection
+from FetchData import FetchData
+from ChallengeCounter import ChallengeCounter
+from RiskRollups import RiskRollups
+from Metrics import Metrics
+
+#####################################################################################
+# Pipeline.py
+# Author: Adi Bhan
+# This script runs the whole workflow (fetch, store, analyze, graphs, reports) as stages of a DAG.
+# Independent stages run in parallel and every finished stage is checkpointed, so a failed run can be resumed
+###############################################################################################################
+
+# Remediation (ReportLab), GraphGenerator (matplotlib, pandas) and ScoreAnalytics are imported by the stages that use them,
+# so --list and the fetch stages start without loading them
+
+# A stage runs once all stages in requires have finished. run is the name of the Pipeline method that does the work
+Stage = namedtuple("Stage", ["name", "requires", "run", "description"])
+
+STAGES = [
+    Stage("scores", (), "stage_scores",
+          "Fetch vendor scores, store them in MongoDB and the score store"),
+    Stage("vulnerabilities", (), "stage_vulnerabilities",
+          "Fetch vulnerabilities and store them in MongoDB"),
+    Stage("risks", (), "stage_risks",
+          "Incrementally ingest risks and update the risk rollups"),
+    Stage("remediation", (), "stage_remediation",
+          "Fetch remediation data for every municipality and store the changed hosts"),
+    Stage("analyze", ("scores", "vulnerabilities", "risks"), "stage_analyze",
+          "Compute score statistics, top challenges and the risk timeline (data/analysis.json)"),
+    Stage("graphs", ("scores", "vulnerabilities", "risks"), "stage_graphs",
+          "Draw every graph"),
+    Stage("reports", ("remediation",), "stage_reports",
+          "Render the remediation PDFs that changed"),
+]
+
+
+class Pipeline:
+    """ Pipeline schedules the stages in STAGES on a thread pool. A stage starts as soon as its requirements are met,
+        so the network bound fetch stages overlap. Finished stages are written to a checkpoint file; a resumed run skips them """
+
+    def __init__(self, checkpoint_path: str = None, connection: MongoConnection = None, max_workers: int = 4):
+        self.data_dir = os.path.join(os.getcwd(), "data")
+        self.checkpoint_path = checkpoint_path or os.path.join(
+            self.data_dir, "pipeline_checkpoint.json")
+        self.connection = connection if connection is not None else MongoConnection.shared()
+        self.max_workers = max(1, max_workers)
+        self.stages = {stage.name: stage for stage in STAGES}
+        self.checkpoint = {"stages": {}}
+        self.lock = threading.Lock()
+        self.metrics = Metrics.shared()
+        self.__fetcher = None
+
+    @property
+    def fetcher(self):
+        """ The FetchData instance shared by the fetch stages, so they share one session and rate limit """
+        with self.lock:
+            if self.__fetcher is None:
+                self.__fetcher = FetchData(self.connection)
+            return self.__fetcher
+
+    def load_checkpoint(self) -> dict:
+        """ load_checkpoint reads the stages finished by the previous run """
+        if os.path.exists(self.checkpoint_path):
+            try:
+                with open(self.checkpoint_path, "r") as file:
+                    return json.load(file)
+            except ValueError:
+                print(f"Ignoring unreadable checkpoint {self.checkpoint_path}")
+        return {"stages": {}}
+
+    def save_checkpoint(self) -> None:
+        """ save_checkpoint writes the finished stages to disk """
+        os.makedirs(os.path.dirname(self.checkpoint_path), exist_ok=True)
+        temp_path = self.checkpoint_path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump(self.checkpoint, file, indent=2, sort_keys=True)
+        os.replace(temp_path, self.checkpoint_path)
+
+    def __complete(self, name: str, seconds: float) -> None:
+        """ Records a finished stage in the checkpoint
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        with self.lock:
+            self.checkpoint["stages"][name] = {
+                "completed": datetime.datetime.now().isoformat(timespec="seconds"),
+                "seconds": round(seconds, 3)}
+            # Fetch stages also record which municipalities' data changed
+            if self.__fetcher is not None and name in self.__fetcher.changed:
+                self.checkpoint["stages"][name]["changed"] = self.__fetcher.changed[name]
+            self.save_checkpoint()
+
+    def __run_stage(self, stage: Stage) -> float:
+        """ Runs one stage (under cProfile if METRICS_PROFILE names it) and returns how long it took
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        print(f"==> {stage.name}: {stage.description}")
+        start = time.perf_counter()
+        with self.metrics.timed("stage_seconds", stage=stage.name), self.metrics.profile(stage.name):
+            getattr(self, stage.run)()
+        return time.perf_counter() - start
+
+    def run(self, stages: list = None, resume: bool = False) -> dict:
+        """ run executes the selected stages (all by default) in dependency order and returns {stage: status}.
+            Requirements that are not selected are assumed to be done. With resume=True, stages finished
+            by the previous run are skipped. A failed stage blocks the stages that need it, the others still run """
+        selected = [stage.name for stage in STAGES if stages is None or stage.name in stages]
+        unknown = set(stages or []) - set(self.stages)
+        if unknown:
+            raise ValueError(f"Unknown stages {sorted(unknown)}, use any of {list(self.stages)}")
+
+        previous = self.load_checkpoint()
+        self.checkpoint = previous if resume else {"stages": {}}
+        self.checkpoint["started"] = datetime.datetime.now().isoformat(timespec="seconds")
+        self.save_checkpoint()
+
+        status = {}
+        for name in selected:
+            if resume and name in previous["stages"]:
+                status[name] = "skipped (checkpoint)"
+
+        def satisfied(requirement):
+            return requirement not in selected or status.get(requirement, "").startswith(("done", "skipped"))
+
+        def blocked(requirement):
+            return requirement in selected and status.get(requirement, "").startswith(("failed", "blocked"))
+
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while True:
+                for name in selected:
+                    if name in status or name in running.values():
+                        continue
+                    requires = self.stages[name].requires
+                    if any(blocked(requirement) for requirement in requires):
+                        status[name] = "blocked"
+                    elif all(satisfied(requirement) for requirement in requires):
+                        running[pool.submit(self.__run_stage, self.stages[name])] = name
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        seconds = future.result()
+                        self.__complete(name, seconds)
+                        status[name] = f"done ({seconds:.1f}s)"
+                    except Exception as e:
+                        status[name] = f"failed: {e!r}"
+                    print(f"<== {name}: {status[name]}")
+
+        print("--------------------------------------------------------------------")
+        for name in selected:
+            print(f"{name:16} {status.get(name, 'not run')}")
+        print("--------------------------------------------------------------------")
+        self.metrics.save()
+        return status
+
+    # Stages
+
+    def stage_scores(self) -> None:
+        """ Fetches and stores the vendor scores """
+        self.fetcher.vendor_scores()
+
+    def stage_vulnerabilities(self) -> None:
+        """ Fetches and stores the vulnerabilities """
+        self.fetcher.fetch_vulnerabilities()
+
+    def stage_risks(self) -> None:
+        """ Ingests new risks and updates the risk rollups """
+        self.fetcher.risk_timeseries()
+
+    def __remediation(self):
+        """ Returns a Remediation that shares the fetch stages' session and rate limit
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        from Remediation import Remediation
+        remediation = Remediation(list(self.fetcher.muncipalities.values()),
+                                  connection=self.connection, run=False)
+        remediation.fetch_engine = self.fetcher.fetch_engine
+        remediation.changed = self.fetcher.changed
+        return remediation
+
+    def stage_remediation(self) -> None:
+        """ Fetches the remediation data of every municipality and stores the hosts that changed """
+        remediation = self.__remediation()
+        remediation.fetch_and_store(remediation.IPS)
+
+    def stage_reports(self) -> None:
+        """ Renders the remediation reports whose data changed, failing the stage if any report failed """
+        remediation = self.__remediation()
+        failures = remediation.generate_reports(remediation.IPS)
+        if failures:
+            raise RuntimeError(f"{len(failures)} reports failed: {sorted(failures)}")
+
+    def stage_analyze(self) -> None:
+        """ Writes score statistics, the top challenges and the monthly risk counts to data/analysis.json """
+        from ScoreAnalytics import ScoreAnalytics
+        fetcher = self.fetcher
+        analytics = ScoreAnalytics(
+            fetcher.collection_scores, pipelines=self.connection.backend != "memory")
+        timeline = RiskRollups(fetcher.collection_risk_rollups).timeline("month", by=None)
+        analysis = {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "summary": analytics.summary("score"),
+            "categories": analytics.category_stats(),
+            "top_scores": analytics.top_scores(15, "score"),
+            "histogram": analytics.histogram("score"),
+            "top_challenges": ChallengeCounter.from_collection(fetcher.collection_vulnerabilities).top(15),
+            "risks_per_month": [{"period": row["period"].date().isoformat(), "count": row["count"]} for row in timeline],
+        }
+        os.makedirs(self.data_dir, exist_ok=True)
+        path = os.path.join(self.data_dir, "analysis.json")
+        with open(path, "w") as file:
+            json.dump(analysis, file, indent=2, default=str)
+        print(f"Analysis saved to {path}")
+
+    def stage_graphs(self) -> None:
+        """ Draws every graph (see GraphGenerator.create_all_graphs), after copying the scores in MongoDB into the
+            local score store so municipalities fetched by workers are included. Fails the stage if any graph failed """
+        from Graph import GraphGenerator
+        self.fetcher.sync_score_store()
+        failures = GraphGenerator(self.connection).create_all_graphs()
+        if failures:
+            raise RuntimeError(f"{len(failures)} graphs failed: {sorted(failures)}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Run the MAPC analysis pipeline: fetch, store, analyze, render graphs and reports")
+    parser.add_argument("--stages", nargs="+", metavar="STAGE", choices=[stage.name for stage in STAGES],
+                        help=f"Only run these stages (any of: {', '.join(stage.name for stage in STAGES)})")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip the stages the previous run finished")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("PIPELINE_WORKERS", 4)),
+                        help="Stages to run at the same time")
+    parser.add_argument("--list", action="store_true",
+                        help="List the stages and exit")
+    parser.add_argument("--profile", nargs="+", metavar="STAGE", choices=[stage.name for stage in STAGES] + ["all"],
+                        help="Run these stages under cProfile, saved to data/profiles/<stage>.prof (same as METRICS_PROFILE)")
+    args = parser.parse_args()
+    if args.profile:
+        Metrics.shared().profile_stages = set(args.profile)
+
+    if args.list:
+        for stage in STAGES:
+            requires = f" (after {', '.join(stage.requires)})" if stage.requires else ""
+            print(f"{stage.name:16} {stage.description}{requires}")
+        sys.exit(0)
+
+    status = Pipeline(max_workers=args.workers).run(args.stages, resume=args.resume)
+    sys.exit(0 if all(result.startswith(("done", "skipped")) for result in status.values()) else 1)
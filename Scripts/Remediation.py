@@ -1,13 +1,12 @@
+import argparse
+import hashlib
+import json
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from FetchData import FetchData as FD
-import pymongo as pm
-import requests
+from Metrics import timed_call
 import datetime
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, HRFlowable
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib import colors
 
 #####################################################################################
 # Remediation.py
@@ -15,25 +14,53 @@ from reportlab.lib import colors
 # This script is used to generate PDFS of vunerabilities found by UpGuard and remediation steps for each NERAC Region.
 ###############################################################################################################
 
-# Custom HRFlowable class to change the color of the line.
-# Documentation: https://www.reportlab.com/docs/reportlab-userguide.pdf
+# The PDFs are drawn by ReportRenderer.py, imported when reports are generated so fetching does not load ReportLab
 
 
-class CustomHRFlowable(HRFlowable):
-    def __init__(self, width="100%", thickness=1, spaceBefore=0, spaceAfter=0):
-        super().__init__(width=width, thickness=thickness,
-                         spaceBefore=spaceBefore, spaceAfter=spaceAfter)
+def finding_id(risk: dict) -> str:
+    """ finding_id returns the catalog key of an UpGuard risk: its id, or a hash of the finding name if it has none """
+    return risk.get('id') or hashlib.sha1(risk['finding'].encode("utf-8")).hexdigest()
 
 
-class Remediation(FD):
+def catalog_key(finding: str, entry: dict) -> str:
+    """ catalog_key returns the Risk_Catalog key of a finding's text: the finding id plus a hash of the text.
+        UpGuard can word the same finding differently for different hosts, so each wording gets its own entry
+        and every report shows the text its own host was given """
+    text = json.dumps(entry, sort_keys=True)
+    return f"{finding}|{hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]}"
+
+
+def fingerprint(issue_data: list) -> str:
+    """ fingerprint returns a hash of a host's issue data (findings and scores) that does not depend on the order UpGuard lists them in """
+    issues = sorted(json.dumps(issue, sort_keys=True) for issue in issue_data)
+    return hashlib.sha256("\n".join(issues).encode("utf-8")).hexdigest()
+
+
+def response_hash(*responses) -> str:
+    """ response_hash returns a hash of the bodies of the UpGuard responses a host's stored data was parsed from """
+    digest = hashlib.sha256()
+    for response in responses:
+        digest.update(hashlib.sha256(response.content).digest())
+    return digest.hexdigest()
+
 
-    def __init__(self, IPS):
+def issue_delta(issue_data: list, reported_issues: list) -> dict:
+    """ issue_delta returns the issues that are new and resolved compared to the issues of the previous report """
+    current = [data['Issue'] for data in issue_data]
+    return {"new": sorted(set(current) - set(reported_issues)),
+            "resolved": sorted(set(reported_issues) - set(current))}
 
-        super().__init__()
 
-        # MongoDB setup
+class Remediation(FD):
+
+    def __init__(self, IPS, connection=None, max_workers: int = None, delta: bool = True, force: bool = None, run: bool = True):
+        """ Fetches UpGuard data for every host in IPS and writes one remediation PDF per host.
+            Only hosts whose findings or scores changed since their last report are stored and rebuilt.
+            max_workers is the number of report processes (defaults to REPORT_WORKERS or one per core),
+            delta adds a section with the new and resolved issues, force (or REPORT_FORCE=1) rebuilds every report.
+            With run=False nothing is fetched or rendered, call fetch_and_store and generate_reports yourself """
 
-        self.remediation_collection = self.DB['Remediation']
+        super().__init__(connection)
 
         # Directory setup
         self.remediation_dir = os.path.join(os.getcwd(), "Remediation")
@@ -44,6 +71,10 @@ class Remediation(FD):
 
         self.IPS = IPS
         self.date = datetime.datetime.now().strftime("%m-%d-%Y")
+        self.max_workers = max_workers or int(os.getenv("REPORT_WORKERS", 0)) or None
+        self.delta = delta
+        self.force = force if force is not None else os.getenv(
+            "REPORT_FORCE") == "1"
 
         # Data setup
         self.remediation_data = []
@@ -61,28 +92,106 @@ class Remediation(FD):
             'Insecure SSL/TLS versions available'
         ]
 
-        for IP in self.IPS:
-            self.fetch_data(IP)
-            self.generate_report(IP)
-
-    def fetch_data(self, IP):
-        """Fetch NERAC Region data from UpGuard and store in MongoDB. 
-        Helper method for the constructor.
-        """
-        params = {
+        # Fingerprints of the data already stored, so unchanged hosts are not written again
+        self.fingerprints = {}
+        # Hashes of the responses the stored data was parsed from, written with the data (see fetch_all)
+        self.response_hashes = {}
+        # Finding texts already queued for the Risk_Catalog in this run, by catalog key
+        self.catalog = {}
+
+        self.failures = {}
+        if run:
+            # Fetch every host first so the upserts go to MongoDB in one batch before the reports read them back
+            self.fetch_and_store(self.IPS)
+            self.failures = self.generate_reports(self.IPS)
+
+    @property
+    def remediation_collection(self):
+        return self.DB['Remediation']
+
+    @property
+    def risk_catalog_collection(self):
+        return self.DB['Risk_Catalog']
+
+    @staticmethod
+    def __params(IP) -> dict:
+        """ Returns the UpGuard query parameters for one host
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        return {
             "hostname": {IP},
             "primary_hostname": {IP},
         }
 
-        RISK_URL = "https://cyber-risk.upguard.com/api/public/risks/vendors"
-        SCORE_URL = "https://cyber-risk.upguard.com/api/public/vendor"
+    def title(self, IP) -> str:
+        """ title returns the report title of a host: the municipality name if the host is known, otherwise a name derived from the host """
+        for name, hostname in self.muncipalities.items():
+            if hostname == IP:
+                return name
+        return IP.replace("ma.gov", "").replace("-", "").capitalize()
+
+    def fetch_all(self, IPS) -> None:
+        """ fetch_all requests the risks and scores of every host concurrently (see FetchEngine) and queues them for MongoDB.
+            Hosts that fail are put on the "remediation" dead letter list (see FetchData.retry_dead_letters) """
+        for document in self.remediation_collection.find(
+                {"IP": {"$in": list(IPS)}}, {"_id": 0, "IP": 1, "Fingerprint": 1, "ResponseHash": 1}):
+            self.fingerprints[document["IP"]] = document.get("Fingerprint")
+            self.response_hashes[document["IP"]] = document.get("ResponseHash")
+
+        jobs = []
+        for IP in IPS:
+            jobs.append((self.VENDOR_RISKS_URL, self.__params(IP)))
+            jobs.append((self.VENDOR_URL, self.__params(IP)))
+        responses = self.fetch_engine.fetch_all(jobs)
+
+        fetched, changed = [], []
+        for index, IP in enumerate(IPS):
+            risk_response, score_response = responses[2 * index], responses[2 * index + 1]
+            if risk_response is None or score_response is None:
+                self.dead_letter("remediation", IP, "no response")
+                continue
+            self.metrics.observe("municipality_fetch_seconds", risk_response.fetch_seconds + score_response.fetch_seconds,
+                                 collector="remediation", municipality=IP)
+            failed = [response for response in (risk_response, score_response) if response.status_code != 200]
+            if failed:
+                self.dead_letter("remediation", IP,
+                                 f"HTTP {failed[0].status_code}: {failed[0].text[:200]}")
+                continue
+            if getattr(risk_response, "changed", True) or getattr(score_response, "changed", True):
+                changed.append(IP)
+            # The response cache commits a new body as soon as it arrives, so "unchanged" alone does not mean it was stored.
+            # Only skip parsing when MongoDB holds data parsed from exactly these responses
+            if self.response_hashes.get(IP) and self.response_hashes[IP] == response_hash(risk_response, score_response):
+                fetched.append(IP)
+                continue
+            try:
+                self.store_data(IP, risk_response, score_response)
+                fetched.append(IP)
+            except Exception as e:
+                self.dead_letter("remediation", IP, f"Error with parsing UpGuard data: {e}")
+        self.changed["remediation"] = changed
+        print(f"remediation: {len(changed)} of {len(fetched)} hosts changed since the previous run")
+        self.clear_dead_letters("remediation", fetched)
+
+    def fetch_and_store(self, IPS) -> None:
+        """ fetch_and_store fetches every host (see fetch_all) and writes the changed data to MongoDB """
+        self.fetch_all(IPS)
+        self.flush_writer(self.risk_catalog_collection)
+        self.flush_writer(self.remediation_collection)
 
-        risk_response = requests.get(
-            RISK_URL, headers=self.headers, params=params)
-        score_response = requests.get(
-            SCORE_URL, headers=self.headers, params=params)
-
-        if risk_response.status_code == 200:
+    def fetch_data(self, IP):
+        """Fetch NERAC Region data from UpGuard and store in MongoDB. 
+        Call flush_writer(self.remediation_collection) afterwards, fetch_all does the same for many hosts at once.
+        """
+        risk_response = self.fetch_engine.get(
+            self.VENDOR_RISKS_URL, params=self.__params(IP))
+        score_response = self.fetch_engine.get(
+            self.VENDOR_URL, params=self.__params(IP))
+        self.store_data(IP, risk_response, score_response)
+
+    def store_data(self, IP, risk_response, score_response):
+        """ store_data turns the risk and score responses of one host into issue data and queues it for MongoDB,
+            unless its fingerprint matches the data already stored """
+        if risk_response.status_code == 200 and score_response.status_code == 200:
             score_json = score_response.json()
             overall_score = score_json['score']
             category_scores = score_json['categoryScores']
@@ -97,15 +206,20 @@ class Remediation(FD):
 
             issue_data = []
             for risk in risks:
+                finding = finding_id(risk)
                 issue = risk['finding']
                 why_is_it_risky = risk['risk']
                 description = risk['description']
                 hostnames = risk['hostnames']
 
-                issue_data.append({
+                key = self.add_to_catalog(finding, {
                     "Issue": issue,
                     "Why is it risky": why_is_it_risky,
                     "Description": description,
+                })
+                issue_data.append({
+                    "Finding": key,
+                    "Issue": issue,
                     "Host": hostnames[0],
                     "Overall Score": overall_score,
                     "Web Score": web_score,
@@ -117,76 +231,137 @@ class Remediation(FD):
 
             self.remediation_data.append({IP: issue_data})
 
-            existing_data = self.remediation_collection.find_one({"IP": IP})
-            if existing_data is None:
-                self.remediation_collection.insert_one(
-                    {"IP": IP, "Data": issue_data})
-            else:
-                print(f"Data for {IP} already exists in MongoDB")
+            issue_fingerprint = fingerprint(issue_data)
+            content_hash = response_hash(risk_response, score_response)
+            if issue_fingerprint == self.fingerprints.get(IP) and content_hash == self.response_hashes.get(IP):
+                return
+            self.fingerprints[IP] = issue_fingerprint
+            self.response_hashes[IP] = content_hash
+            self.bulk_writer(self.remediation_collection, key="IP").add(
+                {"IP": IP, "Data": issue_data, "Fingerprint": issue_fingerprint, "ResponseHash": content_hash})
 
         else:
-            print("Error in fetching data from UpGuard API",
-                  risk_response.status_code, risk_response.text, sep="\n")
+            failed = risk_response if risk_response.status_code != 200 else score_response
+            print(f"Error in fetching data for {IP} from UpGuard API",
+                  failed.status_code, failed.text, sep="\n")
+
+    def add_to_catalog(self, finding: str, entry: dict) -> str:
+        """ add_to_catalog queues the text of a finding for the Risk_Catalog collection, once per wording per run.
+            Returns the catalog key (see catalog_key) the host's issue data refers to """
+        key = catalog_key(finding, entry)
+        if key in self.catalog:
+            return key
+        self.catalog[key] = entry
+        self.bulk_writer(self.risk_catalog_collection,
+                         key="Finding").add(dict(entry, Finding=key, FindingId=finding))
+        return key
+
+    def catalog_entries(self, documents) -> dict:
+        """ catalog_entries returns {catalog key: catalog entry} for every finding referenced by the given host documents """
+        findings = {data['Finding'] for document in documents
+                    for data in document['Data'] if 'Finding' in data}
+        return {entry['Finding']: entry for entry in self.risk_catalog_collection.find(
+            {"Finding": {"$in": list(findings)}}, {"_id": 0})}
+
+    def collectors(self) -> dict:
+        """ collectors adds the remediation hosts to the collectors retried by retry_dead_letters """
+        collectors = super().collectors()
+        collectors["remediation"] = self.fetch_and_store
+        return collectors
+
+    def report_job(self, IP, Data, reported_issues: list = None, catalog: dict = None) -> dict:
+        """ report_job returns the plain data render_report needs for one host.
+            reported_issues are the issues of the previous report, used for the delta section """
+        Title = self.title(IP)
+        delta = issue_delta(Data, reported_issues) if self.delta and reported_issues is not None else None
+        findings = {data.get('Finding') for data in Data}
+        return {"title": Title, "path": os.path.join(self.remediation_dir, f"{Title}.pdf"),
+                "date": self.date, "data": Data, "delta": delta,
+                "catalog": {finding: entry for finding, entry in (catalog or {}).items() if finding in findings}}
+
+    def record_report(self, IP, document) -> None:
+        """ record_report queues the fingerprint and issues a report was just built from, see needs_report """
+        self.bulk_writer(self.remediation_collection, key="IP").add(
+            {"IP": IP, "ReportFingerprint": document.get("Fingerprint") or fingerprint(document["Data"]),
+             "ReportedIssues": [data['Issue'] for data in document["Data"]], "ReportDate": self.date})
+
+    def needs_report(self, IP, document) -> bool:
+        """ needs_report is True when the stored data differs from what the last report was built from, or the PDF is missing """
+        if self.force or not os.path.exists(self.report_job(IP, [])["path"]):
+            return True
+        return (document.get("Fingerprint") or fingerprint(document["Data"])) != document.get("ReportFingerprint")
 
     def generate_report(self, IP):
         """Method generates PDF report based on UpGuard Data"""
 
-        Title = IP.replace("ma.gov", "").replace("-", "").capitalize()
-        Data = self.remediation_collection.find_one({"IP": IP})['Data']
-        IP_Scores = [str(Data[0][key]) for key in ['Overall Score', 'Web Score', 'Email Score',
-                                                   'Network Score', 'Phishing Score', 'Brand Score']]
-
-        doc = SimpleDocTemplate(os.path.join(
-            self.remediation_dir, f"{Title}.pdf"), pagesize=letter)
-        story = []  # This list will hold the document's contents
-
-        # Get the default style and customize it
-        styles = getSampleStyleSheet()
-        styles.add(ParagraphStyle(name='Center', alignment=1))
-
-        styles.add(ParagraphStyle(
-            name='Bold', parent=styles['BodyText'], fontName='Helvetica-Bold'))
-
-        # Adding the title and date to the story
-        story.append(Paragraph(
-            f"<font size=24 color=green>{Title} Remediation Report</font>", styles['Center']))
-        story.append(Spacer(1, 12))
-        story.append(
-            Paragraph(f"<font size=12>Date Created: {self.date}</font>", styles['Italic']))
-        story.append(Spacer(1, 12))
-
-        # Adding the scores to the story
-        story.append(Paragraph(
-            f"<font size=14>Overall Score {IP_Scores[0]} / 850</font>", styles['Center']))
-        story.append(Spacer(1, 12))
-
-        score_headings = ['Website Security', 'Email Security',
-                          'Network Security', 'Phishing Score', 'Brand Score']
-        scores_text = ' | '.join(
-            [f"{heading}: {score}" for heading, score in zip(score_headings, IP_Scores)])
-        story.append(Paragraph(scores_text, styles['BodyText']))
-        story.append(CustomHRFlowable())
-        story.append(Spacer(1, 12))
-
-        # Adding each issue and its description
-        for index, data in enumerate(Data, start=1):
-
-            story.append(
-                Paragraph(f"<font size=14>Issue #{index}: <font size=12>{data['Issue']} </font></font>", styles['Bold']))
-            story.append(Spacer(1, 12))
-            for key in ['Why is it risky', 'Description']:
-                story.append(Paragraph(f"<b>{key}:</b>", styles['BodyText']))
-                story.append(Paragraph(data[key], styles['BodyText']))
-                story.append(Spacer(1, 12))
-            story.append(CustomHRFlowable())
-
-        doc.build(story)
+        document = self.remediation_collection.find_one({"IP": IP})
+        job = self.report_job(IP, document['Data'], document.get(
+            "ReportedIssues"), self.catalog_entries([document]))
+        from ReportRenderer import render_report
+        with self.metrics.timed("report_render_seconds", report=job["title"]):
+            render_report(job)
+        self.record_report(IP, document)
+        self.flush_writer(self.remediation_collection)
+        print(f"-" * 50)
+        print(f"\n\nReport for {job['title']} has been generated successfully\n\n")
+        print(f"-" * 50)
+
+    def generate_reports(self, IPS) -> dict:
+        """ generate_reports renders the reports of many hosts in a process pool, printing progress as each one finishes.
+            Reports that are up to date (see needs_report) are skipped. A report that fails does not stop the others.
+            Returns {IP: error} for every report that was not written """
+        documents = {document["IP"]: document for document in self.remediation_collection.find(
+            {"IP": {"$in": list(IPS)}}, {"_id": 0})}
+        failures = {IP: "no data in MongoDB" for IP in IPS if IP not in documents}
+
+        changed = [IP for IP in IPS if IP in documents and self.needs_report(IP, documents[IP])]
+        catalog = self.catalog_entries([documents[IP] for IP in changed])
+        jobs = {IP: self.report_job(IP, documents[IP]["Data"], documents[IP].get("ReportedIssues"), catalog)
+                for IP in changed}
+        unchanged = len(documents) - len(jobs)
+        from ReportRenderer import render_report
+        done = 0
+        with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {pool.submit(timed_call, render_report, job): IP for IP, job in jobs.items()}
+            for future in as_completed(futures):
+                IP = futures[future]
+                done += 1
+                try:
+                    _, seconds = future.result()
+                    self.metrics.observe("report_render_seconds", seconds, report=jobs[IP]["title"])
+                    self.record_report(IP, documents[IP])
+                    print(f"[{done}/{len(jobs)}] Report for {jobs[IP]['title']} has been generated successfully")
+                except Exception as e:
+                    failures[IP] = e
+                    print(f"[{done}/{len(jobs)}] Report for {jobs[IP]['title']} failed: {e}")
+
+        # Record which data each new report was built from
+        self.flush_writer(self.remediation_collection)
+
         print(f"-" * 50)
-        print(f"\n\nReport for {Title} has been generated successfully\n\n")
+        generated = len([IP for IP in jobs if IP not in failures])
+        print(f"\n\n{generated} of {len(jobs)} changed reports generated, {unchanged} unchanged\n\n")
+        for IP, error in failures.items():
+            print(f"{IP}: {error}")
         print(f"-" * 50)
+        return failures
 
 
 if __name__ == '__main__':
-    NERAC_REGIONS = ["danversma.gov", "middletonma.gov",
-                     "topsfield-ma.gov", "wenhamma.gov"]
-    Remediate = Remediation(NERAC_REGIONS)
+    parser = argparse.ArgumentParser(
+        description="Generate remediation reports for every NERAC municipality")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Fetch again every host that failed in an earlier run (see Dead_Letters)")
+    args = parser.parse_args()
+
+    # Every municipality in the registry (data/municipalities.csv), read by the constructor after .env is loaded
+    # so a MUNICIPALITY_REGISTRY set there is used
+    Remediate = Remediation([], run=False)
+    NERAC_REGIONS = list(Remediate.muncipalities.values())
+    Remediate.IPS = NERAC_REGIONS
+    if args.retry_failed:
+        Remediate.retry_dead_letters()
+    else:
+        Remediate.fetch_and_store(NERAC_REGIONS)
+        Remediate.failures = Remediate.generate_reports(NERAC_REGIONS)
+    Remediate.metrics.save()
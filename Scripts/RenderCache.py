@@ -0,0 +1,49 @@
+import hashlib
+import json
+import os
+
+#####################################################################################
+# RenderCache.py
+# Author: Adi Bhan
+# This script remembers a content hash of every chart spec that was rendered, so unchanged charts are not drawn again
+###############################################################################################################
+
+
+class RenderCache:
+    """ RenderCache keeps a manifest of file name -> hash of the chart spec (data + parameters) that produced it.
+        A chart is fresh when its file still exists and its spec hashes to the value in the manifest """
+
+    def __init__(self, graph_dir: str, manifest_name: str = ".render_manifest.json"):
+        self.graph_dir = graph_dir
+        self.path = os.path.join(graph_dir, manifest_name)
+        self.manifest = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as file:
+                    self.manifest = json.load(file)
+            except ValueError:
+                print(f"Ignoring unreadable render manifest {self.path}")
+
+    @staticmethod
+    def key(spec: dict) -> str:
+        """ key returns the content hash of a chart spec. The output folder is left out so moving the graphs folder keeps the cache valid """
+        content = {name: value for name,
+                   value in spec.items() if name != "graph_dir"}
+        encoded = json.dumps(content, sort_keys=True, default=str)
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def is_fresh(self, spec: dict) -> bool:
+        """ is_fresh returns True if the file for spec exists and was rendered from identical inputs """
+        return (self.manifest.get(spec["file_name"]) == self.key(spec)
+                and os.path.exists(os.path.join(spec["graph_dir"], spec["file_name"])))
+
+    def record(self, spec: dict) -> None:
+        """ record stores the hash of a spec that has just been rendered (call save to write the manifest) """
+        self.manifest[spec["file_name"]] = self.key(spec)
+
+    def save(self) -> None:
+        """ save writes the manifest to disk """
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump(self.manifest, file, indent=2, sort_keys=True)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,179 @@
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+#####################################################################################
+# Replay.py
+# Author: Adi Bhan
+# This script records UpGuard API responses to disk and serves them back from a local stand-in server,
+# so the fetch code can be tested and load tested without using API quota
+###############################################################################################################
+
+API_PREFIX = "/api/public/"
+
+
+def endpoint_name(url: str) -> str:
+    """ endpoint_name turns an API url or path into the fixture folder name, e.g. .../api/public/risks/vendors -> risks_vendors """
+    path = urlparse(url).path
+    if API_PREFIX in path:
+        path = path.split(API_PREFIX, 1)[1]
+    return path.strip("/").replace("/", "_") or "root"
+
+
+def fixture_name(hostname: str) -> str:
+    """ fixture_name returns a file name that is safe to use for a hostname """
+    return re.sub(r"[^A-Za-z0-9._-]", "_", hostname) + ".json"
+
+
+class FixtureRecorder:
+    """ FixtureRecorder saves every response the fetch engine receives as <directory>/<endpoint>/<hostname>.json """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.lock = threading.Lock()
+
+    def record(self, url: str, params: dict, response) -> None:
+        """ record writes the status code and body of a response, keyed on the hostname parameter of the request """
+        hostname = (params or {}).get("hostname")
+        if isinstance(hostname, (set, list, tuple)):
+            hostname = next(iter(hostname), None)
+        if not hostname:
+            return
+
+        try:
+            body = response.json()
+        except ValueError:
+            body = response.text
+        folder = os.path.join(self.directory, endpoint_name(url))
+        with self.lock:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            with open(os.path.join(folder, fixture_name(hostname)), "w") as file:
+                json.dump({"status": response.status_code,
+                          "body": body}, file)
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """ ReplayServer is a local stand-in for the UpGuard public API that serves recorded fixtures.
+        Unknown hostnames are answered with a recording of another host (picked deterministically),
+        so any number of synthetic municipalities can be fetched from a small set of recordings """
+
+    daemon_threads = True
+
+    def __init__(self, fixtures_dir: str, host: str = "127.0.0.1", port: int = 8089,
+                 latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, payload_scale: int = 1, seed: int = None):
+        super().__init__((host, port), ReplayHandler)
+        self.fixtures_dir = fixtures_dir
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.payload_scale = max(1, payload_scale)
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.fixtures = {}
+
+        if os.path.exists(fixtures_dir):
+            for endpoint in sorted(os.listdir(fixtures_dir)):
+                folder = os.path.join(fixtures_dir, endpoint)
+                if os.path.isdir(folder):
+                    self.fixtures[endpoint] = sorted(
+                        name for name in os.listdir(folder) if name.endswith(".json"))
+
+    @property
+    def api_root(self) -> str:
+        """ api_root is the value to use for UPGUARD_API_ROOT to point the fetch classes at this server """
+        return f"http://{self.server_address[0]}:{self.server_address[1]}{API_PREFIX.rstrip('/')}"
+
+    def draw(self) -> float:
+        with self.random_lock:
+            return self.random.random()
+
+    def load(self, endpoint: str, hostname: str):
+        """ load returns (status, body) for a request, or None if nothing is recorded for the endpoint """
+        names = self.fixtures.get(endpoint)
+        if not names:
+            return None
+        name = fixture_name(hostname)
+        if name not in names:
+            name = names[zlib.crc32(hostname.encode("utf-8")) % len(names)]
+        with open(os.path.join(self.fixtures_dir, endpoint, name), "r") as file:
+            fixture = json.load(file)
+
+        body = fixture["body"]
+        if isinstance(body, dict):
+            if body.get("primary_hostname"):
+                body["primary_hostname"] = hostname
+            # Repeat list payloads (risks, vulnerabilities) to test larger responses
+            for key, value in body.items():
+                if isinstance(value, list):
+                    body[key] = value * self.payload_scale
+        return fixture["status"], body
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    """ ReplayHandler answers GET requests for ReplayServer, applying its latency and error rate """
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        hostname = (params.get("hostname") or params.get("primary_hostname") or [""])[0]
+
+        delay = server.latency + server.jitter * server.draw()
+        if delay > 0:
+            time.sleep(delay)
+
+        if server.error_rate and server.draw() < server.error_rate:
+            status, body = 503, {"error": "simulated failure"}
+        else:
+            fixture = server.load(endpoint_name(url.path), hostname)
+            status, body = fixture if fixture else (
+                404, {"error": f"no recording for {url.path}"})
+
+        payload = json.dumps(body).encode("utf-8")
+        # ETag lets conditional requests (see ResponseCache) be tested against the stand-in server
+        etag = f'"{zlib.crc32(payload):08x}"'
+        if status == 200 and self.headers.get("If-None-Match") == etag:
+            status, payload = 304, b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        if status in (200, 304):
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        # Keep load tests quiet, errors are still visible through the status codes
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve recorded UpGuard responses from a local stand-in server")
+    parser.add_argument("--fixtures", default=os.path.join(os.getcwd(), "data", "fixtures"),
+                        help="Directory written by a run with UPGUARD_RECORD_DIR set")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="Random extra seconds (0 to jitter) added to every response")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of requests answered with 503")
+    parser.add_argument("--payload-scale", type=int, default=1,
+                        help="Repeat every list in a payload this many times")
+    args = parser.parse_args()
+
+    server = ReplayServer(args.fixtures, host=args.host, port=args.port, latency=args.latency,
+                          jitter=args.jitter, error_rate=args.error_rate, payload_scale=args.payload_scale)
+    print(f"Serving {sum(len(names) for names in server.fixtures.values())} recordings from {args.fixtures}")
+    print(f"Set UPGUARD_API_ROOT={server.api_root} to use it")
+    server.serve_forever()
@@ -0,0 +1,121 @@
+import copy
+from reportlab.lib.pagesizes import letter
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, HRFlowable
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib import colors
+
+#####################################################################################
+# ReportRenderer.py
+# Author: Adi Bhan
+# This script draws the remediation PDFs with ReportLab from plain job dictionaries (see Remediation.report_job),
+# so reports can be rendered in worker processes that only import this module
+###############################################################################################################
+
+# Custom HRFlowable class to change the color of the line.
+# Documentation: https://www.reportlab.com/docs/reportlab-userguide.pdf
+
+
+class CustomHRFlowable(HRFlowable):
+    def __init__(self, width="100%", thickness=1, spaceBefore=0, spaceAfter=0):
+        super().__init__(width=width, thickness=thickness,
+                         spaceBefore=spaceBefore, spaceAfter=spaceAfter)
+
+
+# Prose stored once per finding in the Risk_Catalog collection instead of in every host's issue data
+CATALOG_FIELDS = ['Why is it risky', 'Description']
+
+
+# Paragraph styles, built once per process by report_styles()
+_STYLES = None
+
+# Parsed catalog paragraphs by (catalog key, field, text), shared by every report rendered in the same process
+_FLOWABLES = {}
+
+
+def report_styles():
+    """ report_styles returns the sample style sheet with the Center and Bold styles the reports use.
+        It is built on first use and shared by every report rendered in the same process """
+    global _STYLES
+    if _STYLES is None:
+        styles = getSampleStyleSheet()
+        styles.add(ParagraphStyle(name='Center', alignment=1))
+        styles.add(ParagraphStyle(
+            name='Bold', parent=styles['BodyText'], fontName='Helvetica-Bold'))
+        _STYLES = styles
+    return _STYLES
+
+
+def catalog_paragraph(finding: str, key: str, text: str) -> Paragraph:
+    """ catalog_paragraph returns a Paragraph for catalog text. Paragraphs are parsed once per process and
+        each report gets its own shallow copy, so the markup of common findings is not parsed again for every host """
+    cache_key = (finding, key, text)
+    if cache_key not in _FLOWABLES:
+        _FLOWABLES[cache_key] = Paragraph(text, report_styles()['BodyText'])
+    return copy.copy(_FLOWABLES[cache_key])
+
+
+def render_report(job: dict) -> str:
+    """ render_report builds one remediation PDF and returns its path. job is a dictionary with
+        title, path, date, data (the issue list stored in the Remediation collection),
+        catalog (the Risk_Catalog entries of those issues by catalog key) and
+        delta (issue_delta against the previous report, or None to leave the section out).
+        Only plain data goes in, so reports can be rendered in a process pool """
+    Title, Data = job["title"], job["data"]
+    IP_Scores = [str(Data[0][key]) if Data else "N/A" for key in ['Overall Score', 'Web Score', 'Email Score',
+                                                                  'Network Score', 'Phishing Score', 'Brand Score']]
+
+    doc = SimpleDocTemplate(job["path"], pagesize=letter)
+    story = []  # This list will hold the document's contents
+    styles = report_styles()
+
+    # Adding the title and date to the story
+    story.append(Paragraph(
+        f"<font size=24 color=green>{Title} Remediation Report</font>", styles['Center']))
+    story.append(Spacer(1, 12))
+    story.append(
+        Paragraph(f"<font size=12>Date Created: {job['date']}</font>", styles['Italic']))
+    story.append(Spacer(1, 12))
+
+    # Adding the scores to the story
+    story.append(Paragraph(
+        f"<font size=14>Overall Score {IP_Scores[0]} / 850</font>", styles['Center']))
+    story.append(Spacer(1, 12))
+
+    score_headings = ['Website Security', 'Email Security',
+                      'Network Security', 'Phishing Score', 'Brand Score']
+    scores_text = ' | '.join(
+        [f"{heading}: {score}" for heading, score in zip(score_headings, IP_Scores[1:])])
+    story.append(Paragraph(scores_text, styles['BodyText']))
+    story.append(CustomHRFlowable())
+    story.append(Spacer(1, 12))
+
+    # Adding the changes since the previous report
+    if job.get("delta") is not None:
+        story.append(
+            Paragraph("<font size=14>Changes Since Last Report</font>", styles['Bold']))
+        story.append(Spacer(1, 12))
+        for key, heading in [("new", "New issues"), ("resolved", "Resolved issues")]:
+            issues = ", ".join(job["delta"][key]) or "None"
+            story.append(
+                Paragraph(f"<b>{heading}:</b> {issues}", styles['BodyText']))
+            story.append(Spacer(1, 12))
+        story.append(CustomHRFlowable())
+        story.append(Spacer(1, 12))
+
+    # Adding each issue and its description
+    for index, data in enumerate(Data, start=1):
+
+        story.append(
+            Paragraph(f"<font size=14>Issue #{index}: <font size=12>{data['Issue']} </font></font>", styles['Bold']))
+        story.append(Spacer(1, 12))
+        # Issue data stored before the catalog existed still has the text inline
+        entry = job.get("catalog", {}).get(data.get('Finding'), data)
+        for key in CATALOG_FIELDS:
+            story.append(Paragraph(f"<b>{key}:</b>", styles['BodyText']))
+            story.append(catalog_paragraph(
+                data.get('Finding'), key, entry[key]))
+            story.append(Spacer(1, 12))
+        story.append(CustomHRFlowable())
+
+    doc.build(story)
+    return job["path"]
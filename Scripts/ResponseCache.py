@@ -0,0 +1,186 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from Replay import endpoint_name
+
+#####################################################################################
+# ResponseCache.py
+# Author: Adi Bhan
+# This script keeps the last successful UpGuard response of every request on disk (SQLite, zlib compressed),
+# so unchanged data is revalidated with conditional requests or served locally instead of downloaded again
+###############################################################################################################
+
+
+def parse_ttls(value: str) -> dict:
+    """ parse_ttls reads per endpoint TTLs in seconds from "endpoint=seconds,..." (e.g. "vendor=86400,risks_vendors=3600").
+        Endpoint names are the ones used by Replay.endpoint_name """
+    ttls = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            endpoint, seconds = item.split("=", 1)
+            ttls[endpoint.strip()] = float(seconds)
+    return ttls
+
+
+class ResponseCache:
+    """ ResponseCache stores the body, ETag, Last-Modified and content hash of the last 200 response per (url, params).
+        Within an endpoint's TTL the stored response is returned without a request. After that the request is sent with
+        If-None-Match/If-Modified-Since when the API gave those headers; a 304 (or a body with the same hash) means unchanged.
+        Responses returned through resolve have two extra attributes: from_cache and changed """
+
+    def __init__(self, path: str, default_ttl: float = 0.0, ttls: dict = None):
+        self.path = path
+        self.default_ttl = default_ttl
+        self.ttls = ttls or {}
+        self.lock = threading.Lock()
+        self.hits = {"fresh": 0, "revalidated": 0, "unchanged": 0, "changed": 0}
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, url TEXT NOT NULL, headers TEXT, body BLOB, "
+            "etag TEXT, last_modified TEXT, content_hash TEXT, fetched_at REAL NOT NULL, changed_at REAL NOT NULL)")
+        self.connection.commit()
+
+    @staticmethod
+    def key(url: str, params: dict = None) -> str:
+        """ key returns the cache key of a request. Parameter values may be strings or collections (sets are sorted) """
+        normalized = {name: sorted(value) if isinstance(value, (set, list, tuple)) else value
+                      for name, value in (params or {}).items()}
+        return url + "?" + json.dumps(normalized, sort_keys=True, default=str)
+
+    def ttl(self, url: str) -> float:
+        """ ttl returns how many seconds a response of url's endpoint is served without asking the API """
+        return self.ttls.get(endpoint_name(url), self.default_ttl)
+
+    def lookup(self, url: str, params: dict = None) -> dict:
+        """ lookup returns the stored entry of a request (with a "fresh" flag telling if it is within its TTL), or None """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT headers, body, etag, last_modified, content_hash, fetched_at FROM responses WHERE key = ?",
+                (self.key(url, params),)).fetchone()
+        if row is None:
+            return None
+        headers, body, etag, last_modified, content_hash, fetched_at = row
+        return {"headers": json.loads(headers), "body": zlib.decompress(body), "etag": etag,
+                "last_modified": last_modified, "content_hash": content_hash,
+                "fresh": time.time() - fetched_at < self.ttl(url)}
+
+    @staticmethod
+    def conditional_headers(entry: dict) -> dict:
+        """ conditional_headers returns the If-None-Match/If-Modified-Since headers for revalidating an entry """
+        headers = {}
+        if entry is not None and entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry is not None and entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    @staticmethod
+    def to_response(url: str, entry: dict, changed: bool = False):
+        """ to_response rebuilds a requests.Response from a stored entry """
+        # requests is imported here so the stats and clear commands start without it
+        import requests
+        from requests.structures import CaseInsensitiveDict
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.encoding = "utf-8"
+        response._content = entry["body"]
+        response.from_cache = True
+        response.changed = changed
+        return response
+
+    def fresh(self, url: str, entry: dict):
+        """ fresh returns the stored response of an entry that is within its TTL """
+        with self.lock:
+            self.hits["fresh"] += 1
+        return self.to_response(url, entry)
+
+    def resolve(self, url: str, params: dict, response, entry: dict = None):
+        """ resolve takes the API's answer to a (conditional) request and returns the response to use:
+            the stored one on a 304, otherwise the new one, which is stored if it is a 200. Sets response.changed """
+        now = time.time()
+        key = self.key(url, params)
+        if response.status_code == 304 and entry is not None:
+            with self.lock:
+                self.connection.execute(
+                    "UPDATE responses SET fetched_at = ? WHERE key = ?", (now, key))
+                self.connection.commit()
+                self.hits["revalidated"] += 1
+            return self.to_response(url, entry)
+
+        response.from_cache = False
+        response.changed = True
+        if response.status_code != 200:
+            return response
+
+        content_hash = hashlib.sha256(response.content).hexdigest()
+        response.changed = entry is None or entry["content_hash"] != content_hash
+        headers = {name: value for name, value in response.headers.items()
+                   if name.lower() in ("content-type", "etag", "last-modified")}
+        with self.lock:
+            if response.changed:
+                self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                        (key, url, json.dumps(headers), zlib.compress(response.content),
+                                         response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                                         content_hash, now, now))
+            else:
+                self.connection.execute("UPDATE responses SET fetched_at = ?, etag = ?, last_modified = ? WHERE key = ?",
+                                        (now, response.headers.get("ETag"), response.headers.get("Last-Modified"), key))
+            self.connection.commit()
+            self.hits["changed" if response.changed else "unchanged"] += 1
+        return response
+
+    def stats(self) -> dict:
+        """ stats returns the number of stored responses, their compressed size and this run's hit counts """
+        with self.lock:
+            count, size = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(body)), 0) FROM responses").fetchone()
+        return dict(self.hits, responses=count, compressed_bytes=size)
+
+    def clear(self, endpoint: str = None) -> int:
+        """ clear removes every stored response (or those of one endpoint) and returns how many were removed """
+        with self.lock:
+            urls = [row[0] for row in self.connection.execute(
+                "SELECT DISTINCT url FROM responses").fetchall()]
+            removed = 0
+            for url in urls:
+                if endpoint is None or endpoint_name(url) == endpoint:
+                    removed += self.connection.execute(
+                        "DELETE FROM responses WHERE url = ?", (url,)).rowcount
+            self.connection.commit()
+        return removed
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Inspect or clear the UpGuard response cache")
+    parser.add_argument("--path", default=os.getenv("UPGUARD_CACHE", os.path.join(
+        os.getcwd(), "data", "response_cache.sqlite")))
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats", help="Print how many responses are stored")
+    clear_parser = subparsers.add_parser(
+        "clear", help="Remove stored responses so the next run downloads them again")
+    clear_parser.add_argument("--endpoint", help="Only clear one endpoint, e.g. risks_vendors")
+    args = parser.parse_args()
+
+    cache = ResponseCache(args.path)
+    if args.command == "stats":
+        stats = cache.stats()
+        print(f"{stats['responses']} responses, {stats['compressed_bytes']} bytes compressed")
+    else:
+        print(f"Removed {cache.clear(args.endpoint)} responses")
+    cache.close()
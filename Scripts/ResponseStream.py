@@ -0,0 +1,25 @@
+import io
+
+# ijson is optional, without it every payload is decoded with response.json()
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+#####################################################################################
+# ResponseStream.py
+# Author: Adi Bhan
+# This script turns UpGuard API responses into a stream of records, decoding each payload exactly once
+###############################################################################################################
+
+# Payloads larger than this are parsed incrementally with ijson (when it is installed)
+STREAM_THRESHOLD_BYTES = 8 * 1024 * 1024
+
+
+def iter_records(response, key: str, threshold: int = STREAM_THRESHOLD_BYTES):
+    """ iter_records yields every item of the top level list `key` in a JSON response, e.g. iter_records(response, "risks").
+        The body is decoded once; large bodies are parsed item by item so the full document is never built in memory """
+    if ijson is not None and len(response.content) > threshold:
+        yield from ijson.items(io.BytesIO(response.content), f"{key}.item", use_float=True)
+    else:
+        yield from response.json().get(key) or []
@@ -0,0 +1,121 @@
+import datetime
+from collections import Counter
+from pymongo import ASCENDING, UpdateOne
+
+#####################################################################################
+# RiskRollups.py
+# Author: Adi Bhan
+# This script keeps daily, weekly and monthly risk counts per municipality, severity and category,
+# so the risk timeline is read from a few hundred rollup documents instead of every risk
+###############################################################################################################
+
+GRANULARITIES = ["day", "week", "month"]
+
+
+def parse_detected(first_detected: str) -> datetime.datetime:
+    """ parse_detected turns UpGuard's firstDetected timestamp ("2023-05-01T12:34:56Z") into a naive UTC datetime """
+    try:
+        detected = datetime.datetime.fromisoformat(
+            first_detected.replace("Z", "+00:00"))
+    except ValueError:
+        detected = datetime.datetime.strptime(first_detected[0:10], "%Y-%m-%d")
+    if detected.tzinfo is not None:
+        detected = detected.astimezone(
+            datetime.timezone.utc).replace(tzinfo=None)
+    return detected
+
+
+def period_start(detected: datetime.datetime, granularity: str) -> datetime.datetime:
+    """ period_start returns the first moment of the day, week (starting Monday) or month containing detected """
+    day = datetime.datetime(detected.year, detected.month, detected.day)
+    if granularity == "day":
+        return day
+    if granularity == "week":
+        return day - datetime.timedelta(days=day.weekday())
+    if granularity == "month":
+        return day.replace(day=1)
+    raise ValueError(f"Unknown granularity {granularity}, use one of {GRANULARITIES}")
+
+
+class RiskRollups:
+    """ RiskRollups maintains the rollup collection. Each document counts the risks of one
+        (granularity, period, municipality, severity, category) and is only ever incremented """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def ensure_indexes(self) -> None:
+        """ ensure_indexes creates the index used by timeline queries """
+        self.collection.create_index(
+            [("granularity", ASCENDING), ("period", ASCENDING)])
+
+    @staticmethod
+    def __counts(risks) -> Counter:
+        """ Counts risk documents per rollup bucket
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        counts = Counter()
+        for risk in risks:
+            detected = risk.get("Detected") or parse_detected(
+                risk["FirstDetected"])
+            for granularity in GRANULARITIES:
+                counts[(granularity, period_start(detected, granularity), risk["Name"],
+                        risk["Severity"], risk["Category"])] += 1
+        return counts
+
+    def add(self, risks: list) -> int:
+        """ add increments the rollups for newly stored risk documents (Name, Severity, Category, Detected/FirstDetected).
+            Only pass risks that were not stored before, or they are counted twice. Returns the number of rollups touched """
+        operations = []
+        for document in self.__documents(risks):
+            count = document.pop("count")
+            operations.append(UpdateOne({"_id": document.pop("_id")}, {
+                "$inc": {"count": count}, "$setOnInsert": document}, upsert=True))
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
+        return len(operations)
+
+    def __documents(self, risks) -> list:
+        """ Returns the rollup documents (with their counts) of a set of risks
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        return [{"_id": f"{granularity}|{period.date().isoformat()}|{name}|{severity}|{category}",
+                 "granularity": granularity, "period": period, "name": name,
+                 "severity": severity, "category": category, "count": count}
+                for (granularity, period, name, severity, category), count in self.__counts(risks).items()]
+
+    def rebuild(self, risk_collection) -> int:
+        """ rebuild recomputes every rollup from the stored risks, for data stored before rollups existed """
+        risks = risk_collection.find({}, {"_id": 0, "Name": 1, "Severity": 1, "Category": 1,
+                                          "Detected": 1, "FirstDetected": 1})
+        risks = (risk for risk in risks if risk.get(
+            "Detected") or risk.get("FirstDetected"))
+        self.collection.delete_many({})
+        # The collection is empty, so plain inserts replace the per rollup upserts
+        documents = self.__documents(risks)
+        if documents:
+            self.collection.insert_many(documents, ordered=False)
+        return len(documents)
+
+    def timeline(self, granularity: str = "month", start: datetime.datetime = None, end: datetime.datetime = None,
+                 by: str = "severity", names: list = None) -> list:
+        """ timeline returns [{"period", by, "count"}] sorted by period, summed over everything except `by`
+            (one of "name", "severity", "category", or None for a single total) """
+        match = {"granularity": granularity}
+        if start or end:
+            match["period"] = {}
+            if start:
+                match["period"]["$gte"] = start
+            if end:
+                match["period"]["$lte"] = end
+        if names is not None:
+            match["name"] = {"$in": list(names)}
+
+        group_id = {"period": "$period"}
+        if by:
+            group_id[by] = f"${by}"
+        pipeline = [
+            {"$match": match},
+            {"$group": {"_id": group_id, "count": {"$sum": "$count"}}},
+        ]
+        rows = [dict(row["_id"], count=row["count"])
+                for row in self.collection.aggregate(pipeline)]
+        return sorted(rows, key=lambda row: (row["period"], str(row.get(by, ""))))
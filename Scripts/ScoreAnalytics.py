@@ -0,0 +1,153 @@
+import math
+from pymongo.errors import OperationFailure
+from ScoreFrame import SCORE_COLUMNS
+
+#####################################################################################
+# ScoreAnalytics.py
+# Author: Adi Bhan
+# This script runs score statistics inside MongoDB with aggregation pipelines so only the results cross the network
+###############################################################################################################
+
+# Default histogram buckets, UpGuard scores go from 0 to 950
+HISTOGRAM_BOUNDARIES = list(range(0, 1000, 50))
+
+
+def field_path(column: str) -> str:
+    """ field_path returns where a score column is stored in a Municipality_Scores document """
+    return "data.score" if column == "score" else f"data.categoryScores.{column}"
+
+
+class ScoreAnalytics:
+    """ ScoreAnalytics answers histogram, summary and top-N questions about the Municipality_Scores collection.
+        With pipelines=False (the in-memory backend) the same results are computed in Python from projected documents """
+
+    def __init__(self, collection, pipelines: bool = True):
+        self.collection = collection
+        self.pipelines = pipelines
+
+    @staticmethod
+    def __number(document: dict, path: str):
+        """ Returns the number stored at a dotted path of a document, or None
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        value = document
+        for part in path.split("."):
+            value = value.get(part) if isinstance(value, dict) else None
+        return value if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+    def __values(self, column: str) -> list:
+        """ Returns the numeric values of one column, reading only that field
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        path = field_path(column)
+        values = [self.__number(document, path)
+                  for document in self.collection.find({}, {path: 1, "_id": 0})]
+        return [value for value in values if value is not None]
+
+    def top_scores(self, n: int = 15, column: str = "score", ascending: bool = False) -> list:
+        """ top_scores returns (name, score) pairs of the n highest (or lowest) municipalities """
+        path = field_path(column)
+        if self.pipelines:
+            pipeline = [
+                {"$match": {path: {"$type": "number"}}},
+                {"$project": {"_id": 0, "name": 1, "value": f"${path}"}},
+                {"$sort": {"value": 1 if ascending else -1, "name": 1}},
+                {"$limit": n},
+            ]
+            return [(document["name"], document["value"]) for document in self.collection.aggregate(pipeline)]
+        documents = self.collection.find({}, {"name": 1, path: 1, "_id": 0})
+        pairs = [(document["name"], self.__number(document, path))
+                 for document in documents]
+        pairs = [pair for pair in pairs if pair[1] is not None]
+        pairs.sort(key=lambda pair: (pair[1] if ascending else -pair[1], pair[0]))
+        return pairs[:n]
+
+    def histogram(self, column: str = "score", boundaries: list = HISTOGRAM_BOUNDARIES) -> list:
+        """ histogram returns [{"min", "max", "count"}] for each bucket that has at least one municipality """
+        if self.pipelines:
+            pipeline = [
+                {"$match": {field_path(column): {"$type": "number"}}},
+                {"$bucket": {"groupBy": f"${field_path(column)}", "boundaries": boundaries + [math.inf],
+                             "default": "other", "output": {"count": {"$sum": 1}}}},
+            ]
+            buckets = list(self.collection.aggregate(pipeline))
+        else:
+            counts = {}
+            for value in self.__values(column):
+                lower = max([boundary for boundary in boundaries if boundary <= value], default="other")
+                counts[lower] = counts.get(lower, 0) + 1
+            buckets = [{"_id": lower, "count": count}
+                       for lower, count in counts.items()]
+
+        edges = boundaries + [math.inf]
+        result = []
+        for bucket in buckets:
+            if bucket["_id"] == "other":
+                result.append({"min": None, "max": None, "count": bucket["count"]})
+                continue
+            index = edges.index(bucket["_id"])
+            result.append({"min": edges[index], "max": edges[index + 1], "count": bucket["count"]})
+        return sorted(result, key=lambda bucket: (bucket["min"] is None, bucket["min"] or 0))
+
+    def category_stats(self, columns: list = SCORE_COLUMNS) -> dict:
+        """ category_stats returns {column: {"count", "mean", "std", "min", "max"}} computed in one $group stage """
+        if self.pipelines:
+            group = {"_id": None}
+            for column in columns:
+                value = {"$cond": [{"$isNumber": f"${field_path(column)}"}, f"${field_path(column)}", None]}
+                group[f"{column}_count"] = {"$sum": {"$cond": [{"$isNumber": f"${field_path(column)}"}, 1, 0]}}
+                group[f"{column}_mean"] = {"$avg": value}
+                group[f"{column}_std"] = {"$stdDevPop": value}
+                group[f"{column}_min"] = {"$min": value}
+                group[f"{column}_max"] = {"$max": value}
+            results = list(self.collection.aggregate([{"$group": group}]))
+            row = results[0] if results else {}
+            return {column: {statistic: row.get(f"{column}_{statistic}")
+                             for statistic in ["count", "mean", "std", "min", "max"]} for column in columns}
+
+        stats = {}
+        for column in columns:
+            values = self.__values(column)
+            mean = sum(values) / len(values) if values else None
+            stats[column] = {
+                "count": len(values),
+                "mean": mean,
+                "std": math.sqrt(sum((value - mean) ** 2 for value in values) / len(values)) if values else None,
+                "min": min(values, default=None),
+                "max": max(values, default=None),
+            }
+        return stats
+
+    def percentiles(self, column: str = "score", p: list = [0.5]) -> list:
+        """ percentiles returns the requested percentiles (0-1) of a column, as values of the column (no interpolation,
+            so percentiles([0.5]) is the lower middle value of an even count, see median). $percentile needs MongoDB 7.0,
+            older servers and the in-memory backend fall back to computing it in Python """
+        if self.pipelines:
+            pipeline = [{"$group": {"_id": None, "values": {"$percentile": {
+                "input": f"${field_path(column)}", "p": p, "method": "approximate"}}}}]
+            try:
+                results = list(self.collection.aggregate(pipeline))
+                return results[0]["values"] if results else [None for _ in p]
+            except OperationFailure:
+                pass
+
+        # Same definition as MongoDB's approximate method: the smallest value with at least p of the values at or below it
+        values = sorted(self.__values(column))
+        if not values:
+            return [None for _ in p]
+        return [values[max(0, math.ceil(percentile * len(values)) - 1)] for percentile in p]
+
+    def median(self, column: str = "score"):
+        """ median returns the median of a column (the mean of the two middle values for an even count, as np.median),
+            or None if it has no values. Only the middle one or two values are read, in the same way on every backend """
+        path = field_path(column)
+        query = {path: {"$type": "number"}}
+        count = self.collection.count_documents(query)
+        if count == 0:
+            return None
+        middle = self.collection.find(query, {path: 1, "_id": 0}).sort(path, 1).skip((count - 1) // 2).limit(2 - count % 2)
+        values = [self.__number(document, path) for document in middle]
+        return sum(values) / len(values)
+
+    def summary(self, column: str = "score") -> dict:
+        """ summary returns mean, median and standard deviation of a column """
+        stats = self.category_stats([column])[column]
+        return {"mean": stats["mean"], "median": self.median(column), "std": stats["std"]}
@@ -0,0 +1,67 @@
+import pandas as pd
+from ScoreStore import CATEGORIES
+
+#####################################################################################
+# ScoreFrame.py
+# Author: Adi Bhan
+# This script holds every municipality's scores in one DataFrame and provides vectorized analytics over it
+###############################################################################################################
+
+SCORE_COLUMNS = ["score"] + CATEGORIES
+
+# Readable names for the score columns, used for graph labels
+COLUMN_LABELS = {
+    "score": "Overall Score",
+    "websiteSecurity": "Web Security",
+    "emailSecurity": "Email Security",
+    "networkSecurity": "Network Security",
+    "phishing": "Phishing",
+    "brandProtection": "Brand Protection",
+}
+
+
+class ScoreFrame:
+    """ ScoreFrame wraps a DataFrame indexed by municipality name with one column per score category
+        (see SCORE_COLUMNS) plus latitude and longitude. Every method works on whole columns at once """
+
+    def __init__(self, frame: pd.DataFrame):
+        self.frame = frame
+
+    @classmethod
+    def from_store(cls, store):
+        """ from_store builds a ScoreFrame from a ScoreStore. If two hostnames report the same name the newest snapshot is kept """
+        frame = store.load().sort_values("snapshot", kind="stable")
+        frame = frame.drop_duplicates("name", keep="last").set_index("name")
+        return cls(frame)
+
+    def __len__(self) -> int:
+        return len(self.frame)
+
+    def column(self, column: str) -> pd.Series:
+        """ column returns one score column """
+        return self.frame[column]
+
+    def sorted(self, column: str = "score", ascending: bool = True) -> pd.Series:
+        """ sorted returns a column sorted by value, keeping each value with its own municipality """
+        return self.frame[column].sort_values(ascending=ascending, kind="stable")
+
+    def top(self, column: str = "score", n: int = 15, ascending: bool = False) -> pd.Series:
+        """ top returns the n highest (or lowest, if ascending) municipalities for a column """
+        return self.sorted(column, ascending=ascending).head(n)
+
+    def rank(self, columns: list = None) -> pd.DataFrame:
+        """ rank returns each municipality's rank per column, 1 is the highest score """
+        return self.frame[columns or SCORE_COLUMNS].rank(ascending=False, method="min").astype(int)
+
+    def percentile(self, columns: list = None) -> pd.DataFrame:
+        """ percentile returns the percentage of municipalities scoring at or below each municipality, per column """
+        return self.frame[columns or SCORE_COLUMNS].rank(pct=True, method="max") * 100
+
+    def zscore(self, columns: list = None) -> pd.DataFrame:
+        """ zscore returns how many (population) standard deviations each score is from its column mean """
+        scores = self.frame[columns or SCORE_COLUMNS].astype(float)
+        return (scores - scores.mean()) / scores.std(ddof=0)
+
+    def aggregates(self, columns: list = None) -> pd.DataFrame:
+        """ aggregates returns count, mean, median, std, min and max for each column """
+        return self.frame[columns or SCORE_COLUMNS].agg(["count", "mean", "median", "std", "min", "max"])
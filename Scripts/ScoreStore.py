@@ -0,0 +1,123 @@
+import ast
+import contextlib
+import datetime
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+# fcntl is POSIX only, msvcrt locks the file on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+#####################################################################################
+# ScoreStore.py
+# Author: Adi Bhan
+# This script stores the latest UpGuard vendor scores for each municipality as a typed NumPy structured array
+###############################################################################################################
+
+CATEGORIES = ["websiteSecurity", "emailSecurity",
+              "networkSecurity", "phishing", "brandProtection"]
+
+SCORE_DTYPE = np.dtype([
+    ("hostname", "U64"),
+    ("name", "U64"),
+    ("score", "i4"),
+] + [(category, "i4") for category in CATEGORIES] + [
+    ("latitude", "f8"),
+    ("longitude", "f8"),
+    ("snapshot", "datetime64[s]"),
+])
+
+
+class ScoreStore:
+    """ ScoreStore keeps one row per municipality hostname, the most recent snapshot wins.
+        Rows are saved to a single .npy file which is read back in one call.
+        Upserts hold an exclusive lock on path + ".lock", so processes sharing the file never lose each other's rows """
+
+    def __init__(self, path: str, legacy_csv: str = None):
+        self.path = path
+        self.legacy_csv = legacy_csv
+        self.lock_path = path + ".lock"
+
+    @contextlib.contextmanager
+    def locked(self):
+        """ locked holds the store's file lock (blocking until other processes release it) for a read-merge-write """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        with open(self.lock_path, "a+b") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    @staticmethod
+    def to_row(data: dict, snapshot: np.datetime64) -> tuple:
+        """ to_row converts a vendor response (as stored by vendor_scores) into a row of SCORE_DTYPE """
+        category_scores = data.get("categoryScores", {})
+        return ((data.get("primary_hostname") or "", data.get("name") or "", data.get("score", 0))
+                + tuple(category_scores.get(category, 0) for category in CATEGORIES)
+                + (data.get("latitude", np.nan), data.get("longitude", np.nan), snapshot))
+
+    def read(self) -> np.ndarray:
+        """ read returns the stored rows as a structured array (empty if nothing is stored yet).
+            A legacy Muncipalities.csv file is imported the first time if no store exists """
+        if not os.path.exists(self.path):
+            if self.legacy_csv and os.path.exists(self.legacy_csv):
+                return self.import_legacy_csv(self.legacy_csv)
+            return np.empty(0, dtype=SCORE_DTYPE)
+        return np.load(self.path, allow_pickle=False)
+
+    def load(self) -> pd.DataFrame:
+        """ load returns the stored scores as a DataFrame with typed columns """
+        return pd.DataFrame(self.read())
+
+    def upsert(self, records: list, snapshot: datetime.datetime = None) -> np.ndarray:
+        """ upsert inserts or replaces the rows for the hostnames in records and saves the store.
+            Records are vendor responses, later records win over earlier ones with the same hostname """
+        snapshot = np.datetime64(
+            snapshot or datetime.datetime.now(), "s")
+        incoming = np.array([self.to_row(data, snapshot)
+                            for data in records], dtype=SCORE_DTYPE)
+        with self.locked():
+            return self.__merge(self.read(), incoming)
+
+    def import_legacy_csv(self, csv_path: str) -> np.ndarray:
+        """ import_legacy_csv reads the old one-dict-per-line Muncipalities.csv format into the store.
+            Repeated appends for the same hostname collapse into a single row (the last one) """
+        snapshot = np.datetime64(datetime.datetime.fromtimestamp(
+            os.path.getmtime(csv_path)), "s")
+        with open(csv_path, "r") as file:
+            rows = [self.to_row(ast.literal_eval(line), snapshot)
+                    for line in file if line.strip()]
+        return self.__merge(np.empty(0, dtype=SCORE_DTYPE), np.array(rows, dtype=SCORE_DTYPE))
+
+    def __merge(self, existing: np.ndarray, incoming: np.ndarray) -> np.ndarray:
+        """ Keeps the last row per hostname out of existing + incoming, then writes the result to disk
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        combined = np.concatenate([existing, incoming])
+        # np.unique returns the first occurrence, so search the reversed array to keep the last one
+        _, last = np.unique(combined["hostname"][::-1], return_index=True)
+        merged = combined[::-1][np.sort(last)][::-1]
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        # A temporary file per process and thread, so a writer never replaces another writer's half written file
+        temp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp.npy"
+        np.save(temp_path, merged, allow_pickle=False)
+        os.replace(temp_path, self.path)
+        return merged
@@ -0,0 +1,310 @@
+import os
+import sqlite3
+import threading
+import time
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+#####################################################################################
+# WorkQueue.py
+# Author: Adi Bhan
+# This script keeps a queue of municipality fetch jobs that many worker processes (or hosts) claim with expiring leases,
+# backed by SQLite on one machine or by a MongoDB collection across machines. See Worker.py for the workers
+###############################################################################################################
+
+# A job is one collector ("scores", "vulnerabilities", "risks", "remediation") for one municipality. Its status is
+#   queued   waiting for a worker
+#   leased   claimed by a worker until lease_expires; a worker that stops heartbeating loses it and the job is claimed again
+#   done     fetched and stored
+#   failed   failed max_attempts times, enqueue it again to retry
+QUEUED, LEASED, DONE, FAILED = "queued", "leased", "done", "failed"
+
+
+def job_id(collector: str, name: str) -> str:
+    """ job_id returns the id of a collector's job for a municipality, the same form Dead_Letters uses """
+    return f"{collector}|{name}"
+
+
+class SQLiteWorkQueue:
+    """ SQLiteWorkQueue stores jobs in a SQLite file. Claims run in an IMMEDIATE transaction, so worker processes
+        on the same machine never claim the same job. SQLite locking is not reliable on network drives,
+        use MongoWorkQueue for workers on several hosts """
+
+    COLUMNS = ["id", "collector", "name", "hostname", "status", "attempts", "owner", "lease_expires",
+               "enqueued_at", "updated_at", "error"]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # isolation_level=None leaves transactions to BEGIN/COMMIT below
+        self.connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, collector TEXT NOT NULL, name TEXT NOT NULL, "
+            "hostname TEXT, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, owner TEXT, lease_expires REAL, "
+            "enqueued_at REAL NOT NULL, updated_at REAL NOT NULL, error TEXT)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, enqueued_at)")
+
+    def __transaction(self, statements):
+        """ Runs statements(cursor) in an IMMEDIATE transaction (the write lock is taken up front) and returns its result
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(cursor)
+                cursor.execute("COMMIT")
+                return result
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, collector: str, municipalities: dict) -> int:
+        """ enqueue queues a collector's job for every {name: hostname}. Done and failed jobs are queued again,
+            jobs that are queued or leased are left alone. Returns the number of jobs queued """
+        now = time.time()
+
+        def statements(cursor):
+            queued = 0
+            for name, hostname in municipalities.items():
+                cursor.execute(
+                    "INSERT INTO jobs (id, collector, name, hostname, status, attempts, enqueued_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, 0, ?, ?) ON CONFLICT(id) DO UPDATE SET hostname = excluded.hostname, "
+                    "status = excluded.status, attempts = 0, owner = NULL, lease_expires = NULL, error = NULL, "
+                    "enqueued_at = excluded.enqueued_at, updated_at = excluded.updated_at WHERE status IN (?, ?)",
+                    (job_id(collector, name), collector, name, hostname, QUEUED, now, now, DONE, FAILED))
+                queued += cursor.rowcount
+            return queued
+        return self.__transaction(statements)
+
+    def claim(self, worker: str, lease_seconds: float, limit: int = 1, collectors: list = None) -> list:
+        """ claim leases up to limit jobs of one collector (the one with the oldest claimable job) to worker.
+            Queued jobs and jobs whose lease has expired can be claimed. Returns the jobs as dictionaries """
+        now = time.time()
+        collectors = list(collectors or [])
+
+        def statements(cursor):
+            where = "(status = ? OR (status = ? AND lease_expires < ?))"
+            params = [QUEUED, LEASED, now]
+            if collectors:
+                where += f" AND collector IN ({', '.join('?' for _ in collectors)})"
+                params += collectors
+            first = cursor.execute(f"SELECT collector FROM jobs WHERE {where} ORDER BY enqueued_at LIMIT 1",
+                                   params).fetchone()
+            if first is None:
+                return []
+            rows = cursor.execute(f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE {where} AND collector = ? "
+                                  f"ORDER BY enqueued_at LIMIT ?", params + [first[0], max(1, limit)]).fetchall()
+            jobs = [dict(zip(self.COLUMNS, row)) for row in rows]
+            for job in jobs:
+                job.update(status=LEASED, owner=worker, lease_expires=now + lease_seconds,
+                           attempts=job["attempts"] + 1, updated_at=now)
+                cursor.execute("UPDATE jobs SET status = ?, owner = ?, lease_expires = ?, attempts = ?, updated_at = ? "
+                               "WHERE id = ?", (LEASED, worker, job["lease_expires"], job["attempts"], now, job["id"]))
+            return jobs
+        return self.__transaction(statements)
+
+    def heartbeat(self, worker: str, keys: list, lease_seconds: float) -> list:
+        """ heartbeat extends the leases worker still holds and returns their job ids.
+            A job missing from the result was re-claimed by another worker after its lease expired """
+        now = time.time()
+
+        def statements(cursor):
+            held = []
+            for key in keys:
+                cursor.execute("UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE id = ? AND owner = ? AND status = ?",
+                               (now + lease_seconds, now, key, worker, LEASED))
+                if cursor.rowcount:
+                    held.append(key)
+            return held
+        return self.__transaction(statements)
+
+    def complete(self, worker: str, key: str) -> bool:
+        """ complete marks a job worker holds as done. Returns False if the lease was lost """
+        def statements(cursor):
+            cursor.execute("UPDATE jobs SET status = ?, owner = NULL, lease_expires = NULL, error = NULL, updated_at = ? "
+                           "WHERE id = ? AND owner = ? AND status = ?", (DONE, time.time(), key, worker, LEASED))
+            return cursor.rowcount == 1
+        return self.__transaction(statements)
+
+    def fail(self, worker: str, key: str, error: str, max_attempts: int) -> bool:
+        """ fail puts a job worker holds back in the queue, or marks it failed after max_attempts attempts.
+            Returns False if the lease was lost """
+        def statements(cursor):
+            cursor.execute("UPDATE jobs SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, owner = NULL, "
+                           "lease_expires = NULL, error = ?, updated_at = ? WHERE id = ? AND owner = ? AND status = ?",
+                           (max_attempts, FAILED, QUEUED, error, time.time(), key, worker, LEASED))
+            return cursor.rowcount == 1
+        return self.__transaction(statements)
+
+    def requeue_expired(self) -> int:
+        """ requeue_expired puts every job whose lease has expired back in the queue and returns how many.
+            claim already takes expired jobs, this is for inspecting or resetting the queue by hand """
+        def statements(cursor):
+            now = time.time()
+            cursor.execute("UPDATE jobs SET status = ?, owner = NULL, lease_expires = NULL, updated_at = ? "
+                           "WHERE status = ? AND lease_expires < ?", (QUEUED, now, LEASED, now))
+            return cursor.rowcount
+        return self.__transaction(statements)
+
+    def stats(self) -> dict:
+        """ stats returns {collector: {status: count}} """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT collector, status, COUNT(*) FROM jobs GROUP BY collector, status").fetchall()
+        counts = {}
+        for collector, status, count in rows:
+            counts.setdefault(collector, {})[status] = count
+        return counts
+
+    def failed(self) -> list:
+        """ failed returns the jobs that failed max_attempts times, with their last error """
+        with self.lock:
+            rows = self.connection.execute(f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE status = ? "
+                                           f"ORDER BY collector, name", (FAILED,)).fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+    def clear(self, collector: str = None) -> int:
+        """ clear removes every job (or those of one collector) and returns how many were removed """
+        def statements(cursor):
+            if collector is None:
+                cursor.execute("DELETE FROM jobs")
+            else:
+                cursor.execute("DELETE FROM jobs WHERE collector = ?", (collector,))
+            return cursor.rowcount
+        return self.__transaction(statements)
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class MongoWorkQueue:
+    """ MongoWorkQueue stores jobs in a MongoDB collection (Work_Queue), so workers on any number of hosts can share it.
+        Every claim is a single find_one_and_update, which MongoDB applies atomically, so a job is never leased twice """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.collection.create_index([("status", 1), ("enqueued_at", 1)])
+        self.collection.create_index([("collector", 1), ("status", 1)])
+
+    def enqueue(self, collector: str, municipalities: dict) -> int:
+        """ enqueue queues a collector's job for every {name: hostname}. Done and failed jobs are queued again,
+            jobs that are queued or leased are left alone. Returns the number of jobs queued """
+        now = time.time()
+        queued = 0
+        for name, hostname in municipalities.items():
+            key = job_id(collector, name)
+            reset = {"hostname": hostname, "status": QUEUED, "attempts": 0, "owner": None, "lease_expires": None,
+                     "error": None, "enqueued_at": now, "updated_at": now}
+            if self.collection.update_one({"_id": key, "status": {"$in": [DONE, FAILED]}}, {"$set": reset}).modified_count:
+                queued += 1
+                continue
+            try:
+                self.collection.insert_one(dict(reset, _id=key, collector=collector, name=name))
+                queued += 1
+            except DuplicateKeyError:
+                pass  # already queued or leased
+        return queued
+
+    @staticmethod
+    def __job(document: dict) -> dict:
+        """ Returns a job document in the same form as SQLiteWorkQueue
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        job = dict(document)
+        job["id"] = job.pop("_id")
+        return job
+
+    def claim(self, worker: str, lease_seconds: float, limit: int = 1, collectors: list = None) -> list:
+        """ claim leases up to limit jobs of one collector (the one with the oldest claimable job) to worker.
+            Queued jobs and jobs whose lease has expired can be claimed. Returns the jobs as dictionaries """
+        jobs = []
+        while len(jobs) < max(1, limit):
+            now = time.time()
+            query = {"$or": [{"status": QUEUED}, {"status": LEASED, "lease_expires": {"$lt": now}}]}
+            if jobs:
+                query["collector"] = jobs[0]["collector"]
+            elif collectors:
+                query["collector"] = {"$in": list(collectors)}
+            document = self.collection.find_one_and_update(
+                query, {"$set": {"status": LEASED, "owner": worker, "lease_expires": now + lease_seconds,
+                                 "updated_at": now}, "$inc": {"attempts": 1}},
+                sort=[("enqueued_at", 1)], return_document=ReturnDocument.AFTER)
+            if document is None:
+                break
+            jobs.append(self.__job(document))
+        return jobs
+
+    def heartbeat(self, worker: str, keys: list, lease_seconds: float) -> list:
+        """ heartbeat extends the leases worker still holds and returns their job ids.
+            A job missing from the result was re-claimed by another worker after its lease expired """
+        now = time.time()
+        held = []
+        for key in keys:
+            if self.collection.update_one({"_id": key, "owner": worker, "status": LEASED}, {
+                    "$set": {"lease_expires": now + lease_seconds, "updated_at": now}}).matched_count:
+                held.append(key)
+        return held
+
+    def complete(self, worker: str, key: str) -> bool:
+        """ complete marks a job worker holds as done. Returns False if the lease was lost """
+        return self.collection.update_one({"_id": key, "owner": worker, "status": LEASED}, {"$set": {
+            "status": DONE, "owner": None, "lease_expires": None, "error": None,
+            "updated_at": time.time()}}).matched_count == 1
+
+    def fail(self, worker: str, key: str, error: str, max_attempts: int) -> bool:
+        """ fail puts a job worker holds back in the queue, or marks it failed after max_attempts attempts.
+            Returns False if the lease was lost """
+        document = self.collection.find_one({"_id": key, "owner": worker, "status": LEASED}, {"attempts": 1})
+        if document is None:
+            return False
+        status = FAILED if document.get("attempts", 0) >= max_attempts else QUEUED
+        return self.collection.update_one({"_id": key, "owner": worker, "status": LEASED}, {"$set": {
+            "status": status, "owner": None, "lease_expires": None, "error": error,
+            "updated_at": time.time()}}).matched_count == 1
+
+    def requeue_expired(self) -> int:
+        """ requeue_expired puts every job whose lease has expired back in the queue and returns how many.
+            claim already takes expired jobs, this is for inspecting or resetting the queue by hand """
+        now = time.time()
+        return self.collection.update_many({"status": LEASED, "lease_expires": {"$lt": now}}, {"$set": {
+            "status": QUEUED, "owner": None, "lease_expires": None, "updated_at": now}}).modified_count
+
+    def stats(self) -> dict:
+        """ stats returns {collector: {status: count}} """
+        counts = {}
+        for document in self.collection.find({}, {"collector": 1, "status": 1}):
+            collector = counts.setdefault(document["collector"], {})
+            collector[document["status"]] = collector.get(document["status"], 0) + 1
+        return counts
+
+    def failed(self) -> list:
+        """ failed returns the jobs that failed max_attempts times, with their last error """
+        return [self.__job(document) for document in self.collection.find(
+            {"status": FAILED}).sort([("collector", 1), ("name", 1)])]
+
+    def clear(self, collector: str = None) -> int:
+        """ clear removes every job (or those of one collector) and returns how many were removed """
+        return self.collection.delete_many({} if collector is None else {"collector": collector}).deleted_count
+
+    def close(self) -> None:
+        pass
+
+
+def open_work_queue(connection=None):
+    """ open_work_queue returns the queue selected by WORK_QUEUE: "sqlite" (default, WORK_QUEUE_PATH or
+        data/work_queue.sqlite) for workers on this machine, or "mongodb" (the Work_Queue collection) for several hosts.
+        connection is the MongoConnection to use for "mongodb", by default the process-wide one """
+    backend = os.getenv("WORK_QUEUE", "sqlite").lower()
+    if backend == "mongodb":
+        from MongoConnection import MongoConnection
+        connection = connection if connection is not None else MongoConnection.shared()
+        return MongoWorkQueue(connection.collection("Work_Queue"))
+    if backend != "sqlite":
+        raise ValueError(f"Unknown WORK_QUEUE {backend}, use sqlite or mongodb")
+    return SQLiteWorkQueue(os.getenv("WORK_QUEUE_PATH") or os.path.join(os.getcwd(), "data", "work_queue.sqlite"))
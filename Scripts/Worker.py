@@ -0,0 +1,211 @@
+import argparse
+import os
+import socket
+import sys
+import threading
+from FetchData import FetchData
+from MunicipalityRegistry import load_registry, hostnames
+from WorkQueue import open_work_queue
+
+#####################################################################################
+# Worker.py
+# Author: Adi Bhan
+# This script fills the work queue with municipality fetch jobs and runs workers that claim them in batches,
+# so the collectors can be spread over many processes and hosts (see WorkQueue.py)
+#
+# Usage (from the repository root):
+#   python Scripts/Worker.py enqueue [--collectors scores risks] [--state Massachusetts]
+#   python Scripts/Worker.py work [--batch 10] [--exit-when-empty]      (start as many as needed, on any host)
+#   python Scripts/Worker.py status
+#   python Scripts/Worker.py sync-scores      (copy the scores the workers stored in MongoDB into the local score store)
+###############################################################################################################
+
+COLLECTORS = ["scores", "vulnerabilities", "risks", "remediation"]
+
+# The job field each collector is called with: remediation works on hostnames, the others on municipality names
+JOB_FIELDS = {"remediation": "hostname"}
+
+
+class Worker:
+    """ Worker claims batches of jobs of one collector from the work queue and runs the collector for just those
+        municipalities. While a batch runs its leases are extended every lease_seconds / 3 seconds by a heartbeat thread;
+        if the worker dies the leases expire and other workers claim the jobs again.
+        Municipalities that end up on the collector's dead letter list are failed (and retried up to max_attempts times).
+        Scores are only stored in MongoDB, the local score store is rebuilt from it by the graphs stage (or sync-scores) """
+
+    def __init__(self, queue, worker_id: str = None, collectors: list = None, batch_size: int = 10,
+                 lease_seconds: float = 300.0, max_attempts: int = 3, connection=None):
+        self.queue = queue
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.collectors = list(collectors or COLLECTORS)
+        self.batch_size = max(1, batch_size)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(1, max_attempts)
+        self.connection = connection
+        self.held = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.__fetcher = None
+
+    @property
+    def fetcher(self) -> FetchData:
+        """ The collector instance, a Remediation if this worker takes remediation jobs (created on first use) """
+        if self.__fetcher is None:
+            if "remediation" in self.collectors:
+                from Remediation import Remediation
+                self.__fetcher = Remediation([], connection=self.connection, run=False)
+            else:
+                self.__fetcher = FetchData(self.connection)
+            # Many workers (on many hosts) would otherwise each write a partial Muncipalities.npy
+            self.__fetcher.store_scores_locally = False
+            # Workers only add to the risk rollups, the enqueue step rebuilds them when they are empty
+            self.__fetcher.rebuild_empty_rollups = False
+        return self.__fetcher
+
+    def __heartbeat(self) -> None:
+        """ Extends the leases of the running batch until the worker stops
+            ** HELPER METHOD, DO NOT CALL DIRECTLY ** """
+        while not self.stopped.wait(self.lease_seconds / 3):
+            with self.lock:
+                held = list(self.held)
+            if not held:
+                continue
+            try:
+                lost = set(held) - set(self.queue.heartbeat(self.worker_id, held, self.lease_seconds))
+                if lost:
+                    print(f"{self.worker_id}: lost the lease of {sorted(lost)}, another worker has them now")
+            except Exception as e:
+                print(f"Error with heartbeating the work queue: {e}")
+
+    def run_batch(self) -> int:
+        """ run_batch claims and runs one batch of jobs. Returns the number of jobs claimed (0 if the queue is empty) """
+        jobs = self.queue.claim(self.worker_id, self.lease_seconds, self.batch_size, self.collectors)
+        if not jobs:
+            return 0
+
+        collector = jobs[0]["collector"]
+        field = JOB_FIELDS.get(collector, "name")
+        fetcher = self.fetcher
+        # Jobs carry their hostname, so workers do not need the same registry file as the host that queued them
+        fetcher.muncipalities.update({job["name"]: job["hostname"] for job in jobs})
+        with self.lock:
+            self.held = [job["id"] for job in jobs]
+        print(f"{self.worker_id}: {collector} for {len(jobs)} municipalities")
+
+        try:
+            with fetcher.metrics.timed("work_queue_batch_seconds", collector=collector):
+                fetcher.collectors()[collector]([job[field] for job in jobs])
+            failed, error = set(fetcher.dead_letters().get(collector, [])), "failed, see Dead_Letters"
+        except Exception as e:
+            failed, error = {job[field] for job in jobs}, repr(e)
+        finally:
+            with self.lock:
+                self.held = []
+
+        for job in jobs:
+            if job[field] in failed:
+                status, kept = "failed", self.queue.fail(self.worker_id, job["id"], error, self.max_attempts)
+            else:
+                status, kept = "done", self.queue.complete(self.worker_id, job["id"])
+            if not kept:
+                print(f"{self.worker_id}: lease of {job['id']} expired before it finished, it will run again")
+            fetcher.metrics.inc("work_queue_jobs_total", collector=collector, status=status)
+        return len(jobs)
+
+    def run(self, exit_when_empty: bool = False, poll_seconds: float = 10.0, max_jobs: int = None) -> int:
+        """ run works through the queue until it is empty (exit_when_empty), max_jobs jobs were claimed, or forever,
+            checking an empty queue every poll_seconds. Returns the number of jobs claimed """
+        heartbeat = threading.Thread(target=self.__heartbeat, daemon=True)
+        heartbeat.start()
+        claimed = 0
+        try:
+            while max_jobs is None or claimed < max_jobs:
+                count = self.run_batch()
+                claimed += count
+                if count == 0:
+                    if exit_when_empty:
+                        break
+                    if self.stopped.wait(poll_seconds):
+                        break
+        finally:
+            self.stopped.set()
+            heartbeat.join()
+            if self.__fetcher is not None:
+                self.__fetcher.metrics.save()
+        print(f"{self.worker_id}: finished after {claimed} jobs")
+        return claimed
+
+
+def print_status(queue) -> None:
+    """ print_status prints the number of jobs per collector and status, and every job that failed for good """
+    print("--------------------------------------------------------------------")
+    print(f"{'collector':16} {'queued':>8} {'leased':>8} {'done':>8} {'failed':>8}")
+    for collector, counts in sorted(queue.stats().items()):
+        print(f"{collector:16} " + " ".join(f"{counts.get(status, 0):8}" for status in ("queued", "leased", "done", "failed")))
+    print("--------------------------------------------------------------------")
+    for job in queue.failed():
+        print(f"{job['id']}: {job['error']}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Queue municipality fetch jobs and run workers that process them")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = subparsers.add_parser(
+        "enqueue", help="Queue a job per municipality in the registry for each collector")
+    enqueue_parser.add_argument("--collectors", nargs="+", choices=COLLECTORS, default=COLLECTORS)
+    enqueue_parser.add_argument("--names", nargs="+", help="Only these municipalities")
+    enqueue_parser.add_argument("--state", help="Only the municipalities of one state")
+
+    work_parser = subparsers.add_parser(
+        "work", help="Claim and run jobs until stopped")
+    work_parser.add_argument("--collectors", nargs="+", choices=COLLECTORS, default=COLLECTORS,
+                             help="Only take jobs of these collectors")
+    work_parser.add_argument("--batch", type=int, default=int(os.getenv("WORKER_BATCH_SIZE", 10)),
+                             help="Jobs claimed at a time")
+    work_parser.add_argument("--lease", type=float, default=float(os.getenv("WORKER_LEASE_SECONDS", 300)),
+                             help="Seconds a claimed job stays leased without a heartbeat")
+    work_parser.add_argument("--max-attempts", type=int, default=int(os.getenv("WORKER_MAX_ATTEMPTS", 3)),
+                             help="Attempts before a job is marked failed")
+    work_parser.add_argument("--poll", type=float, default=10.0,
+                             help="Seconds between checks of an empty queue")
+    work_parser.add_argument("--exit-when-empty", action="store_true",
+                             help="Stop once the queue is empty instead of waiting for more jobs")
+    work_parser.add_argument("--id", help="Worker id (default hostname-pid)")
+
+    subparsers.add_parser("status", help="Print the jobs per collector and status")
+    subparsers.add_parser("requeue", help="Put every job whose lease expired back in the queue")
+    subparsers.add_parser("sync-scores", help="Copy the scores stored in MongoDB into the local score store")
+    clear_parser = subparsers.add_parser("clear", help="Remove jobs from the queue")
+    clear_parser.add_argument("--collector", choices=COLLECTORS)
+    args = parser.parse_args()
+
+    queue = open_work_queue()
+    if args.command == "enqueue":
+        registry = [municipality for municipality in load_registry()
+                    if (args.names is None or municipality.name in args.names)
+                    and (args.state is None or municipality.state == args.state)]
+        if "risks" in args.collectors:
+            # Rebuilt here, once, so workers running at the same time never delete each other's rollup increments
+            FetchData().prepare_risk_rollups()
+        for collector in args.collectors:
+            jobs = hostnames(registry)
+            print(f"Queued {queue.enqueue(collector, jobs)} of {len(jobs)} {collector} jobs")
+    elif args.command == "work":
+        worker = Worker(queue, args.id, args.collectors, args.batch, args.lease, args.max_attempts)
+        try:
+            worker.run(exit_when_empty=args.exit_when_empty, poll_seconds=args.poll)
+        except KeyboardInterrupt:
+            # The leases of the running batch expire and other workers take the jobs over
+            sys.exit(130)
+    elif args.command == "status":
+        print_status(queue)
+    elif args.command == "sync-scores":
+        FetchData().sync_score_store()
+    elif args.command == "requeue":
+        print(f"Requeued {queue.requeue_expired()} jobs with an expired lease")
+    else:
+        print(f"Removed {queue.clear(args.collector)} jobs")
+    queue.close()
@@ -0,0 +1,412 @@
+import argparse
+import contextlib
+import csv
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+#####################################################################################
+# bench.py
+# Author: Adi Bhan
+# This script times the hot paths of the project (collectors, analytics, graphs and PDF reports) on synthetic
+# datasets of 75, 350 and 5,000 municipalities. HTTP is served by Replay.ReplayServer and MongoDB by the in-memory backend,
+# so nothing leaves the machine. Results are saved as JSON so runs can be compared with `bench.py compare`
+#
+# Usage (from the repository root):
+#   python benchmarks/bench.py run [--sizes 75 350] [--only graph.] [--repeat 3]
+#   python benchmarks/bench.py compare benchmarks/results/OLD.json benchmarks/results/NEW.json
+###############################################################################################################
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "Scripts"))
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+SIZES = [75, 350, 5000]
+CATEGORIES = ["websiteSecurity", "emailSecurity",
+              "networkSecurity", "phishing", "brandProtection"]
+SEVERITIES = ["info", "low", "medium", "high", "critical"]
+
+# name -> function(workspace, timer), filled in by @benchmark
+BENCHMARKS = {}
+
+
+def benchmark(name: str):
+    """ benchmark registers a function that sets up its own state and times the hot part with `with timer:` """
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+class Timer:
+    """ Timer collects one sample per `with timer:` block """
+
+    def __init__(self):
+        self.samples = []
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.samples.append(time.perf_counter() - self.start)
+        return False
+
+
+class Workspace:
+    """ Workspace holds one synthetic dataset: municipalities, UpGuard fixtures served by a ReplayServer,
+        a gazetteer and a working directory (data/, graphs/, Remediation/) that the project classes write into """
+
+    def __init__(self, size: int, seed: int = 0):
+        self.size = size
+        self.random = random.Random(seed)
+        self.directory = tempfile.mkdtemp(prefix=f"mapc-bench-{size}-")
+        self.municipalities = {f"Town {index:04d}": f"town{index:04d}.example.gov"
+                               for index in range(size)}
+        self.previous_directory = os.getcwd()
+        self.server = None
+
+    def __enter__(self):
+        from Replay import ReplayServer
+        self.write_fixtures()
+        self.server = ReplayServer(os.path.join(
+            self.directory, "fixtures"), port=0)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+        os.environ.update({
+            "UPGUARD_API_ROOT": self.server.api_root,
+            "UPGUARD_RATE_LIMIT": "0",
+            "UPGUARD_CONCURRENCY": "16",
+            "UPGUARD_CACHE": "off",
+            "GEOCODE_GAZETTEER": os.path.join(self.directory, "gazetteer.csv"),
+            "RENDER_FORCE": "1",
+            "REPORT_FORCE": "1",
+            # Metrics.shared() lives as long as the process, its files would end up in the first workspace
+            "METRICS": "off",
+        })
+        os.chdir(self.directory)
+        self.seed = self.connection()
+        with quiet():
+            self.populate(self.seed)
+        return self
+
+    def __exit__(self, *exc):
+        os.chdir(self.previous_directory)
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        return False
+
+    def write_fixtures(self) -> None:
+        """ write_fixtures writes one recording per host and endpoint, in the format FixtureRecorder uses """
+        from Replay import fixture_name
+        fixtures = os.path.join(self.directory, "fixtures")
+        findings = [{"id": f"finding_{index}", "finding": f"Finding {index}", "risk": f"Why finding {index} is risky. " * 8,
+                     "description": f"How to fix finding {index}. " * 12} for index in range(40)]
+        bodies = {"vendor": {}, "vulnerabilities_vendor": {},
+                  "risks": {}, "risks_vendors": {}}
+        for name, hostname in self.municipalities.items():
+            bodies["vendor"][hostname] = {"name": name, "primary_hostname": hostname,
+                                          "score": self.random.randint(300, 950),
+                                          "categoryScores": {category: self.random.randint(300, 950) for category in CATEGORIES}}
+            bodies["vulnerabilities_vendor"][hostname] = {"vulnerabilities": [
+                {"cve": {"id": f"CVE-2023-{self.random.randint(1000, 1200)}", "severity": self.random.choice(SEVERITIES),
+                         "description": "Synthetic vulnerability description"}} for _ in range(self.random.randint(0, 15))]}
+            bodies["risks"][hostname] = {"risks": [
+                {"risk": f"risk_{self.random.randint(0, 60)}", "riskSubtype": "synthetic", "category": self.random.choice(CATEGORIES),
+                 "severity": self.random.choice(SEVERITIES), "description": "Synthetic risk",
+                 "firstDetected": f"{self.random.choice([2022, 2023, 2024])}-{self.random.randint(1, 12):02d}-{self.random.randint(1, 28):02d}T00:00:00Z"}
+                for _ in range(self.random.randint(5, 30))]}
+            bodies["risks_vendors"][hostname] = {"risks": [dict(finding, hostnames=[hostname])
+                                                           for finding in self.random.sample(findings, self.random.randint(3, 10))]}
+
+        for endpoint, hosts in bodies.items():
+            os.makedirs(os.path.join(fixtures, endpoint))
+            for hostname, body in hosts.items():
+                with open(os.path.join(fixtures, endpoint, fixture_name(hostname)), "w") as file:
+                    json.dump({"status": 200, "body": body}, file)
+
+        with open(os.path.join(self.directory, "gazetteer.csv"), "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["name", "latitude", "longitude"])
+            for name in self.municipalities:
+                writer.writerow([name, 42 + self.random.random(),
+                                 -71 - self.random.random()])
+
+    def connection(self):
+        """ connection returns a new, empty in-memory MongoDB """
+        from MongoConnection import MongoConnection
+        return MongoConnection(backend="memory")
+
+    def fetch_data(self, connection=None):
+        from FetchData import FetchData
+        fetcher = FetchData(connection or self.connection())
+        fetcher.muncipalities = dict(self.municipalities)
+        return fetcher
+
+    def remediation(self, connection=None):
+        from Remediation import Remediation
+        remediation = Remediation(list(self.municipalities.values()),
+                                  connection=connection or self.connection(), run=False)
+        remediation.muncipalities = dict(self.municipalities)
+        return remediation
+
+    def graph_generator(self):
+        from Graph import GraphGenerator
+        generator = GraphGenerator(self.seed)
+        generator.muncipalities = dict(self.municipalities)
+        return generator
+
+    def populate(self, connection) -> None:
+        """ populate runs every collector once so the analytics, graph and report benchmarks have data """
+        fetcher = self.fetch_data(connection)
+        fetcher.vendor_scores()
+        fetcher.fetch_vulnerabilities()
+        fetcher.risk_timeseries()
+        self.remediation(connection).fetch_and_store(
+            list(self.municipalities.values()))
+
+
+@contextlib.contextmanager
+def quiet():
+    """ quiet hides the progress output of the project classes while benchmarking """
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+# Collectors
+
+@benchmark("fetch.vendor_scores")
+def bench_vendor_scores(workspace, timer):
+    fetcher = workspace.fetch_data()
+    with timer:
+        fetcher.vendor_scores()
+
+
+@benchmark("fetch.vulnerabilities")
+def bench_vulnerabilities(workspace, timer):
+    fetcher = workspace.fetch_data()
+    with timer:
+        fetcher.fetch_vulnerabilities()
+
+
+@benchmark("fetch.risk_timeseries")
+def bench_risk_timeseries(workspace, timer):
+    fetcher = workspace.fetch_data()
+    with timer:
+        fetcher.risk_timeseries()
+
+
+@benchmark("fetch.remediation")
+def bench_remediation_fetch(workspace, timer):
+    remediation = workspace.remediation()
+    with timer:
+        remediation.fetch_and_store(remediation.IPS)
+
+
+# Analytics
+
+@benchmark("analytics.summary")
+def bench_summary(workspace, timer):
+    generator = workspace.graph_generator()
+    with timer:
+        generator.analytics.summary("score")
+        generator.analytics.top_scores(15, "score")
+
+
+@benchmark("analytics.challenge_counter")
+def bench_challenge_counter(workspace, timer):
+    from ChallengeCounter import ChallengeCounter
+    generator = workspace.graph_generator()
+    with timer:
+        ChallengeCounter.from_collection(
+            generator.collection_vulnerabilities).top(15)
+
+
+# Graphs
+
+@benchmark("graph.read_file")
+def bench_read_file(workspace, timer):
+    generator = workspace.graph_generator()
+    with timer:
+        generator.read_file()
+
+
+@benchmark("graph.sort_dictionaries")
+def bench_sort_dictionaries(workspace, timer):
+    generator = workspace.graph_generator()
+    scores = generator.scores.column("score").to_dict()
+    with timer:
+        generator.sort_dictionaries(scores)
+
+
+@benchmark("graph.create_graphs")
+def bench_create_graphs(workspace, timer):
+    generator = workspace.graph_generator()
+    with timer:
+        generator.create_graphs("score", "Municipalities", "General Scores",
+                                "general_map.png", "Scores across all municipalities")
+
+
+@benchmark("graph.create_stacked_bar_graph")
+def bench_create_stacked_bar_graph(workspace, timer):
+    generator = workspace.graph_generator()
+    with timer:
+        generator.create_stacked_bar_graph("Municipalities", "Scores", "stacked_bar_graph.png",
+                                           "Category scores across all municipalities")
+
+
+@benchmark("graph.create_histogram")
+def bench_create_histogram(workspace, timer):
+    generator = workspace.graph_generator()
+    with timer:
+        generator.create_histogram("score", "Score", "Municipalities", "histogram.png",
+                                   "Distribution of scores across all municipalities")
+
+
+@benchmark("graph.create_challenge_frequency_graph")
+def bench_create_challenge_frequency_graph(workspace, timer):
+    from ChallengeCounter import ChallengeCounter
+    generator = workspace.graph_generator()
+    with timer:
+        generator.create_challenge_frequency_graph(ChallengeCounter.from_collection(generator.collection_vulnerabilities),
+                                                   "Frequency", "Vulnerability", "challenge_frequency_graph.png",
+                                                   "Most common vulnerabilities")
+
+
+@benchmark("graph.create_score_map")
+def bench_create_score_map(workspace, timer):
+    generator = workspace.graph_generator()
+    with timer:
+        generator.create_score_map("score", "overall_security_map.png",
+                                   "Overall security score by location")
+
+
+@benchmark("graph.create_risk_timeseries_graph")
+def bench_create_risk_timeseries_graph(workspace, timer):
+    generator = workspace.graph_generator()
+    with timer:
+        generator.create_risk_timeseries_graph("Month", "Risks", "risks_timeseries.png",
+                                               "Risks detected per month by severity")
+
+
+# Reports
+
+@benchmark("report.generate_report")
+def bench_generate_report(workspace, timer):
+    remediation = workspace.remediation(workspace.seed)
+    with timer:
+        remediation.generate_report(remediation.IPS[0])
+
+
+@benchmark("report.generate_reports")
+def bench_generate_reports(workspace, timer):
+    remediation = workspace.remediation(workspace.seed)
+    with timer:
+        remediation.generate_reports(remediation.IPS)
+
+
+def commit() -> str:
+    """ commit returns the current git commit, or "unknown" outside a git checkout """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(sizes: list, only: list, repeat: int, output: str = None) -> str:
+    """ run times every selected benchmark at every size and writes the results file. Returns its path """
+    names = [name for name in BENCHMARKS if not only or any(
+        name.startswith(prefix) for prefix in only)]
+    results = []
+    for size in sizes:
+        print(f"Preparing {size} municipalities")
+        with Workspace(size) as workspace:
+            for name in names:
+                timer = Timer()
+                try:
+                    with quiet():
+                        for _ in range(repeat):
+                            BENCHMARKS[name](workspace, timer)
+                except Exception as e:
+                    print(f"{name:40} {size:>6}  failed: {e!r}")
+                    results.append({"benchmark": name, "size": size, "error": repr(e)})
+                    continue
+                result = {"benchmark": name, "size": size, "repeat": repeat, "samples": timer.samples,
+                          "min": min(timer.samples), "median": statistics.median(timer.samples),
+                          "mean": statistics.mean(timer.samples)}
+                results.append(result)
+                print(f"{name:40} {size:>6}  min {result['min']:9.4f}s  median {result['median']:9.4f}s")
+
+    started = datetime.datetime.now()
+    report = {"date": started.isoformat(timespec="seconds"), "commit": commit(), "python": platform.python_version(),
+              "platform": platform.platform(), "cpus": os.cpu_count(), "results": results}
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(
+            RESULTS_DIR, f"{started.strftime('%Y%m%d-%H%M%S')}-{report['commit']}.json")
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results saved to {output}")
+    return output
+
+
+def compare(old_path: str, new_path: str, threshold: float = 0.10) -> None:
+    """ compare prints the change in median time of every benchmark present in both result files.
+        Changes larger than threshold (10% by default) are marked as faster or slower """
+    with open(old_path, "r") as file:
+        old = json.load(file)
+    with open(new_path, "r") as file:
+        new = json.load(file)
+    old_results = {(result["benchmark"], result["size"]): result
+                   for result in old["results"] if "median" in result}
+
+    print(f"{old['commit']} ({old['date']}) -> {new['commit']} ({new['date']})")
+    for result in new["results"]:
+        key = (result["benchmark"], result["size"])
+        if "median" not in result or key not in old_results:
+            continue
+        before, after = old_results[key]["median"], result["median"]
+        ratio = after / before if before else float("inf")
+        mark = "slower" if ratio > 1 + threshold else "faster" if ratio < 1 - threshold else ""
+        print(f"{key[0]:40} {key[1]:>6}  {before:9.4f}s -> {after:9.4f}s  x{ratio:5.2f} {mark}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the collectors, analytics, graphs and reports on synthetic data")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks and save the results")
+    run_parser.add_argument("--sizes", nargs="+", type=int, default=SIZES,
+                            help="Numbers of municipalities to generate")
+    run_parser.add_argument("--only", nargs="+", default=[],
+                            help="Only run benchmarks whose name starts with one of these prefixes, e.g. graph. fetch.vendor_scores")
+    run_parser.add_argument("--repeat", type=int, default=3,
+                            help="Times each benchmark is run, the minimum and median are reported")
+    run_parser.add_argument("--output", help="Results file (default benchmarks/results/<date>-<commit>.json)")
+    run_parser.add_argument("--list", action="store_true", help="List the benchmarks and exit")
+    compare_parser = subparsers.add_parser("compare", help="Compare two results files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.10,
+                                help="Relative change reported as faster/slower")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        compare(args.old, args.new, args.threshold)
+    elif args.list:
+        print("\n".join(BENCHMARKS))
+    else:
+        run(args.sizes, args.only, max(1, args.repeat), args.output)
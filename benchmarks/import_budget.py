@@ -0,0 +1,104 @@
+import argparse
+import os
+import subprocess
+import sys
+
+#####################################################################################
+# import_budget.py
+# Author: Adi Bhan
+# This script checks how long each Scripts module takes to import (python -X importtime) and that heavy libraries
+# are only loaded by the modules that draw or render, so short commands and worker processes keep starting fast
+#
+# Usage (from the repository root):
+#   python benchmarks/import_budget.py [--scale 2] [--repeat 3] [--only FetchData Pipeline]
+###############################################################################################################
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS_DIR = os.path.join(ROOT, "Scripts")
+
+# Libraries that must be imported lazily, by the stage or method that uses them
+PLOTTING = ["matplotlib", "seaborn"]
+DATAFRAMES = ["pandas", "numpy"]
+EXTRAS = ["reportlab", "geopy", "openpyxl"]
+CLIENTS = ["pymongo", "requests"]
+
+# module: (budget in milliseconds, top level packages it must not import)
+BUDGETS = {
+    "Pipeline": (600, PLOTTING + DATAFRAMES + EXTRAS),
+    "FetchData": (600, PLOTTING + DATAFRAMES + EXTRAS),
+    "Remediation": (600, PLOTTING + DATAFRAMES + EXTRAS),
+    "Graph": (1200, PLOTTING + EXTRAS),
+    # Imported by render worker processes
+    "ChartRenderer": (2500, CLIENTS + EXTRAS),
+    "ReportRenderer": (500, PLOTTING + DATAFRAMES + CLIENTS + ["geopy", "openpyxl"]),
+    # Short ops commands
+    "ResponseCache": (150, PLOTTING + DATAFRAMES + EXTRAS + CLIENTS),
+    "GeocodeCache": (150, PLOTTING + DATAFRAMES + EXTRAS + CLIENTS),
+    "Metrics": (150, PLOTTING + DATAFRAMES + EXTRAS + CLIENTS),
+    "Replay": (150, PLOTTING + DATAFRAMES + EXTRAS + CLIENTS),
+}
+
+
+def import_profile(module: str) -> tuple:
+    """ import_profile imports module in a fresh interpreter with -X importtime and returns
+        (cumulative milliseconds, set of every module it imported) """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=SCRIPTS_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr.strip().splitlines()[-1]}")
+
+    total, imported = None, set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue  # the header line
+        imported.add(name.strip())
+        if name.strip() == module:
+            total = int(cumulative) / 1000
+    return total, imported
+
+
+def check(modules: list, scale: float = 1.0, repeat: int = 3) -> list:
+    """ check imports every module repeat times and returns a list of problems (empty if every budget holds).
+        The fastest import is compared with the budget times scale, for slower machines """
+    problems = []
+    for module in modules:
+        budget, forbidden = BUDGETS[module]
+        timings, imported = [], set()
+        for _ in range(max(1, repeat)):
+            total, imported = import_profile(module)
+            timings.append(total)
+        best = min(timings)
+        loaded = sorted(package for package in forbidden
+                        if package in imported or any(name.startswith(package + ".") for name in imported))
+        status = "ok"
+        if best > budget * scale:
+            status = "over budget"
+            problems.append(f"{module} took {best:.0f} ms to import, the budget is {budget * scale:.0f} ms")
+        if loaded:
+            status = "imports " + ", ".join(loaded)
+            problems.append(f"{module} imports {', '.join(loaded)}, which must be imported lazily")
+        print(f"{module:16} {best:8.0f} ms  budget {budget * scale:6.0f} ms  {status}")
+    return problems
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Check the import time of the Scripts modules against their budgets")
+    parser.add_argument("--only", nargs="+", choices=list(BUDGETS), default=list(BUDGETS),
+                        help="Only check these modules")
+    parser.add_argument("--scale", type=float, default=float(os.getenv("IMPORT_BUDGET_SCALE", 1)),
+                        help="Multiply every budget, e.g. 2 on a slow machine")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Imports per module, the fastest one counts")
+    args = parser.parse_args()
+
+    problems = check(args.only, args.scale, args.repeat)
+    print("--------------------------------------------------------------------")
+    for problem in problems:
+        print(problem)
+    print("All import budgets hold" if not problems else f"{len(problems)} import budget problems")
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,23 @@
+import os
+import sys
+import pytest
+
+#####################################################################################
+# test_import_budget.py
+# Author: Adi Bhan
+# Runs benchmarks/import_budget.py as part of the test suite, so a module that starts importing matplotlib, pandas,
+# ReportLab or pymongo eagerly (or gets slow to import) fails `make test`.
+# IMPORT_BUDGET_SCALE multiplies every budget (e.g. 2 on a slow machine), 0 skips the check
+###############################################################################################################
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from import_budget import BUDGETS, check  # noqa: E402
+
+SCALE = float(os.getenv("IMPORT_BUDGET_SCALE", 1))
+
+
+@pytest.mark.skipif(SCALE <= 0, reason="IMPORT_BUDGET_SCALE=0 disables the import budget check")
+@pytest.mark.parametrize("module", list(BUDGETS))
+def test_import_budget(module):
+    assert check([module], scale=SCALE, repeat=2) == []
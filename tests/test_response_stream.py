@@ -0,0 +1,140 @@
+import json
+import os
+import sys
+import pytest
+
+#####################################################################################
+# test_response_stream.py
+# Author: Adi Bhan
+# Regression tests for ResponseStream.iter_records and the collectors that use it: every risk and vulnerability
+# of a response is kept, including the last one that the old range(len(...) - 1) loops dropped,
+# and risks that could not be written are ingested again on the next run
+###############################################################################################################
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Scripts"))
+
+from ResponseStream import iter_records  # noqa: E402
+
+RECORDS = 25
+MUNICIPALITIES = {"Town A": "towna.gov", "Town B": "townb.gov"}
+
+
+class FakeResponse:
+    """ FakeResponse stands in for a requests.Response with a JSON body, as returned by FetchEngine.fetch_all """
+
+    def __init__(self, body: dict):
+        self.content = json.dumps(body).encode("utf-8")
+        self.text = self.content.decode("utf-8")
+        self.status_code = 200
+        self.fetch_seconds = 0.0
+        self.changed = True
+
+    def json(self) -> dict:
+        return json.loads(self.content)
+
+
+def risks_body(city: str, n: int = RECORDS) -> dict:
+    return {"risks": [{"risk": f"{city} risk {index}", "riskSubtype": "synthetic", "severity": "high",
+                       "category": "websiteSecurity", "description": "Synthetic risk",
+                       "firstDetected": f"2023-01-{index % 28 + 1:02d}T00:00:{index % 60:02d}Z"} for index in range(n)]}
+
+
+def vulnerabilities_body(n: int = RECORDS) -> dict:
+    return {"vulnerabilities": [{"cve": {"id": f"CVE-2023-{index}", "severity": "low",
+                                         "description": f"Vulnerability {index}"}} for index in range(n)]}
+
+
+@pytest.fixture(params=["json", "ijson"])
+def threshold(request):
+    """ The iter_records threshold that selects the response.json() path or the ijson path """
+    if request.param == "ijson":
+        pytest.importorskip("ijson")
+        return 0
+    return 1 << 40
+
+
+@pytest.fixture
+def fetcher(tmp_path, monkeypatch):
+    """ A FetchData on the in-memory backend whose fetch engine answers from risks_body/vulnerabilities_body """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("UPGUARD_CACHE", "off")
+    monkeypatch.setenv("METRICS", "off")
+    from Metrics import Metrics
+    from MongoConnection import MongoConnection
+    from FetchData import FetchData
+    monkeypatch.setattr(Metrics, "shared_metrics", None)
+
+    fetcher = FetchData(MongoConnection(backend="memory"))
+    fetcher.muncipalities = dict(MUNICIPALITIES)
+    hosts = {hostname: name for name, hostname in MUNICIPALITIES.items()}
+
+    def fetch_all(jobs):
+        responses = []
+        for url, params in jobs:
+            name = hosts[params["hostname"]]
+            responses.append(FakeResponse(
+                vulnerabilities_body() if url == fetcher.VULNERABILITY_URL else risks_body(name)))
+        return responses
+
+    fetcher.fetch_engine.fetch_all = fetch_all
+    return fetcher
+
+
+def test_iter_records_keeps_every_record(threshold):
+    records = list(iter_records(FakeResponse(risks_body("Town A")), "risks", threshold=threshold))
+    assert len(records) == RECORDS
+    assert records[-1]["risk"] == f"Town A risk {RECORDS - 1}"
+
+
+def test_iter_records_missing_or_empty_key(threshold):
+    assert list(iter_records(FakeResponse({"risks": []}), "risks", threshold=threshold)) == []
+    assert list(iter_records(FakeResponse({"other": 1}), "risks", threshold=1 << 40)) == []
+
+
+def test_risk_timeseries_stores_every_risk(fetcher, threshold, monkeypatch):
+    monkeypatch.setattr("FetchData.iter_records",
+                        lambda response, key: iter_records(response, key, threshold=threshold))
+    fetcher.risk_timeseries()
+
+    for city in MUNICIPALITIES:
+        stored = {document["Risk"] for document in fetcher.collection_risks.find({"Name": city})}
+        assert len(stored) == RECORDS
+        assert f"{city} risk {RECORDS - 1}" in stored
+
+
+def test_vulnerabilities_stores_every_vulnerability(fetcher, threshold, monkeypatch):
+    monkeypatch.setattr("FetchData.iter_records",
+                        lambda response, key: iter_records(response, key, threshold=threshold))
+    fetcher.fetch_vulnerabilities()
+
+    for city in MUNICIPALITIES:
+        vulnerabilities = fetcher.collection_vulnerabilities.find_one({"name": city})["vulnerabilities"]
+        assert len(vulnerabilities) == RECORDS
+        assert vulnerabilities[-1]["CVE"] == f"CVE-2023-{RECORDS - 1}"
+
+
+def test_failed_risk_write_keeps_high_water_mark(fetcher, monkeypatch):
+    # The first bulk_write of the risks fails as a whole (e.g. a network error)
+    collection = fetcher.collection_risks
+    bulk_write, calls = collection.bulk_write, []
+
+    def flaky_bulk_write(operations, **kwargs):
+        calls.append(len(operations))
+        if len(calls) == 1:
+            raise ConnectionError("MongoDB unreachable")
+        return bulk_write(operations, **kwargs)
+
+    monkeypatch.setattr(collection, "bulk_write", flaky_bulk_write)
+    assert fetcher.collection_risks.bulk_write is flaky_bulk_write
+    fetcher.risk_timeseries()
+
+    assert collection.count_documents({}) == 0
+    assert fetcher.collection_ingest_state.count_documents({"risks_high_water": {"$exists": True}}) == 0
+    assert set(fetcher.dead_letters().get("risks", [])) == set(MUNICIPALITIES)
+
+    # The next run ingests every risk again and moves the marks forward
+    fetcher.risk_timeseries()
+    for city in MUNICIPALITIES:
+        assert collection.count_documents({"Name": city}) == RECORDS
+    assert fetcher.collection_ingest_state.count_documents({"risks_high_water": {"$exists": True}}) == len(MUNICIPALITIES)
+    assert fetcher.dead_letters().get("risks", []) == []